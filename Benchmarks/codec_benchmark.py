@@ -0,0 +1,49 @@
+from Benchmarks.rsa_key_benchmark import measure
+from Communication.Messages.message_codecs import MESSAGE_CODECS, MessageCodecsEnum
+from Communication.Messages.messages import ContentMessage, ClientRegistrationMessage, KeyMessage, OptMessage, \
+    AckMessage, CommunicationMessage
+from Tools.crypto_suites import CryptoSuitesEnum
+from Tools.encryptors import EncryptorAES, EncryptorAESKey, EncryptorRSAKey, EncryptorRSA
+from Tools.tools import Tools
+
+ITERATIONS = 20000
+
+
+def sample_messages() -> list[CommunicationMessage]:
+    """One message of every type, with realistic field sizes."""
+    private_key, public_key = EncryptorRSAKey.create_keys()
+    aes_key = EncryptorAESKey.create()
+    content = EncryptorAES().encrypt(key=aes_key, content="Hey, are we still meeting at eight tonight?")
+    hmac = Tools.generate_hmac(key=aes_key, content=content.encode())
+
+    return [
+        ContentMessage(uid="0541234567",
+                       des_uid="0547654321",
+                       content=content,
+                       hmac=hmac,
+                       signature=Tools.create_signature(rsa_private_key=private_key, hmac=hmac)),
+        ClientRegistrationMessage(uid="0541234567",
+                                  public_key=public_key.str(),
+                                  suites=[CryptoSuitesEnum.RSA],
+                                  codecs=[MessageCodecsEnum.BINARY, MessageCodecsEnum.JSON]),
+        KeyMessage(uid="0541234567",
+                   encrypted_key=EncryptorRSA().encrypt(key=public_key, content=aes_key.str()),
+                   suite=CryptoSuitesEnum.RSA),
+        OptMessage(uid="0541234567", opt="123456"),
+        AckMessage(uid="0541234567", ack="ok"),
+    ]
+
+
+def main():
+    print(f"{'message':<28}{'codec':<12}{'bytes':>8}{'encode/s':>12}{'decode/s':>12}")
+    for message in sample_messages():
+        for codec in MESSAGE_CODECS.values():
+            payload = codec.encode(message)
+            encode = measure(lambda: codec.encode(message), iterations=ITERATIONS)
+            decode = measure(lambda: codec.decode(payload), iterations=ITERATIONS)
+            print(f"{type(message).__name__:<28}{codec.NAME.value:<12}{len(payload):>8}"
+                  f"{1_000_000 / encode:>12.0f}{1_000_000 / decode:>12.0f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,48 @@
+from Benchmarks.rsa_key_benchmark import measure
+from Tools.compression import COMPRESSIONS, compress, decompress
+from Tools.encryptors import EncryptorAES, EncryptorAESKey
+from Tools.tools import Tools
+
+ITERATIONS = 5000
+
+SAMPLE_MESSAGES = {
+    "short": "ok, see you later",
+    "chat": "Hey, are we still meeting at eight tonight? Let me know when you're home, I'll call you.",
+    "paragraph": ("Sorry I couldn't answer before, I was in a meeting the whole afternoon. I read the document you "
+                  "sent me and I think the second part needs more work, the numbers in the table don't match the "
+                  "ones in the summary. Can we talk about it tomorrow morning? I'm free after ten. ") * 2,
+    "log": "\n".join(f"2024-05-{day:02d} 12:00:{day:02d} INFO user 0541234567 sent message {day}"
+                     for day in range(1, 29)),
+}
+
+
+def main():
+    """Bytes on the wire and the cost of the sender's and the receiver's side of the content pipeline."""
+    aes_key = EncryptorAESKey.create()
+    encryptor_aes = EncryptorAES()
+
+    print(f"{'message':<12}{'compression':<14}{'raw':>8}{'wire':>8}{'ratio':>8}{'send us':>10}{'receive us':>12}")
+    for name, text in SAMPLE_MESSAGES.items():
+        raw = text.encode()
+        for compression in COMPRESSIONS.values():
+            def send():
+                data, flag = compress(raw, compression)
+                content = encryptor_aes.encrypt_bytes(key=aes_key, data=data)
+                return content, Tools.generate_hmac(key=aes_key, content=content.encode()), flag
+
+            content, hmac, flag = send()
+
+            def receive():
+                Tools.verify_hmac(key=aes_key, content=content.encode(), hmac=hmac)
+                return decompress(encryptor_aes.decrypt_bytes(key=aes_key, content=content), flag=flag)
+
+            assert receive() == raw
+            send_time = measure(send, iterations=ITERATIONS)
+            receive_time = measure(receive, iterations=ITERATIONS)
+            # the wire size is the base64 content the messages carry
+            print(f"{name:<12}{compression.NAME.value:<14}{len(raw):>8}{len(content):>8}"
+                  f"{len(content) / len(raw):>8.2f}{send_time:>10.1f}{receive_time:>12.1f}")
+
+
+if __name__ == "__main__":
+    main()
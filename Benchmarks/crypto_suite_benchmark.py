@@ -0,0 +1,35 @@
+from Benchmarks.rsa_key_benchmark import measure
+from Tools.crypto_suites import CRYPTO_SUITES
+from Tools.encryptors import EncryptorAESKey, EncryptorRSA
+from Tools.tools import Tools
+
+KEY_GENERATION_ITERATIONS = 5
+
+
+def main():
+    hmac = Tools.generate_hmac(key=EncryptorAESKey.create(), content=b"benchmark message")
+
+    print(f"{'suite':<18}{'key generation (us)':>22}{'sign (us)':>12}{'verify (us)':>14}{'key exchange (us)':>20}")
+    for suite in CRYPTO_SUITES.values():
+        key_generation = measure(suite.create_signing_keys, iterations=KEY_GENERATION_ITERATIONS)
+
+        private_key, public_key = suite.create_signing_keys()
+        signature = suite.sign(private_key=private_key, hmac=hmac)
+        sign = measure(lambda: suite.sign(private_key=private_key, hmac=hmac))
+        verify = measure(lambda: suite.verify(public_key=public_key, signature=signature, hmac=hmac))
+
+        # what the server does to get the AES key of a new client
+        if suite.USES_KEY_AGREEMENT:
+            server_private_key, _ = suite.create_agreement_keys()
+            _, client_public_key = suite.create_agreement_keys()
+            key_exchange = measure(lambda: suite.derive_aes_key(private_key=server_private_key,
+                                                                peer_public_key=client_public_key))
+        else:
+            encrypted_key = EncryptorRSA().encrypt(key=public_key, content=EncryptorAESKey.create().str())
+            key_exchange = measure(lambda: EncryptorRSA().decrypt(key=private_key, content=encrypted_key))
+
+        print(f"{suite.NAME.value:<18}{key_generation:>22.1f}{sign:>12.1f}{verify:>14.1f}{key_exchange:>20.1f}")
+
+
+if __name__ == "__main__":
+    main()
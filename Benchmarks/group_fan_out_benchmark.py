@@ -0,0 +1,69 @@
+from Benchmarks.rsa_key_benchmark import measure
+from Server.crypto_pool import GroupOpenJob, GroupRecipient, GroupSealJob, RelayJob, open_group_message, \
+    relay_crypto, seal_group_message
+from Tools.compression import CompressionsEnum
+from Tools.crypto_suites import CRYPTO_SUITES
+from Tools.encryptors import EncryptorAES, EncryptorAESKey
+from Tools.tools import Tools
+
+ITERATIONS = 5
+GROUP_SIZES = (10, 100, 1000)
+
+
+def main():
+    """Server side crypto of one message to a group against one message to every member."""
+    print(f"{'suite':<18}{'members':>8}{'per member ms':>16}{'group ms':>12}{'speedup':>10}")
+    for suite in CRYPTO_SUITES.values():
+        server_private_key, _ = suite.create_signing_keys()
+        server_private_keys = {suite.NAME: server_private_key}
+        sender_private_key, sender_public_key = suite.create_signing_keys()
+        sender_aes_key = EncryptorAESKey.create()
+
+        content = EncryptorAES().encrypt(key=sender_aes_key, content="Hey everyone, the meeting moved to eight.")
+        hmac = Tools.generate_hmac(key=sender_aes_key, content=content.encode())
+        signature = suite.sign(private_key=sender_private_key, hmac=hmac)
+
+        for group_size in GROUP_SIZES:
+            member_keys = [EncryptorAESKey.create() for _ in range(group_size)]
+
+            # before: the sender sends one message for every member, each is relayed on its own
+            def per_member():
+                for member_key in member_keys:
+                    relay_crypto(RelayJob(sender_aes_key=sender_aes_key,
+                                          recipient_aes_key=member_key,
+                                          sender_public_key=sender_public_key,
+                                          sender_suite=suite.NAME,
+                                          recipient_suite=suite.NAME,
+                                          content=content,
+                                          hmac=hmac,
+                                          signature=signature),
+                                 server_private_keys=server_private_keys)
+
+            # after: verified, decrypted and signed once, only the AES and the HMAC are per member
+            def group():
+                result = open_group_message(GroupOpenJob(uid="0541234567",
+                                                         group_id="friends",
+                                                         sender_aes_key=sender_aes_key,
+                                                         sender_public_key=sender_public_key,
+                                                         sender_suite=suite.NAME,
+                                                         content=content,
+                                                         hmac=hmac,
+                                                         signature=signature,
+                                                         compression="",
+                                                         signing_suites=(suite.NAME,)),
+                                            server_private_keys=server_private_keys)
+                recipients = tuple(GroupRecipient(uid=str(index),
+                                                  aes_key=member_key,
+                                                  suite=suite.NAME,
+                                                  compression=CompressionsEnum.NONE)
+                                   for index, member_key in enumerate(member_keys))
+                seal_group_message(GroupSealJob(data=result.data, recipients=recipients))
+
+            per_member_time = measure(per_member, iterations=ITERATIONS) / 1000
+            group_time = measure(group, iterations=ITERATIONS) / 1000
+            print(f"{suite.NAME.value:<18}{group_size:>8}{per_member_time:>16.1f}{group_time:>12.1f}"
+                  f"{per_member_time / group_time:>10.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,352 @@
+import argparse
+import asyncio
+import itertools
+import json
+import logging
+import multiprocessing
+import platform
+import socket
+import tempfile
+import time
+from datetime import datetime
+from typing import Optional
+
+from Communication.Messages.message_codecs import MessageCodecsEnum, decode_message, get_codec
+from Communication.Messages.messages import AckMessage, ClientRegistrationMessage, ContentMessage, KeyMessage, \
+    OptMessage, HeartbeatMessage
+from Communication.framing import read_frame
+from Tools.crypto_suites import CryptoSuitesEnum, get_suite
+from Tools.encryptors import EncryptorAES, EncryptorAESKey, EncryptorECCKey, EncryptorRSA
+from Tools.tools import Tools
+
+try:
+    import resource
+except ImportError:  # not on Windows
+    resource = None
+
+HOST = "127.0.0.1"
+
+
+def percentile(values: list[float], percent: float) -> Optional[float]:
+    """Nearest rank percentile, None if there are no values."""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(1, round(percent / 100 * len(ordered)))
+    return ordered[min(rank, len(ordered)) - 1]
+
+
+def latency_summary(latencies: list[float]) -> dict:
+    """p50/p95/p99/max of latencies in seconds, reported in milliseconds."""
+    summary = {f"p{percent}": percentile(latencies, percent) for percent in (50, 95, 99, 100)}
+    summary["max"] = summary.pop("p100")
+    return {name: None if value is None else round(value * 1000, 3) for name, value in summary.items()}
+
+
+def run_server(mode: str, port: int, crypto_workers: int, keys_dir: str, workers: int = 1):
+    """Entry point of the server process, the console logging of every message would be the bottleneck."""
+    if workers > 1:
+        from Server.multi_worker import run_workers
+        run_workers(workers=workers,
+                    mode=mode,
+                    host=HOST,
+                    port=port,
+                    runner_arguments=dict(crypto_workers=crypto_workers, keys_dir=keys_dir),
+                    logging_arguments=dict(level=logging.ERROR))
+        return
+    if mode == "asyncio":
+        from Server.async_server_runner import AsyncServerRunner
+        runner = AsyncServerRunner(crypto_workers=crypto_workers, keys_dir=keys_dir)
+    else:
+        from Server.server_runner import ServerRunner
+        runner = ServerRunner(crypto_workers=crypto_workers, keys_dir=keys_dir)
+    runner._logger.setLevel(logging.ERROR)
+    runner.start(host=HOST, port=port)
+
+
+class LoadStats:
+    def __init__(self):
+        self.registration_latencies: list[float] = []
+        self.message_latencies: list[float] = []
+        self.sent = 0
+        self.received = 0
+        self.errors = 0
+
+
+class SimulatedClient:
+    """A client that goes through the same registration and content flow as ClientRunner, without a console."""
+
+    def __init__(self, uid: str, suite: CryptoSuitesEnum, codec: MessageCodecsEnum, stats: LoadStats):
+        self.uid = uid
+        self._suite = get_suite(suite)
+        self._codecs = [codec]
+        self._codec = None
+        self._stats = stats
+        # created before the clock starts, the benchmark measures the server and not the client's key generation
+        self._private_key, self._public_key = self._suite.create_signing_keys()
+        self._aes_key = EncryptorAESKey.create()
+        self._server_public_key = None
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+
+    async def register(self, port: int):
+        start = time.perf_counter()
+        self._reader, self._writer = await asyncio.open_connection(HOST, port)
+        self._writer.write(ClientRegistrationMessage(uid=self.uid,
+                                                     public_key=self._public_key.str(),
+                                                     suites=[self._suite.NAME],
+                                                     codecs=self._codecs).encode())
+
+        opt_message = decode_message(await read_frame(self._reader))
+        if not isinstance(opt_message, OptMessage):
+            raise ValueError(f"Expected an OPT message, got {opt_message}")
+        self._writer.write(OptMessage(uid=self.uid, opt=opt_message.opt).encode())
+
+        key_message = decode_message(await read_frame(self._reader))
+        if not isinstance(key_message, KeyMessage):
+            raise ValueError(f"Expected a key message, got {key_message}")
+        self._codec = get_codec(key_message.codec)
+        self._server_public_key = self._suite.import_key(key_message.encrypted_key)
+        if self._suite.USES_KEY_AGREEMENT:
+            agreement_private_key, agreement_public_key = self._suite.create_agreement_keys()
+            self._aes_key = self._suite.derive_aes_key(private_key=agreement_private_key,
+                                                       peer_public_key=EncryptorECCKey(key_message.agreement_key))
+            encrypted_key = agreement_public_key.str()
+        else:
+            encrypted_key = EncryptorRSA().encrypt(key=self._server_public_key, content=self._aes_key.str())
+        self._writer.write(KeyMessage(uid=self.uid, encrypted_key=encrypted_key, suite=self._suite.NAME)
+                           .encode(codec=self._codec))
+        await self._writer.drain()
+
+        ack_message = decode_message(await read_frame(self._reader))
+        if not isinstance(ack_message, AckMessage) or ack_message.ack != AckMessage.key_ack(self.uid):
+            raise ValueError(f"Expected an ack of the registration, got {ack_message}")
+        self._stats.registration_latencies.append(time.perf_counter() - start)
+
+    def send(self, des_uid: str, size: int):
+        # the send time travels in the content, sender and receiver share the clock of this process
+        content = f"{time.perf_counter():.9f}|".ljust(size, "x")
+        encrypted_content = EncryptorAES().encrypt(key=self._aes_key, content=content)
+        hmac = Tools.generate_hmac(key=self._aes_key, content=encrypted_content.encode())
+        message = ContentMessage(uid=self.uid,
+                                 des_uid=des_uid,
+                                 content=encrypted_content,
+                                 hmac=hmac,
+                                 signature=self._suite.sign(private_key=self._private_key, hmac=hmac))
+        self._writer.write(message.encode(codec=self._codec))
+        self._stats.sent += 1
+
+    async def receive_loop(self):
+        while True:
+            try:
+                message = decode_message(await read_frame(self._reader))
+            except (asyncio.IncompleteReadError, ConnectionError):
+                return
+            if isinstance(message, HeartbeatMessage) and not message.pong:
+                self._writer.write(HeartbeatMessage(uid=self.uid, pong=True).encode(codec=self._codec))
+                continue
+            if not isinstance(message, ContentMessage):
+                continue
+
+            # the same checks ClientRunner does on every message
+            if not Tools.verify_hmac(key=self._aes_key, content=message.content.encode(), hmac=message.hmac):
+                self._stats.errors += 1
+                continue
+            try:
+                self._suite.verify(public_key=self._server_public_key, signature=message.signature, hmac=message.hmac)
+            except (ValueError, TypeError):
+                self._stats.errors += 1
+                continue
+            content = EncryptorAES().decrypt(key=self._aes_key, content=message.content)
+            self._stats.message_latencies.append(time.perf_counter() - float(content.split("|", 1)[0]))
+            self._stats.received += 1
+
+    async def send_loop(self, des_uid: str, size: int, rate: float, duration: float, offset: float):
+        """Send rate messages a second for duration seconds, on a fixed schedule so delays don't add up."""
+        loop = asyncio.get_running_loop()
+        start = loop.time() + offset
+        for index in range(max(1, int(rate * duration))):
+            delay = start + index / rate - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            self.send(des_uid=des_uid, size=size)
+            await self._writer.drain()
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+
+
+async def run_scenario(port: int,
+                       clients: int,
+                       size: int,
+                       rate: float,
+                       duration: float,
+                       suite: CryptoSuitesEnum,
+                       codec: MessageCodecsEnum,
+                       max_concurrent_registrations: int,
+                       drain_timeout: float) -> dict:
+    stats = LoadStats()
+    simulated_clients = [SimulatedClient(uid=f"load-{index:06d}", suite=suite, codec=codec, stats=stats)
+                         for index in range(clients)]
+
+    # registration: every client through registration, OPT and key exchange
+    registrations = asyncio.Semaphore(max_concurrent_registrations)
+
+    async def register(simulated_client: SimulatedClient):
+        async with registrations:
+            try:
+                await simulated_client.register(port)
+            except (OSError, ValueError, asyncio.IncompleteReadError):
+                stats.errors += 1
+
+    registration_start = time.perf_counter()
+    await asyncio.gather(*(register(simulated_client) for simulated_client in simulated_clients))
+    registration_time = time.perf_counter() - registration_start
+    registered = [simulated_client for simulated_client in simulated_clients if simulated_client._codec is not None]
+
+    # content: every client sends to the next one, the starts are spread over one interval of the rate
+    receivers = [asyncio.create_task(simulated_client.receive_loop()) for simulated_client in registered]
+    content_start = time.perf_counter()
+    await asyncio.gather(*(simulated_client.send_loop(des_uid=registered[(index + 1) % len(registered)].uid,
+                                                      size=size,
+                                                      rate=rate,
+                                                      duration=duration,
+                                                      offset=index / len(registered) / rate)
+                           for index, simulated_client in enumerate(registered)))
+    deadline = time.perf_counter() + drain_timeout
+    while stats.received + stats.errors < stats.sent and time.perf_counter() < deadline:
+        await asyncio.sleep(0.05)
+    content_time = time.perf_counter() - content_start
+
+    for simulated_client in registered:
+        await simulated_client.close()
+    for receiver in receivers:
+        receiver.cancel()
+    await asyncio.gather(*receivers, return_exceptions=True)
+
+    return {
+        "clients": clients,
+        "message_size": size,
+        "rate_per_client": rate,
+        "duration": duration,
+        "registered": len(registered),
+        "registrations_per_second": round(len(registered) / registration_time, 2),
+        "registration_latency_ms": latency_summary(stats.registration_latencies),
+        "messages_sent": stats.sent,
+        "messages_received": stats.received,
+        "messages_lost": stats.sent - stats.received - stats.errors,
+        "errors": stats.errors,
+        "messages_per_second": round(stats.received / content_time, 2),
+        "message_latency_ms": latency_summary(stats.message_latencies),
+    }
+
+
+def free_port() -> int:
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_server(port: int, timeout: float = 30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection((HOST, port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.1)
+    raise TimeoutError(f"The server didn't start listening on port {port}")
+
+
+def raise_open_files_limit(clients: int):
+    """Every client is a socket in this process and in the server, the default limit is often 1024."""
+    if resource is None:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    needed = clients * 2 + 256
+    if soft != resource.RLIM_INFINITY and soft < needed:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (needed if hard == resource.RLIM_INFINITY else min(needed, hard),
+                                                    hard))
+
+
+def parse_list(value: str, value_type: type) -> list:
+    return [value_type(item) for item in value.split(",")]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load the server with simulated clients and measure it.")
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="threaded")
+    parser.add_argument("--crypto-workers", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=1, help="Server processes that share the port.")
+    parser.add_argument("--clients", default="100,1000", help="Comma separated numbers of clients.")
+    parser.add_argument("--sizes", default="64,1024", help="Comma separated content sizes in bytes.")
+    parser.add_argument("--rates", default="1", help="Comma separated messages a second of every client.")
+    parser.add_argument("--duration", type=float, default=10, help="Seconds every client sends messages.")
+    parser.add_argument("--suite", choices=[suite.value for suite in CryptoSuitesEnum],
+                        default=CryptoSuitesEnum.ED25519_X25519.value)
+    parser.add_argument("--codec", choices=[codec.value for codec in MessageCodecsEnum],
+                        default=MessageCodecsEnum.BINARY.value)
+    parser.add_argument("--max-concurrent-registrations", type=int, default=100)
+    parser.add_argument("--drain-timeout", type=float, default=10,
+                        help="Seconds to wait for the messages in flight after the last one was sent.")
+    parser.add_argument("--output", default="load_benchmark_results.json", help="JSON file of the results.")
+    args = parser.parse_args()
+
+    scenarios = list(itertools.product(parse_list(args.clients, int),
+                                       parse_list(args.sizes, int),
+                                       parse_list(args.rates, float)))
+    raise_open_files_limit(max(clients for clients, _, _ in scenarios))
+
+    results = []
+    print(f"{'clients':>8}{'size':>7}{'rate':>6}{'reg/s':>9}{'reg p99 ms':>12}{'msg/s':>9}"
+          f"{'p50 ms':>9}{'p95 ms':>9}{'p99 ms':>9}{'lost':>6}{'errors':>8}")
+    # the servers of all the scenarios share their keys, only the first one waits for the key generation
+    keys_dir = tempfile.TemporaryDirectory()
+    for clients, size, rate in scenarios:
+        # a new server for every scenario, so one scenario's users and mailboxes don't weigh on the next
+        port = free_port()
+        # not a daemon, a multi-worker server starts its own processes
+        server = multiprocessing.Process(target=run_server,
+                                         args=(args.mode, port, args.crypto_workers, keys_dir.name, args.workers))
+        server.start()
+        try:
+            wait_for_server(port)
+            result = asyncio.run(run_scenario(port=port,
+                                              clients=clients,
+                                              size=size,
+                                              rate=rate,
+                                              duration=args.duration,
+                                              suite=CryptoSuitesEnum(args.suite),
+                                              codec=MessageCodecsEnum(args.codec),
+                                              max_concurrent_registrations=args.max_concurrent_registrations,
+                                              drain_timeout=args.drain_timeout))
+        finally:
+            server.terminate()
+            server.join()
+
+        results.append(result)
+        latency = result["message_latency_ms"]
+        print(f"{clients:>8}{size:>7}{rate:>6g}{result['registrations_per_second']:>9}"
+              f"{result['registration_latency_ms']['p99']!s:>12}{result['messages_per_second']:>9}"
+              f"{latency['p50']!s:>9}{latency['p95']!s:>9}{latency['p99']!s:>9}"
+              f"{result['messages_lost']:>6}{result['errors']:>8}")
+    keys_dir.cleanup()
+
+    with open(args.output, "w", encoding="utf-8") as output_file:
+        json.dump({
+            "benchmark": "load",
+            "started": datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "cpus": multiprocessing.cpu_count(),
+            "server": {"mode": args.mode, "crypto_workers": args.crypto_workers, "workers": args.workers},
+            "suite": args.suite,
+            "codec": args.codec,
+            "results": results,
+        }, output_file, indent=2)
+    print(f"Results written to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,41 @@
+import time
+
+from Tools.encryptors import EncryptorRSAKey, EncryptorAESKey
+from Tools.tools import Tools
+
+ITERATIONS = 200
+
+
+def measure(function, iterations: int = ITERATIONS) -> float:
+    """Return the average time of one call in microseconds."""
+    start = time.perf_counter()
+    for _ in range(iterations):
+        function()
+    return (time.perf_counter() - start) / iterations * 1_000_000
+
+
+def main():
+    private_key, public_key = EncryptorRSAKey.create_keys()
+    hmac = Tools.generate_hmac(key=EncryptorAESKey.create(), content=b"benchmark message")
+    signature = Tools.create_signature(rsa_private_key=private_key, hmac=hmac)
+
+    # before: every message used a key that had to be parsed from the PEM again
+    sign_parsed = measure(lambda: Tools.create_signature(rsa_private_key=EncryptorRSAKey(private_key.bytes()),
+                                                         hmac=hmac))
+    verify_parsed = measure(lambda: Tools.varify_signature(rsa_public_key=EncryptorRSAKey(public_key.bytes()),
+                                                           signature=signature,
+                                                           hmac=hmac))
+
+    # after: the key object is imported once and reused for every message
+    sign_cached = measure(lambda: Tools.create_signature(rsa_private_key=private_key, hmac=hmac))
+    verify_cached = measure(lambda: Tools.varify_signature(rsa_public_key=public_key,
+                                                           signature=signature,
+                                                           hmac=hmac))
+
+    print(f"{'operation':<10}{'parse per message (us)':>26}{'cached key (us)':>20}{'speedup':>10}")
+    print(f"{'sign':<10}{sign_parsed:>26.1f}{sign_cached:>20.1f}{sign_parsed / sign_cached:>9.2f}x")
+    print(f"{'verify':<10}{verify_parsed:>26.1f}{verify_cached:>20.1f}{verify_parsed / verify_cached:>9.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,960 @@
+import asyncio
+import base64
+import inspect
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import Future
+from enum import Enum
+from typing import AsyncIterable, AsyncIterator, Awaitable, BinaryIO, Callable, Iterable, Iterator, NamedTuple, \
+    Optional, Union
+
+from Communication.Messages.message_codecs import MessageCodec, MessageCodecsEnum, MessageDecodeError, \
+    decode_message, get_codec
+from Communication.Messages.messages import ClientRegistrationMessage, OptMessage, KeyMessage, ContentMessage, \
+    PublicKeyRequestMessage, PeerKeyMessage, SessionKeyMessage, GroupMessage, GroupContentMessage, AckMessage, \
+    HeartbeatMessage, ResumeMessage, TicketMessage, StreamStartMessage, StreamChunkMessage, StreamEndMessage, \
+    StreamErrorsEnum, CommunicationMessage
+from Communication.framing import read_frame, FrameTooLargeError
+from Tools.compression import Compression, CompressionsEnum, compress, decompress, get_compression
+from Tools.crypto_suites import CRYPTO_SUITES, CryptoSuite, CryptoSuitesEnum, SigningKey, get_suite
+from Tools.encryptors import EncryptorRSA, EncryptorAES, EncryptorAESKey, EncryptorAESStream, EncryptorECCKey
+from Tools.key_pool import get_key_pool
+from Tools.tools import Tools
+from Utils.internal_logger import InternalLogger
+
+# gets the OPT the server sent by the secure channel and returns the OPT to send back
+OptHandler = Callable[[str], Union[str, Awaitable[str]]]
+
+# gets the sender, the name and the size (None if unknown) of a received stream and returns the binary file that
+# its data is written to
+StreamSink = Callable[[str, str, Optional[int]], BinaryIO]
+
+# suites offered to the server when none are given, in order of preference
+DEFAULT_SUITES = [CryptoSuitesEnum.ED25519_X25519, CryptoSuitesEnum.RSA]
+
+
+class ChatClientStatusEnum(str, Enum):
+    REGISTRATION = "registration"
+    WAIT_FOR_OPT = "wait_for_opt"
+    WAIT_FOR_SERVER_PUBLIC_KEY = "wait_for_server_public_key"
+    WAIT_FOR_KEY_ACK = "wait_for_key_ack"
+    COMPLETED_REGISTRATION = "completed_registration"
+
+
+class ReceivedMessage(NamedTuple):
+    """A message from another client, after it was verified and decrypted."""
+    uid: str
+    des_uid: str
+    content: str
+    # the group the message was sent to, empty for a message to des_uid only
+    group_id: str = ""
+    e2e: bool = False
+
+
+class ReceivedStream(NamedTuple):
+    """A stream from another client, after all of it was received and verified.
+
+    The data is in file, at its start. A stream that ended with an error is incomplete, its file is closed.
+    """
+    uid: str
+    des_uid: str
+    stream_id: str
+    name: str
+    size: Optional[int]
+    file: BinaryIO
+    e2e: bool = False
+    error: str = ""
+
+
+class _IncomingStream:
+    """A stream that is being received, its chunks are decrypted into the file as they arrive."""
+
+    def __init__(self, start_message: StreamStartMessage, opened: EncryptorAESStream, file: BinaryIO):
+        self.start_message = start_message
+        self.opened = opened
+        self.file = file
+
+
+class AsyncChatClient:
+    """A client session driven by the server's messages, for bots, integrations and the console client.
+
+    Every call returns when the server's answer arrives instead of polling for it, and all the sessions of a
+    process can share one event loop. Received messages are read with messages() or next_message(), received
+    streams with streams() or next_stream().
+    """
+
+    # bytes of a chunk of a stream
+    STREAM_CHUNK_SIZE = 64 * 1024
+
+    def __init__(self,
+                 uid: str,
+                 host: str = 'localhost',
+                 port: int = 12345,
+                 suites: Optional[list[CryptoSuitesEnum]] = None,
+                 codecs: Optional[list[MessageCodecsEnum]] = None,
+                 compressions: Optional[list[CompressionsEnum]] = None,
+                 end_to_end: bool = False,
+                 opt_handler: Optional[OptHandler] = None,
+                 timeout: float = 30,
+                 session: Optional[dict] = None,
+                 stream_sink: Optional[StreamSink] = None):
+        """With end_to_end the messages are encrypted with a session key of the two clients, the server only
+        forwards them and can't read them. Without an opt_handler the OPT is sent back as it was received.
+        A session of a previous run (the session property) is resumed with resume() instead of registering.
+        Received streams are written to the files of the stream_sink, to temporary files without one.
+        """
+        self._logger: InternalLogger = InternalLogger(logging_level=logging.DEBUG, name="Client.chat_client")
+        self._uid = uid
+        self._host = host
+        self._port = port
+        self._timeout = timeout
+        self._opt_handler: OptHandler = opt_handler or (lambda opt: opt)
+        self._end_to_end = end_to_end
+        # suites offered to the server in order of preference, the keys are created for the first one
+        self._suites: list[CryptoSuitesEnum] = suites or DEFAULT_SUITES
+        self._suite: CryptoSuite = CRYPTO_SUITES[self._suites[0]]
+        # the keys are created in the background until register() needs them
+        get_key_pool(self._suite).start()
+        # codecs the client can decode, the server tells which one to send with
+        self._codecs: list[MessageCodecsEnum] = codecs or [MessageCodecsEnum.BINARY, MessageCodecsEnum.JSON]
+        self._codec: Optional[MessageCodec] = None
+        # compressions the client supports, the server tells which one the content is compressed with
+        self._compressions: list[CompressionsEnum] = compressions or [CompressionsEnum.ZLIB_DICT,
+                                                                      CompressionsEnum.ZLIB,
+                                                                      CompressionsEnum.LZMA]
+        self._compression: Compression = get_compression(None)
+        self._status: ChatClientStatusEnum = ChatClientStatusEnum.REGISTRATION
+
+        self._aes_key: Optional[EncryptorAESKey] = None
+        self._private_key: Optional[SigningKey] = None
+        self._public_key: Optional[SigningKey] = None
+        self._server_public_key: Optional[SigningKey] = None
+        # our part of the key agreement, kept for opening session keys of other clients
+        self._agreement_private_key: Optional[EncryptorECCKey] = None
+        # (suite, public key, agreement key, compression) of other clients as the server signed them,
+        # None if not registered
+        self._peer_keys: dict[str, Optional[tuple[CryptoSuite, SigningKey, Optional[EncryptorECCKey],
+                                                  Compression]]] = {}
+        # session keys of the messages we send to each client and of the messages we receive from each client
+        self._outgoing_session_keys: dict[str, EncryptorAESKey] = {}
+        self._incoming_session_keys: dict[str, EncryptorAESKey] = {}
+        self._session_key_lock = asyncio.Lock()
+
+        self._reader: Optional[asyncio.StreamReader] = None
+        self._writer: Optional[asyncio.StreamWriter] = None
+        self._receiver: Optional[asyncio.Task] = None
+        # futures resolved by the server's answers
+        self._registration: Optional[asyncio.Future] = None
+        self._peer_key_requests: dict[str, asyncio.Future] = {}
+        self._group_requests: dict[str, asyncio.Future] = {}
+        # the server's ticket to resume the session on a new connection, and the resumption that waits for it
+        self._ticket: Optional[str] = None
+        self._resumption: Optional[asyncio.Future] = None
+        # received messages, None once the connection is closed
+        self._messages: asyncio.Queue = asyncio.Queue()
+        # the streams we send by stream id, resolved with the server's answer, and the streams we receive by
+        # (sender, stream id), the received ones are queued once they ended, None once the connection is closed
+        self._outgoing_streams: dict[str, asyncio.Future] = {}
+        self._incoming_streams: dict[tuple[str, str], _IncomingStream] = {}
+        self._stream_sink: StreamSink = stream_sink or (lambda uid, name, size: tempfile.TemporaryFile())
+        self._streams: asyncio.Queue = asyncio.Queue()
+        if session is not None:
+            self._restore_session(session)
+
+    @property
+    def uid(self) -> str:
+        return self._uid
+
+    @property
+    def is_registered(self) -> bool:
+        return self._status == ChatClientStatusEnum.COMPLETED_REGISTRATION
+
+    @property
+    def session(self) -> Optional[dict]:
+        """What resume() needs in another process, None until the server gave a ticket.
+
+        It holds the private keys, keep it as safe as them.
+        """
+        if self._ticket is None:
+            return None
+        return {"uid": self._uid,
+                "suite": self._suite.NAME.value,
+                "private_key": self._private_key.str(),
+                "aes_key": self._aes_key.str(),
+                "server_public_key": self._server_public_key.str(),
+                "agreement_private_key": self._agreement_private_key.str() if self._agreement_private_key else "",
+                "codec": self._codec.NAME.value,
+                "compression": self._compression.NAME.value,
+                "ticket": self._ticket}
+
+    async def connect(self):
+        if self._receiver is not None and self._receiver.done():
+            # a new connection of the session, the messages of the previous one ended with None
+            self._messages = asyncio.Queue()
+            self._streams = asyncio.Queue()
+        self._reader, self._writer = await asyncio.open_connection(self._host, self._port)
+        self._receiver = asyncio.create_task(self._receive_loop())
+
+    async def register(self):
+        """Register the uid with the server, returns once the server acknowledged the keys.
+
+        Raises PermissionError if the server refused the registration.
+        """
+        if self._writer is None:
+            await self.connect()
+
+        # a pair the pool already created, or created on the default executor so the loop keeps running
+        key_pool = get_key_pool(self._suite)
+        self._private_key, self._public_key = await asyncio.get_running_loop().run_in_executor(None, key_pool.get)
+        self._aes_key = EncryptorAESKey.create()
+        self._registration = asyncio.get_running_loop().create_future()
+
+        # set status to wait from OPT from the server
+        self._status = ChatClientStatusEnum.WAIT_FOR_OPT
+
+        # send to server Client's public key, the suites it supports and uid
+        await self._send(ClientRegistrationMessage(uid=self._uid,
+                                                   public_key=self._public_key.str(),
+                                                   suites=self._suites,
+                                                   codecs=self._codecs,
+                                                   compressions=self._compressions))
+        await asyncio.wait_for(asyncio.shield(self._registration), self._timeout)
+
+    async def resume(self) -> bool:
+        """Bind a new connection to the registered session with the server's ticket, in one round trip.
+
+        False if the server didn't accept the ticket, it expired or the keys changed, register() then.
+        """
+        if self._ticket is None:
+            raise ValueError("There is no ticket to resume the session with, register() first.")
+        if self._writer is None or self._writer.is_closing():
+            await self.connect()
+
+        self._resumption = asyncio.get_running_loop().create_future()
+        timestamp = str(time.time())
+        fingerprint = Tools.resumption_fingerprint(self._uid, self._ticket, timestamp)
+        await self._send(ResumeMessage(uid=self._uid,
+                                       ticket=self._ticket,
+                                       timestamp=timestamp,
+                                       hmac=Tools.generate_hmac(key=self._aes_key, content=fingerprint.encode())))
+        return await asyncio.wait_for(asyncio.shield(self._resumption), self._timeout)
+
+    async def send(self, des_uid: str, content: str):
+        """Send the content to des_uid, raises a LookupError if des_uid isn't registered (end to end only)."""
+        # with e2e the message is encrypted with the session key of des_uid instead of the server's one,
+        # and compressed the way des_uid negotiated with the server
+        aes_key, compression = self._aes_key, self._compression
+        if self._end_to_end:
+            aes_key = await self._get_outgoing_session_key(des_uid)
+            compression = self._peer_keys[des_uid][3]
+
+        encrypted_content, hmac, signature, compression_flag = self._seal_content(content=content,
+                                                                                  aes_key=aes_key,
+                                                                                  compression=compression)
+        await self._send(ContentMessage(uid=self._uid,
+                                        des_uid=des_uid,
+                                        content=encrypted_content,
+                                        hmac=hmac,
+                                        signature=signature,
+                                        e2e=self._end_to_end,
+                                        compression=compression_flag))
+
+    async def send_to_group(self, group_id: str, content: str):
+        """Send one message for all the members, the server encrypts it for each of them."""
+        encrypted_content, hmac, signature, compression_flag = self._seal_content(content=content,
+                                                                                  aes_key=self._aes_key,
+                                                                                  compression=self._compression)
+        await self._send(GroupContentMessage(uid=self._uid,
+                                             group_id=group_id,
+                                             des_uid="",
+                                             content=encrypted_content,
+                                             hmac=hmac,
+                                             signature=signature,
+                                             compression=compression_flag))
+
+    async def send_stream(self,
+                          des_uid: str,
+                          chunks: Union[Iterable[bytes], AsyncIterable[bytes]],
+                          name: str = "",
+                          size: Optional[int] = None) -> str:
+        """Send the chunks to des_uid as one stream, returns the stream id once des_uid got all of it.
+
+        Every chunk is encrypted and sent when it's taken from chunks, the payload is never held whole in memory.
+        Raises a ConnectionError with the server's error if the stream wasn't delivered (des_uid has to be online).
+        """
+        aes_key = self._aes_key
+        if self._end_to_end:
+            aes_key = await self._get_outgoing_session_key(des_uid)
+
+        stream_id = uuid.uuid4().hex
+        sealed = EncryptorAESStream(key=aes_key,
+                                    associated_data=Tools.stream_fingerprint(self._uid, des_uid, stream_id))
+        answer = asyncio.get_running_loop().create_future()
+        self._outgoing_streams[stream_id] = answer
+        try:
+            await self._send(StreamStartMessage(uid=self._uid,
+                                                des_uid=des_uid,
+                                                stream_id=stream_id,
+                                                nonce=base64.b64encode(sealed.nonce).decode(),
+                                                name=name,
+                                                size=size,
+                                                e2e=self._end_to_end))
+            try:
+                async for chunk in _iterate(chunks):
+                    if answer.done():
+                        # the server ended the stream, the rest isn't sent
+                        break
+                    for start in range(0, len(chunk), self.STREAM_CHUNK_SIZE):
+                        data = sealed.encrypt(chunk[start:start + self.STREAM_CHUNK_SIZE])
+                        await self._send(StreamChunkMessage(uid=self._uid,
+                                                            des_uid=des_uid,
+                                                            stream_id=stream_id,
+                                                            data=base64.b64encode(data).decode()))
+            except Exception:
+                # reading the chunks failed, the receiver throws away what it got
+                await self._send(StreamEndMessage(uid=self._uid,
+                                                  des_uid=des_uid,
+                                                  stream_id=stream_id,
+                                                  error=StreamErrorsEnum.ABORTED))
+                raise
+
+            if not answer.done():
+                hmac = sealed.hexdigest()
+                await self._send(StreamEndMessage(uid=self._uid,
+                                                  des_uid=des_uid,
+                                                  stream_id=stream_id,
+                                                  hmac=hmac,
+                                                  signature=self._suite.sign(private_key=self._private_key, hmac=hmac)))
+            error = await asyncio.wait_for(asyncio.shield(answer), self._timeout)
+        finally:
+            self._outgoing_streams.pop(stream_id, None)
+        if error:
+            raise ConnectionError(f"The stream to {des_uid} wasn't delivered: {error}")
+        return stream_id
+
+    async def send_file(self, des_uid: str, path: str, name: Optional[str] = None) -> str:
+        """Send the file to des_uid as a stream, it's read a chunk at a time."""
+        with open(path, "rb") as file:
+            return await self.send_stream(des_uid=des_uid,
+                                          chunks=iter(lambda: file.read(self.STREAM_CHUNK_SIZE), b""),
+                                          name=os.path.basename(path) if name is None else name,
+                                          size=os.fstat(file.fileno()).st_size)
+
+    async def create_group(self, group_id: str, members: list[str]):
+        """Create the group or replace its members, returns once the server accepted it."""
+        future = self._group_requests.setdefault(AckMessage.group_ack(group_id),
+                                                 asyncio.get_running_loop().create_future())
+        await self._send(GroupMessage(uid=self._uid, group_id=group_id, members=members))
+        await asyncio.wait_for(asyncio.shield(future), self._timeout)
+
+    async def next_message(self) -> Optional[ReceivedMessage]:
+        """Wait for the next received message, None once the connection is closed."""
+        message = await self._messages.get()
+        if message is None:
+            # let the other readers see the end too
+            self._messages.put_nowait(None)
+        return message
+
+    async def messages(self) -> AsyncIterator[ReceivedMessage]:
+        while True:
+            message = await self.next_message()
+            if message is None:
+                return
+            yield message
+
+    async def next_stream(self) -> Optional[ReceivedStream]:
+        """Wait for the next received stream, None once the connection is closed."""
+        stream = await self._streams.get()
+        if stream is None:
+            self._streams.put_nowait(None)
+        return stream
+
+    async def streams(self) -> AsyncIterator[ReceivedStream]:
+        while True:
+            stream = await self.next_stream()
+            if stream is None:
+                return
+            yield stream
+
+    async def close(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self._receiver is not None:
+            await self._receiver
+
+    async def __aenter__(self) -> 'AsyncChatClient':
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def _send(self, message: CommunicationMessage):
+        if self._writer is None or self._writer.is_closing():
+            raise ConnectionError("The client isn't connected.")
+        self._writer.write(message.encode(codec=self._codec))
+        await self._writer.drain()
+
+    async def _receive_loop(self):
+        try:
+            while True:
+                try:
+                    frame = await read_frame(self._reader)
+                except (asyncio.IncompleteReadError, ConnectionError):
+                    self._logger.warning("Connection closed by the server")
+                    return
+                except FrameTooLargeError as e:
+                    self._logger.error("Invalid frame from the server: %s", e)
+                    self._writer.close()
+                    return
+                try:
+                    message = decode_message(frame)
+                except MessageDecodeError as e:
+                    self._logger.error("Invalid message from the server: %s", e)
+                    self._writer.close()
+                    return
+
+                try:
+                    await self._handle_message(message)
+                except Exception as e:
+                    # one message that can't be handled doesn't end the connection, the next ones are handled
+                    self._logger.error("Unable to handle %s: %s", type(message).__name__, e, exc_info=True)
+                    self._fail_handshake(e)
+        finally:
+            self._close_requests()
+            self._messages.put_nowait(None)
+            # the streams that didn't end never will
+            for incoming_stream in self._incoming_streams.values():
+                incoming_stream.file.close()
+            self._incoming_streams.clear()
+            self._streams.put_nowait(None)
+
+    def _fail_handshake(self, error: Exception):
+        """A registration or a resumption in progress won't get its answer after one of its messages failed."""
+        for future in (self._registration, self._resumption):
+            if future is not None and not future.done():
+                future.set_exception(error)
+        if self._status != ChatClientStatusEnum.COMPLETED_REGISTRATION:
+            self._status = ChatClientStatusEnum.REGISTRATION
+
+    def _close_requests(self):
+        """Fail whatever still waits for the server."""
+        waiting = [self._registration, self._resumption, *self._peer_key_requests.values(),
+                   *self._group_requests.values(), *self._outgoing_streams.values()]
+        for future in waiting:
+            if future is not None and not future.done():
+                future.set_exception(ConnectionError("The connection to the server is closed."))
+
+    async def _handle_message(self, message: CommunicationMessage):
+        if isinstance(message, OptMessage):
+            await self._handle_opt_msg(opt_message=message)
+
+        if isinstance(message, KeyMessage):
+            await self._handle_key_msg(key_message=message)
+
+        if isinstance(message, ContentMessage):
+            self._handle_content_msg(content_message=message)
+
+        if isinstance(message, PeerKeyMessage):
+            self._handle_peer_key_msg(peer_key_message=message)
+
+        if isinstance(message, SessionKeyMessage):
+            self._handle_session_key_msg(session_key_message=message)
+
+        if isinstance(message, GroupContentMessage):
+            self._handle_group_content_msg(group_content_message=message)
+
+        if isinstance(message, TicketMessage):
+            self._handle_ticket_msg(ticket_message=message)
+
+        if isinstance(message, StreamStartMessage):
+            self._handle_stream_start_msg(stream_start_message=message)
+
+        if isinstance(message, StreamChunkMessage):
+            self._handle_stream_chunk_msg(stream_chunk_message=message)
+
+        if isinstance(message, StreamEndMessage):
+            self._handle_stream_end_msg(stream_end_message=message)
+
+        if isinstance(message, HeartbeatMessage) and not message.pong:
+            # the server checks that the connection is alive
+            await self._send(HeartbeatMessage(uid=self._uid, pong=True))
+
+        if isinstance(message, AckMessage):
+            # the server acknowledges the registration and the group updates, each in its own namespace
+            registering = self._registration is not None and not self._registration.done()
+            if message.ack == AckMessage.key_ack(self._uid) and registering:
+                if message.error:
+                    self._status = ChatClientStatusEnum.REGISTRATION
+                    self._registration.set_exception(
+                        PermissionError(f"The server refused the registration of {self._uid}: {message.error}"))
+                else:
+                    # registered only once the server took the keys
+                    self._status = ChatClientStatusEnum.COMPLETED_REGISTRATION
+                    self._registration.set_result(None)
+                return
+            future = self._group_requests.pop(message.ack, None)
+            if future is not None and not future.done():
+                future.set_result(None)
+
+    def _handle_ticket_msg(self, ticket_message: TicketMessage):
+        """The server's ticket after the registration or a resumption, an empty one rejects the resumption."""
+        if ticket_message.ticket:
+            self._ticket = ticket_message.ticket
+        if self._resumption is not None and not self._resumption.done():
+            self._resumption.set_result(bool(ticket_message.ticket))
+
+    def _restore_session(self, session: dict):
+        self._suite = get_suite(session["suite"])
+        self._private_key = self._suite.import_key(session["private_key"])
+        self._public_key = self._private_key.public_key()
+        self._aes_key = EncryptorAESKey(session["aes_key"])
+        self._server_public_key = self._suite.import_key(session["server_public_key"])
+        if session["agreement_private_key"]:
+            self._agreement_private_key = EncryptorECCKey(session["agreement_private_key"])
+        self._codec = get_codec(session["codec"])
+        self._compression = get_compression(session["compression"])
+        self._ticket = session["ticket"]
+        self._status = ChatClientStatusEnum.COMPLETED_REGISTRATION
+
+    async def _handle_opt_msg(self, opt_message: OptMessage):
+        """Handle an OPT message that received from the server."""
+        self._logger.info("received from server OPT = %s", opt_message.opt)
+        # check first that we actually waiting for opt, if not write an error
+        if self._status not in (ChatClientStatusEnum.WAIT_FOR_OPT, ChatClientStatusEnum.WAIT_FOR_SERVER_PUBLIC_KEY):
+            self._logger.error("The Client not waiting for OPT!")
+            return
+
+        client_opt = self._opt_handler(opt_message.opt)
+        if inspect.isawaitable(client_opt):
+            client_opt = await client_opt
+
+        # change the status
+        self._status = ChatClientStatusEnum.WAIT_FOR_SERVER_PUBLIC_KEY
+
+        # resend opt message to server as approve that this client.
+        await self._send(OptMessage(uid=opt_message.uid, opt=client_opt))
+
+    async def _handle_key_msg(self, key_message: KeyMessage):
+        """Handle key message that received from the server."""
+        self._logger.info("Received key message.")
+        # check we waiting for server's public key
+        if self._status != ChatClientStatusEnum.WAIT_FOR_SERVER_PUBLIC_KEY:
+            self._logger.error("Client not waiting for server's public key")
+            return
+
+        # save server's public key and the codec it expects
+        self._codec = get_codec(key_message.codec)
+        self._compression = get_compression(key_message.compression)
+        self._suite = get_suite(key_message.suite)
+        self._server_public_key = self._suite.import_key(key_message.encrypted_key)
+
+        if self._suite.USES_KEY_AGREEMENT:
+            # the AES key is derived from the key agreement, the server gets our part of it
+            self._agreement_private_key, agreement_public_key = self._suite.create_agreement_keys()
+            self._aes_key = self._suite.derive_aes_key(private_key=self._agreement_private_key,
+                                                       peer_public_key=EncryptorECCKey(key_message.agreement_key))
+            message_to_send = KeyMessage(uid=key_message.uid,
+                                         encrypted_key=agreement_public_key.str(),
+                                         suite=self._suite.NAME)
+        else:
+            # send to a server the encrypted AES key, for feature communication
+            encrypted_key = EncryptorRSA().encrypt(key=self._server_public_key, content=self._aes_key.str())
+            message_to_send = KeyMessage(uid=key_message.uid, encrypted_key=encrypted_key, suite=self._suite.NAME)
+
+        self._status = ChatClientStatusEnum.WAIT_FOR_KEY_ACK
+        await self._send(message_to_send)
+
+    def _handle_content_msg(self, content_message: ContentMessage):
+        """Handle content message that received from the server."""
+        self._logger.info("Received content message.")
+        # check registration completed
+        if self._status != ChatClientStatusEnum.COMPLETED_REGISTRATION:
+            self._logger.error("The registration not completed for this Client.")
+            return
+
+        # an e2e message is encrypted with the session key of the sender and signed by the sender itself
+        if content_message.e2e:
+            aes_key = self._incoming_session_keys.get(content_message.uid)
+            peer_keys = self._peer_keys.get(content_message.uid)
+            if aes_key is None or peer_keys is None:
+                self._logger.error("No session key from %s.", content_message.uid)
+                return
+            suite, signer_public_key, _, _ = peer_keys
+        else:
+            aes_key = self._aes_key
+            suite, signer_public_key = self._suite, self._server_public_key
+
+        # compare hmac
+        if not Tools.verify_hmac(key=aes_key, content=content_message.content.encode(), hmac=content_message.hmac):
+            self._logger.warning("The HMAC not identical")
+            return
+
+        # check signature
+        try:
+            suite.verify(public_key=signer_public_key, signature=content_message.signature, hmac=content_message.hmac)
+            self._logger.info("Signature is valid.")
+        except (ValueError, TypeError):
+            self._logger.error("Signature is invalid.")
+            return
+
+        # decrypt the message with client's aes key
+        decrypted_content = self._open_content(aes_key=aes_key,
+                                               content=content_message.content,
+                                               compression=content_message.compression)
+        if decrypted_content is not None:
+            self._messages.put_nowait(ReceivedMessage(uid=content_message.uid,
+                                                      des_uid=content_message.des_uid,
+                                                      content=decrypted_content,
+                                                      e2e=content_message.e2e))
+
+    def _handle_group_content_msg(self, group_content_message: GroupContentMessage):
+        """Handle a group message, the server signed its content once for all the members."""
+        self._logger.info("Received group message.")
+        if self._status != ChatClientStatusEnum.COMPLETED_REGISTRATION:
+            self._logger.error("The registration not completed for this Client.")
+            return
+
+        if not Tools.verify_hmac(key=self._aes_key,
+                                 content=group_content_message.content.encode(),
+                                 hmac=group_content_message.hmac):
+            self._logger.warning("The HMAC not identical")
+            return
+
+        decrypted_content = self._open_content(aes_key=self._aes_key,
+                                               content=group_content_message.content,
+                                               compression=group_content_message.compression)
+        if decrypted_content is None:
+            return
+
+        try:
+            self._suite.verify(public_key=self._server_public_key,
+                               signature=group_content_message.signature,
+                               hmac=Tools.group_fingerprint(uid=group_content_message.uid,
+                                                            group_id=group_content_message.group_id,
+                                                            content=decrypted_content))
+            self._logger.info("Signature is valid.")
+        except (ValueError, TypeError):
+            self._logger.error("Signature is invalid.")
+            return
+
+        self._messages.put_nowait(ReceivedMessage(uid=group_content_message.uid,
+                                                  des_uid=group_content_message.des_uid,
+                                                  content=decrypted_content,
+                                                  group_id=group_content_message.group_id))
+
+    def _handle_stream_start_msg(self, stream_start_message: StreamStartMessage):
+        """Start receiving a stream into a file of the stream sink."""
+        self._logger.info("Received stream %s from %s.", stream_start_message.stream_id, stream_start_message.uid)
+        if self._status != ChatClientStatusEnum.COMPLETED_REGISTRATION:
+            self._logger.error("The registration not completed for this Client.")
+            return
+
+        # like a content message, an e2e stream is encrypted with the session key of the sender
+        aes_key = self._aes_key
+        if stream_start_message.e2e:
+            aes_key = self._incoming_session_keys.get(stream_start_message.uid)
+            if aes_key is None or self._peer_keys.get(stream_start_message.uid) is None:
+                self._logger.error("No session key from %s.", stream_start_message.uid)
+                return
+
+        try:
+            opened = EncryptorAESStream(key=aes_key,
+                                        nonce=base64.b64decode(stream_start_message.nonce),
+                                        associated_data=Tools.stream_fingerprint(stream_start_message.uid,
+                                                                                 stream_start_message.des_uid,
+                                                                                 stream_start_message.stream_id))
+            file = self._stream_sink(stream_start_message.uid, stream_start_message.name, stream_start_message.size)
+        except (ValueError, OSError) as e:
+            self._logger.error("Can't receive stream %s: %s", stream_start_message.stream_id, e)
+            return
+        self._incoming_streams[(stream_start_message.uid, stream_start_message.stream_id)] = _IncomingStream(
+            start_message=stream_start_message, opened=opened, file=file)
+
+    def _handle_stream_chunk_msg(self, stream_chunk_message: StreamChunkMessage):
+        incoming_stream = self._incoming_streams.get((stream_chunk_message.uid, stream_chunk_message.stream_id))
+        if incoming_stream is None:
+            self._logger.warning("Chunk of an unknown stream %s", stream_chunk_message.stream_id)
+            return
+        try:
+            incoming_stream.file.write(incoming_stream.opened.decrypt(base64.b64decode(stream_chunk_message.data)))
+        except OSError as e:
+            self._logger.error("Can't write stream %s: %s", stream_chunk_message.stream_id, e)
+            incoming_stream.file.close()
+            del self._incoming_streams[(stream_chunk_message.uid, stream_chunk_message.stream_id)]
+
+    def _handle_stream_end_msg(self, stream_end_message: StreamEndMessage):
+        """Check the stream that ended and queue it, or resolve the server's answer to a stream we sent."""
+        incoming_stream = self._incoming_streams.pop((stream_end_message.uid, stream_end_message.stream_id), None)
+        if incoming_stream is None:
+            future = self._outgoing_streams.get(stream_end_message.stream_id)
+            if stream_end_message.uid == self._uid and future is not None and not future.done():
+                future.set_result(stream_end_message.error)
+            return
+
+        error = stream_end_message.error or self._verify_stream(incoming_stream=incoming_stream,
+                                                                stream_end_message=stream_end_message)
+        if error:
+            self._logger.error("Stream %s from %s failed: %s", stream_end_message.stream_id, stream_end_message.uid,
+                               error)
+            incoming_stream.file.close()
+        else:
+            incoming_stream.file.flush()
+            if incoming_stream.file.seekable():
+                incoming_stream.file.seek(0)
+
+        start_message = incoming_stream.start_message
+        self._streams.put_nowait(ReceivedStream(uid=start_message.uid,
+                                                des_uid=start_message.des_uid,
+                                                stream_id=start_message.stream_id,
+                                                name=start_message.name,
+                                                size=start_message.size,
+                                                file=incoming_stream.file,
+                                                e2e=start_message.e2e,
+                                                error=error))
+
+    def _verify_stream(self, incoming_stream: _IncomingStream, stream_end_message: StreamEndMessage) -> str:
+        """Compare the HMAC of the received chunks and check the signature, the error if they're invalid."""
+        if not incoming_stream.opened.verify(stream_end_message.hmac):
+            self._logger.warning("The HMAC not identical")
+            return StreamErrorsEnum.INVALID
+
+        # an e2e stream is signed by the sender, a relayed one by the server
+        suite, signer_public_key = self._suite, self._server_public_key
+        if incoming_stream.start_message.e2e:
+            suite, signer_public_key, _, _ = self._peer_keys[stream_end_message.uid]
+        try:
+            suite.verify(public_key=signer_public_key, signature=stream_end_message.signature,
+                         hmac=stream_end_message.hmac)
+        except (ValueError, TypeError):
+            self._logger.error("Signature is invalid.")
+            return StreamErrorsEnum.INVALID
+        return ""
+
+    def _handle_peer_key_msg(self, peer_key_message: PeerKeyMessage):
+        """Keep the keys of another client, after checking the server signed them."""
+        self._logger.info("Received the keys of %s.", peer_key_message.peer_uid)
+        peer_keys = None
+        if peer_key_message.signature:
+            try:
+                self._suite.verify(public_key=self._server_public_key,
+                                   signature=peer_key_message.signature,
+                                   hmac=Tools.fingerprint(peer_key_message.peer_uid,
+                                                          peer_key_message.suite,
+                                                          peer_key_message.public_key,
+                                                          peer_key_message.agreement_key,
+                                                          peer_key_message.compression))
+                suite = get_suite(peer_key_message.suite)
+                agreement_key = EncryptorECCKey(peer_key_message.agreement_key) if suite.USES_KEY_AGREEMENT else None
+                peer_keys = (suite,
+                             suite.import_key(peer_key_message.public_key),
+                             agreement_key,
+                             get_compression(peer_key_message.compression))
+            except (ValueError, TypeError):
+                self._logger.error("Signature of the peer's keys is invalid.")
+                return
+
+        # keys that changed belong to a new registration, the session keys of the old one are useless
+        if self._peer_keys.get(peer_key_message.peer_uid) is not None and \
+                self._peer_keys[peer_key_message.peer_uid][1].str() != peer_key_message.public_key:
+            self._outgoing_session_keys.pop(peer_key_message.peer_uid, None)
+            self._incoming_session_keys.pop(peer_key_message.peer_uid, None)
+        self._peer_keys[peer_key_message.peer_uid] = peer_keys
+
+        future = self._peer_key_requests.pop(peer_key_message.peer_uid, None)
+        if future is not None and not future.done():
+            future.set_result(peer_keys)
+
+    def _handle_session_key_msg(self, session_key_message: SessionKeyMessage):
+        """Open the session key that another client sent us for its messages."""
+        self._logger.info("Received a session key from %s.", session_key_message.uid)
+        peer_keys = self._peer_keys.get(session_key_message.uid)
+        if peer_keys is None:
+            self._logger.error("Unknown keys of %s.", session_key_message.uid)
+            return
+        suite, peer_public_key, _, _ = peer_keys
+
+        try:
+            suite.verify(public_key=peer_public_key,
+                         signature=session_key_message.signature,
+                         hmac=Tools.fingerprint(session_key_message.uid,
+                                                session_key_message.des_uid,
+                                                session_key_message.wrapped_key))
+        except (ValueError, TypeError):
+            self._logger.error("Signature of the session key is invalid.")
+            return
+
+        # the key is wrapped for our suite, the one the server negotiated with us
+        self._incoming_session_keys[session_key_message.uid] = self._suite.unwrap_session_key(
+            private_key=self._private_key,
+            agreement_private_key=self._agreement_private_key,
+            wrapped_key=session_key_message.wrapped_key)
+
+    async def _get_outgoing_session_key(self, des_uid: str) -> EncryptorAESKey:
+        """Return the session key of our messages to des_uid, set it up with des_uid if there is none yet."""
+        async with self._session_key_lock:
+            session_key = self._outgoing_session_keys.get(des_uid)
+            if session_key is not None:
+                return session_key
+
+            # get the keys of des_uid from the server
+            if des_uid not in self._peer_keys:
+                future = self._peer_key_requests.setdefault(des_uid, asyncio.get_running_loop().create_future())
+                await self._send(PublicKeyRequestMessage(uid=self._uid, peer_uid=des_uid))
+                await asyncio.wait_for(asyncio.shield(future), self._timeout)
+
+            peer_keys = self._peer_keys.get(des_uid)
+            if peer_keys is None:
+                raise LookupError(f"The user {des_uid} isn't registered.")
+            suite, peer_public_key, peer_agreement_key, _ = peer_keys
+
+            # a new key wrapped for the suite of des_uid, signed by us so des_uid knows who sent it
+            session_key, wrapped_key = suite.wrap_session_key(peer_public_key=peer_public_key,
+                                                              peer_agreement_key=peer_agreement_key)
+            signature = self._suite.sign(private_key=self._private_key,
+                                         hmac=Tools.fingerprint(self._uid, des_uid, wrapped_key))
+            await self._send(SessionKeyMessage(uid=self._uid,
+                                               des_uid=des_uid,
+                                               wrapped_key=wrapped_key,
+                                               signature=signature))
+            self._outgoing_session_keys[des_uid] = session_key
+            return session_key
+
+    def _seal_content(self, content: str, aes_key: EncryptorAESKey, compression: Compression) -> (str, str, str, str):
+        """Compress, encrypt, authenticate and sign the content, return the content, hmac, signature and the
+        compression flag of the message."""
+        data, compression_flag = compress(content.encode(), compression)
+        encrypted_content = EncryptorAES().encrypt_bytes(key=aes_key, data=data)
+
+        # create hmac
+        hmac = Tools.generate_hmac(key=aes_key, content=encrypted_content.encode())
+
+        # create signature
+        signature = self._suite.sign(private_key=self._private_key, hmac=hmac)
+        return encrypted_content, hmac, signature, compression_flag
+
+    def _open_content(self, aes_key: EncryptorAESKey, content: str, compression: str) -> Optional[str]:
+        """Decrypt and decompress the content, None if it's invalid."""
+        decrypted_data = EncryptorAES().decrypt_bytes(key=aes_key, content=content)
+        try:
+            return decompress(decrypted_data, flag=compression).decode()
+        except ValueError as e:
+            self._logger.error("Invalid content: %s", e)
+            return None
+
+
+async def _iterate(chunks: Union[Iterable[bytes], AsyncIterable[bytes]]) -> AsyncIterator[bytes]:
+    if hasattr(chunks, "__aiter__"):
+        async for chunk in chunks:
+            yield chunk
+    else:
+        for chunk in chunks:
+            yield chunk
+
+
+class ChatClient:
+    """Thread-safe wrapper of AsyncChatClient for code that doesn't run an event loop.
+
+    The session runs on an event loop in a background thread, every method can be called from any thread
+    (but not from the loop's own thread) and returns a concurrent.futures.Future of the async call. Many
+    clients can share one loop by passing it in, otherwise every client starts its own.
+    A blocking opt_handler (e.g. input()) runs on the loop's default executor so the loop keeps running.
+    """
+
+    def __init__(self,
+                 uid: str,
+                 loop: Optional[asyncio.AbstractEventLoop] = None,
+                 opt_handler: Optional[Callable[[str], str]] = None,
+                 **kwargs):
+        self._own_loop = loop is None
+        if loop is None:
+            loop = asyncio.new_event_loop()
+            loop_thread = threading.Thread(target=loop.run_forever, name=f"chat-client-{uid}")
+            loop_thread.daemon = True
+            loop_thread.start()
+        self._loop = loop
+
+        async_opt_handler = None
+        if opt_handler is not None:
+            async_opt_handler = lambda opt: self._loop.run_in_executor(None, opt_handler, opt)
+        self._client = AsyncChatClient(uid=uid, opt_handler=async_opt_handler, **kwargs)
+
+    @property
+    def uid(self) -> str:
+        return self._client.uid
+
+    @property
+    def is_registered(self) -> bool:
+        return self._client.is_registered
+
+    @property
+    def session(self) -> Optional[dict]:
+        return self._client.session
+
+    def register(self) -> Future:
+        return self._submit(self._client.register())
+
+    def resume(self) -> Future:
+        """A future of True if the session was resumed, False if the client has to register."""
+        return self._submit(self._client.resume())
+
+    def send(self, des_uid: str, content: str) -> Future:
+        return self._submit(self._client.send(des_uid=des_uid, content=content))
+
+    def send_to_group(self, group_id: str, content: str) -> Future:
+        return self._submit(self._client.send_to_group(group_id=group_id, content=content))
+
+    def send_stream(self,
+                    des_uid: str,
+                    chunks: Iterable[bytes],
+                    name: str = "",
+                    size: Optional[int] = None) -> Future:
+        """A future of the stream id once des_uid got the stream, the chunks are read on the client's loop."""
+        return self._submit(self._client.send_stream(des_uid=des_uid, chunks=chunks, name=name, size=size))
+
+    def send_file(self, des_uid: str, path: str, name: Optional[str] = None) -> Future:
+        return self._submit(self._client.send_file(des_uid=des_uid, path=path, name=name))
+
+    def create_group(self, group_id: str, members: list[str]) -> Future:
+        return self._submit(self._client.create_group(group_id=group_id, members=members))
+
+    def next_message(self) -> Future:
+        """A future of the next received message, None once the connection is closed."""
+        return self._submit(self._client.next_message())
+
+    def messages(self, timeout: Optional[float] = None) -> Iterator[ReceivedMessage]:
+        """Iterate the received messages until the connection is closed."""
+        while True:
+            message = self.next_message().result(timeout)
+            if message is None:
+                return
+            yield message
+
+    def next_stream(self) -> Future:
+        """A future of the next received stream, None once the connection is closed."""
+        return self._submit(self._client.next_stream())
+
+    def streams(self, timeout: Optional[float] = None) -> Iterator[ReceivedStream]:
+        """Iterate the received streams until the connection is closed."""
+        while True:
+            stream = self.next_stream().result(timeout)
+            if stream is None:
+                return
+            yield stream
+
+    def close(self):
+        self._submit(self._client.close()).result()
+        if self._own_loop:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+
+    def __enter__(self) -> 'ChatClient':
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _submit(self, coroutine) -> Future:
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop)
@@ -11,3 +11,13 @@ class ClientOutputsEnum(str, Enum):
     CAN_SEND_MESSAGE_WRITE_TO = "To send a message write to and press 'Enter':"
     CAN_SEND_MESSAGE_WRITE_CONTENT = "write content of the message and press 'Enter':"
     RECEIVED_OPT = "You received opt: {}, please resend it to server:"
+    PEER_NOT_FOUND = "The user {} isn't registered, the message wasn't sent."
+    GROUPS_HELP = "Write to 'group <group id> <member> ...' to create a group, and to '#<group id>' to write to it."
+    GROUP_UPDATED = "The group {} is ready."
+    FILES_HELP = "Write to 'file <uid> <path>' to send a file, the files you receive are saved in {}."
+    FILE_SENT = "The file {} was sent."
+    FILE_RECEIVED = "Received the file {} from {}, saved as {}."
+    FILE_FAILED = "The file {} from {} wasn't received: {}"
+    REGISTRATION_FAILED = "The registration failed: {}"
+    SEND_FAILED = "The message wasn't sent: {}"
+    CONNECTION_CLOSED = "The connection to the server is closed."
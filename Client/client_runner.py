@@ -1,150 +1,65 @@
-import json
-import logging
-import socket
+import argparse
+import os
 import threading
-from enum import Enum
+from concurrent.futures import TimeoutError as FutureTimeoutError
 
 from typing import Optional
 
+from Client.chat_client import ChatClient, ReceivedMessage, ReceivedStream, DEFAULT_SUITES
 from Client.client_info import ClientInfo
 from Client.client_outputs import ClientOutputsEnum
-from Communication.Messages.messages import ClientRegistrationMessage, OptMessage, KeyMessage, ContentMessage, \
-    CommunicationMessageTypesEnum
-from Communication.communication_service import CommunicationService
-from Tools.encryptors import EncryptorRSA, EncryptorAES, EncryptorAESKey, EncryptorRSAKey
-from Tools.tools import Tools
-from Utils.internal_logger import InternalLogger
-
-
-class ClientRunnerStatusEnum(str, Enum):
-    REGISTRATION = "registration"
-    WAIT_FOR_OPT = "wait_for_opt"
-    WAIT_FOR_SERVER_PUBLIC_KEY = "wait_for_server_public_key"
-    COMPLETED_REGISTRATION = "completed_registration"
-
-
-class ClientRunner(CommunicationService):
-    """This class responsible to activate a new client, and run this client."""
-
-    def __init__(self):
-        """Constructor."""
-        self._logger: InternalLogger = InternalLogger(logging_level=logging.DEBUG)
+from Communication.Messages.message_codecs import MessageCodecsEnum
+from Tools.compression import CompressionsEnum
+from Tools.crypto_suites import CRYPTO_SUITES, CryptoSuitesEnum
+from Tools.key_pool import get_key_pool
+
+
+class ClientRunner:
+    """This class responsible to activate a new client, and run this client on the console."""
+
+    def __init__(self,
+                 suites: Optional[list[CryptoSuitesEnum]] = None,
+                 codecs: Optional[list[MessageCodecsEnum]] = None,
+                 compressions: Optional[list[CompressionsEnum]] = None,
+                 end_to_end: bool = False,
+                 host: str = 'localhost',
+                 port: int = 12345,
+                 downloads_dir: str = "downloads"):
+        """Constructor.
+
+        With end_to_end the messages are encrypted with a session key of the two clients, the server only
+        forwards them and can't read them. Received files are saved in downloads_dir.
+        """
         self.client_info: Optional[ClientInfo] = None
-        self._aes_key: Optional[EncryptorAESKey] = None
-        self._rsa_private_key: Optional[EncryptorRSAKey] = None
-        self._rsa_public_key: Optional[EncryptorRSAKey] = None
-        self._server_public_key: Optional[EncryptorRSAKey] = None
-        self._uid: str = ""
-        self._status: ClientRunnerStatusEnum = ClientRunnerStatusEnum.REGISTRATION
+        self._downloads_dir = downloads_dir
+        self._client_options = dict(suites=suites,
+                                    codecs=codecs,
+                                    compressions=compressions,
+                                    end_to_end=end_to_end,
+                                    host=host,
+                                    port=port,
+                                    stream_sink=self.open_download)
+        self._client: Optional[ChatClient] = None
+        # the keys are created while the user types the name and the phone number
+        get_key_pool(CRYPTO_SUITES[(suites or DEFAULT_SUITES)[0]]).start()
 
         # we use this attributes, in case we receive message, and message on console removed by incoming message
         self._waiting_uid_des_input: bool = False
         self._waiting_content_input: bool = False
 
-    def handle_msg_receiving(self, n_socket, address):
-        """Handle receiving message from the server."""
-        self._logger.info("Client handle message")
-        while True:  # Continuous loop to keep receiving messages
-            try:
-                raw_data = n_socket.recv(1024)
-            except OSError as e:
-                self._logger.error(f"Socket error with client {address}: {e}")
-                break
-            if not raw_data:
-                self._logger.warning("Connection closed by the server")
-            else:
-                message = json.loads(raw_data)
-                message_type = message.get("type")
-                data = message.get("data")
-
-                if message_type == CommunicationMessageTypesEnum.OPT_MESSAGE:
-                    opt_message = OptMessage(**data)
-                    self.handle_opt_msg_receiving(opt_message=opt_message, n_socket=n_socket)
-
-                if message_type == CommunicationMessageTypesEnum.KEY_MESSAGE:
-                    key_message = KeyMessage(**data)
-                    self.handle_key_msg_receiving(key_message=key_message, n_socket=n_socket)
-
-                if message_type == CommunicationMessageTypesEnum.CONTENT_MESSAGE:
-                    content_message = ContentMessage(**data)
-                    self.handle_content_msg(content_message=content_message)
-
-    def handle_opt_msg_receiving(self, opt_message: OptMessage, n_socket: socket):
-        """Handle an OPT message that received from the server."""
-        self._logger.info(f"received from server OPT = {opt_message.opt}")
-        # check first that we actually waiting for opt, if not write an error
-        if (self._status != ClientRunnerStatusEnum.WAIT_FOR_OPT and
-                self._status != ClientRunnerStatusEnum.WAIT_FOR_SERVER_PUBLIC_KEY):
-            self._logger.error("The Client not waiting for OPT!")
-            return
-
-        # prompt to the Client that received opt and need to resend it to the server
-        client_opt = input(ClientOutputsEnum.RECEIVED_OPT.value.format(opt_message.opt))
-        respond_opt_message = OptMessage(uid=opt_message.uid, opt=client_opt)
-
-        # change the status
-        self._status = ClientRunnerStatusEnum.WAIT_FOR_SERVER_PUBLIC_KEY
-
-        # resend opt message to server as approve that this client.
-        self.send_msg(n_socket, respond_opt_message.encode())
-
-    def handle_key_msg_receiving(self, key_message: KeyMessage, n_socket: socket):
-        """Handle key message that received from the server."""
-        self._logger.info("Received key message.")
-        # check we waiting for server's public key
-        if self._status != ClientRunnerStatusEnum.WAIT_FOR_SERVER_PUBLIC_KEY:
-            self._logger.error("Client not waiting for server's public key")
-            return
-
-        # save server's public key
-        self._server_public_key = EncryptorRSAKey(key_message.encrypted_key)
-
-        # send to a server the encrypted AES key, for feature communication
-        encryptor_rsa = EncryptorRSA()
-        encrypted_key = encryptor_rsa.encrypt(key=self._server_public_key,
-                                              content=self._aes_key.str())
-
-        # message with the client's encrypted AES key
-        message_to_send = KeyMessage(uid=key_message.uid, encrypted_key=encrypted_key)
-
-        self._status = ClientRunnerStatusEnum.COMPLETED_REGISTRATION
-        self.send_msg(sock=n_socket, content=message_to_send.encode())
-
-    def handle_content_msg(self, content_message: ContentMessage):
-        """Handle content message that received from the server."""
-        self._logger.info("Received content message.")
-        # check registration completed
-        if self._status != ClientRunnerStatusEnum.COMPLETED_REGISTRATION:
-            self._logger.error("The registration not completed for this Client.")
-            return
-
-        # compare hmac
-        if not Tools.verify_hmac(key=self._aes_key,
-                                 content=content_message.content.encode(),
-                                 hmac=content_message.hmac):
-            self._logger.warning("The HMAC not identical")
-            return
-
-        # check signature
-        try:
-            Tools.varify_signature(rsa_public_key=self._server_public_key,
-                                   signature=content_message.signature,
-                                   hmac=content_message.hmac)
-            self._logger.info("Signature is valid.")
-        except (ValueError, TypeError):
-            self._logger.error("Signature is invalid.")
-            return
-
-
-        # decrypt the message with client's aes key
-        encryptor_aes = EncryptorAES()
-        dycrypted_content = encryptor_aes.decrypt(key=self._aes_key, content=content_message.content)
+    def print_messages(self):
+        """Print the received messages until the connection is closed."""
+        for message in self._client.messages():
+            self.print_message(message)
+        print(ClientOutputsEnum.CONNECTION_CLOSED.value)
 
+    def print_message(self, message: ReceivedMessage):
+        to_line = f"== Group   : {message.group_id}" if message.group_id else f"== To      : {message.des_uid}"
         print(f"""
         ====== Received Message ====
-        == From    : {content_message.uid}
-        == To      : {content_message.des_uid}
-        == Content : {dycrypted_content}
+        == From    : {message.uid}
+        {to_line}
+        == Content : {message.content}
         =========== End ============
         """)
 
@@ -153,60 +68,43 @@ class ClientRunner(CommunicationService):
         if self._waiting_content_input:
             print(ClientOutputsEnum.CAN_SEND_MESSAGE_WRITE_CONTENT.value)
 
-    def send_by_secure_channel(self,sock:socket,content):
-        self._logger.info("Sending message by secured channel.")
-        self.send_msg(sock=sock,content=content)
+    def open_download(self, uid: str, name: str, size: Optional[int]):
+        """The file that a received file is written to, named after its sender and its name."""
+        os.makedirs(self._downloads_dir, exist_ok=True)
+        return open(os.path.join(self._downloads_dir, f"{uid}_{os.path.basename(name) or 'file'}"), "w+b")
 
-    def send_msg(self, sock: socket, content):
-        try:
-            # Send data
-            sock.sendall(content)
-        except BrokenPipeError:
-            self._logger.error("Connection broken. Unable to send data.")
-        except ConnectionResetError:
-            self._logger.error("Connection reset by peer.")
-        except socket.timeout:
-            self._logger.error("Send operation timed out.")
-        except OSError as e:
-            self._logger.error(f"OS error occurred: {e}")
-        except ValueError as e:
-            self._logger.error(f"Value error: {e}")
-
-    def connect_to_server(self, host: str, port: int, sock: socket):
-        try:
-            sock.connect((host, port))
-        except ConnectionRefusedError:
-            self._logger.error("Connection refused. Is the server running?")
-        except TimeoutError:
-            self._logger.error("Connection timed out. Server may be unreachable.")
-        except socket.gaierror as e:
-            self._logger.error(f"Address-related error connecting to server: {e}")
-        except OSError as e:
-            self._logger.error(f"General OS error: {e}")
-
-    def start_registration(self, sock: socket):
+    def print_streams(self):
+        """Print the received files until the connection is closed."""
+        for stream in self._client.streams():
+            self.print_stream(stream)
 
+    def print_stream(self, stream: ReceivedStream):
+        if stream.error:
+            print(ClientOutputsEnum.FILE_FAILED.value.format(stream.name, stream.uid, stream.error))
+            os.remove(stream.file.name)
+            return
+        stream.file.close()
+        print(ClientOutputsEnum.FILE_RECEIVED.value.format(stream.name, stream.uid, stream.file.name))
+
+    def ask_opt(self, opt: str) -> str:
+        # prompt to the Client that received opt and need to resend it to the server
+        return input(ClientOutputsEnum.RECEIVED_OPT.value.format(opt))
+
+    def start_registration(self) -> bool:
         name = input(ClientOutputsEnum.INSERT_NAME.value)  # todo: check valid input
         uid = input(ClientOutputsEnum.INSERT_UID.value)  # todo: check valid input
-        self._uid = uid
         self.client_info = ClientInfo(uid=uid, name=name)
 
-        self._rsa_private_key, self._rsa_public_key = EncryptorRSAKey.create_keys()
-
-        # set status to wait from OPT from the server
-        self._status = ClientRunnerStatusEnum.WAIT_FOR_OPT
-
-        # send to server Client's public key and uid
-        message = ClientRegistrationMessage(uid=uid, public_key=self._rsa_public_key.str())
-        self.send_msg(sock=sock, content=message.encode())
+        self._client = ChatClient(uid=uid, opt_handler=self.ask_opt, **self._client_options)
+        try:
+            # wait here till the registration completed
+            self._client.register().result()
+        except (OSError, FutureTimeoutError) as e:
+            print(ClientOutputsEnum.REGISTRATION_FAILED.value.format(e))
+            return False
+        return True
 
     def start(self):
-
-        # generate client's keys
-        self._rsa_private_key, self._rsa_public_key = EncryptorRSAKey.create_keys()
-        self._aes_key = EncryptorAESKey.create()
-        self._logger.info(f"created aes key = {self._aes_key.str()}")
-
         # prompt to console
         print(ClientOutputsEnum.WELCOME.value)
 
@@ -222,61 +120,86 @@ class ClientRunner(CommunicationService):
             print(ClientOutputsEnum.EXIT.value)
             return
 
-        # create a socket to Server
-        host = 'localhost'
-        port = 12345
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-
-        # connect to the server
-        self.connect_to_server(host=host, port=port, sock=s)
-
-        # start a thread that will handle message receiving
-        message_thread = threading.Thread(target=self.handle_msg_receiving, args=(s, (host, port)))
-        message_thread.daemon = True # close the thread if the main thread closed.
-        message_thread.start()
-
         # if we reached here, means user want start registration
-        self.start_registration(sock=s)
+        if not self.start_registration():
+            self._client.close()
+            return
 
-        # wait here till the registration not completed
-        while self._status != ClientRunnerStatusEnum.COMPLETED_REGISTRATION:
-            pass
+        # start a thread that will print the received messages
+        message_thread = threading.Thread(target=self.print_messages)
+        message_thread.daemon = True  # close the thread if the main thread closed.
+        message_thread.start()
+        stream_thread = threading.Thread(target=self.print_streams)
+        stream_thread.daemon = True
+        stream_thread.start()
 
         # print to the Client that now able to send message
         print(ClientOutputsEnum.REGISTRATION_COMPLETED.value)
+        print(ClientOutputsEnum.GROUPS_HELP.value)
+        print(ClientOutputsEnum.FILES_HELP.value.format(self._downloads_dir))
         while True:
             self._waiting_uid_des_input = True
             des_uid = input(ClientOutputsEnum.CAN_SEND_MESSAGE_WRITE_TO.value)
             self._waiting_uid_des_input = False
             if des_uid == 'exit':
-                s.close() # close socket
                 break
+
+            # create a group or change its members
+            if des_uid.startswith('group '):
+                group_id, *members = des_uid.split()[1:] or [""]
+                if group_id:
+                    self.wait(self._client.create_group(group_id=group_id, members=members),
+                              done_output=ClientOutputsEnum.GROUP_UPDATED.value.format(group_id))
+                continue
+
+            # send a file, it's read and sent a chunk at a time
+            if des_uid.startswith('file '):
+                _, file_des_uid, path = (des_uid.split(maxsplit=2) + ["", ""])[:3]
+                if file_des_uid and path:
+                    self.wait(self._client.send_file(des_uid=file_des_uid, path=path),
+                              done_output=ClientOutputsEnum.FILE_SENT.value.format(path))
+                continue
+
             self._waiting_content_input = True
             content = input(ClientOutputsEnum.CAN_SEND_MESSAGE_WRITE_CONTENT.value)
             self._waiting_content_input = False
             if content == 'exit':
                 break
 
-            # encrypt the content of the message
-            encryptor_aes = EncryptorAES()
-            encrypted_content = encryptor_aes.encrypt(key=self._aes_key, content=content)
-
-            # create hmac
-            hmac = Tools.generate_hmac(key=self._aes_key, content=encrypted_content.encode())
+            if des_uid.startswith('#'):
+                self.wait(self._client.send_to_group(group_id=des_uid[1:], content=content))
+                continue
 
-            # create signature
-            signature = Tools.create_signature(rsa_private_key=self._rsa_private_key, hmac=hmac)
+            try:
+                self._client.send(des_uid=des_uid, content=content).result()
+            except LookupError:
+                print(ClientOutputsEnum.PEER_NOT_FOUND.value.format(des_uid))
+            except (OSError, FutureTimeoutError) as e:
+                print(ClientOutputsEnum.SEND_FAILED.value.format(e))
 
-            message = ContentMessage(uid=self._uid,
-                                     des_uid=des_uid,
-                                     content=encrypted_content,
-                                     hmac=hmac,
-                                     signature=signature)
-            self.send_msg(sock=s, content=message.encode())
+        print(ClientOutputsEnum.EXIT.value)
+        self._client.close()
 
-        s.close()
+    def wait(self, future, done_output: Optional[str] = None):
+        """Wait for a request to the server and print how it ended."""
+        try:
+            future.result()
+        except (OSError, FutureTimeoutError) as e:
+            print(ClientOutputsEnum.SEND_FAILED.value.format(e))
+            return
+        if done_output:
+            print(done_output)
 
 
 if __name__ == "__main__":
-    client_runner = ClientRunner()
+    parser = argparse.ArgumentParser(description="Run the chat client.")
+    parser.add_argument("--e2e", action="store_true",
+                        help="Encrypt the messages end to end, the server forwards them without reading them.")
+    parser.add_argument("--host", default="localhost", help="The server's host.")
+    parser.add_argument("--port", type=int, default=12345, help="The server's port.")
+    parser.add_argument("--downloads-dir", default="downloads", help="Directory of the files that are received.")
+    args = parser.parse_args()
+
+    client_runner = ClientRunner(end_to_end=args.e2e, host=args.host, port=args.port,
+                                 downloads_dir=args.downloads_dir)
     client_runner.start()
@@ -0,0 +1,261 @@
+import base64
+import json
+import struct
+from abc import ABC, abstractmethod
+from enum import Enum
+from typing import Callable, Optional
+
+from Communication.Messages.messages import CommunicationMessage, ContentMessage, ClientRegistrationMessage, \
+    KeyMessage, OptMessage, AckMessage, PublicKeyRequestMessage, PeerKeyMessage, SessionKeyMessage, GroupMessage, \
+    GroupContentMessage, HeartbeatMessage, ResumeMessage, TicketMessage, StreamStartMessage, StreamChunkMessage, \
+    StreamEndMessage, parse_message
+
+
+# all supported codecs of the messages on the wire.
+class MessageCodecsEnum(str, Enum):
+    JSON = "json"
+    BINARY = "binary_v1"
+
+
+class MessageDecodeError(ValueError):
+    """Raised when a payload isn't a valid message, whichever part of it is malformed."""
+
+
+# what decoding a malformed payload raises before it's turned into a MessageDecodeError
+_DECODE_ERRORS = (ValueError, KeyError, TypeError, AttributeError, struct.error)
+
+
+class MessageCodec(ABC):
+    """Turns a message into the payload of a frame and back."""
+
+    NAME: MessageCodecsEnum
+
+    @abstractmethod
+    def encode(self, message: CommunicationMessage) -> bytes:
+        pass
+
+    @abstractmethod
+    def decode(self, payload: bytes) -> CommunicationMessage:
+        """Raise MessageDecodeError if the payload isn't a valid message of the codec."""
+        pass
+
+
+class JsonCodec(MessageCodec):
+    NAME = MessageCodecsEnum.JSON
+
+    def encode(self, message: CommunicationMessage) -> bytes:
+        return json.dumps(message.to_dict()).encode()
+
+    def decode(self, payload: bytes) -> CommunicationMessage:
+        try:
+            return parse_message(json.loads(payload))
+        except _DECODE_ERRORS as e:
+            raise MessageDecodeError(f"Invalid JSON message: {e}") from e
+
+
+class _FieldKind:
+    """How a field of a message is written as raw bytes."""
+
+    def __init__(self, to_bytes: Callable[[object], bytes], from_bytes: Callable[[bytes], object]):
+        self.to_bytes = to_bytes
+        self.from_bytes = from_bytes
+
+
+_LIST_ITEM = struct.Struct("!H")
+
+def _list_to_bytes(values: list[str]) -> bytes:
+    parts = []
+    for value in values:
+        encoded = value.encode()
+        parts.append(_LIST_ITEM.pack(len(encoded)))
+        parts.append(encoded)
+    return b"".join(parts)
+
+
+def _list_from_bytes(data: bytes) -> list[str]:
+    values = []
+    offset = 0
+    while offset < len(data):
+        (length,) = _LIST_ITEM.unpack_from(data, offset)
+        offset += _LIST_ITEM.size
+        values.append(data[offset:offset + length].decode())
+        offset += length
+    return values
+
+
+TEXT = _FieldKind(lambda value: value.encode(), lambda data: data.decode())
+# base64 text is sent as the raw bytes it represents
+BASE64 = _FieldKind(lambda value: base64.b64decode(value, validate=True),
+                    lambda data: base64.b64encode(data).decode())
+# hex text (the HMAC) is sent as the raw bytes it represents
+HEX = _FieldKind(lambda value: bytes.fromhex(value), lambda data: data.hex())
+TEXT_LIST = _FieldKind(_list_to_bytes, _list_from_bytes)
+BOOL = _FieldKind(lambda value: b"\x01" if value else b"", lambda data: data == b"\x01")
+_INT = struct.Struct("!Q")
+INT = _FieldKind(_INT.pack, lambda data: _INT.unpack(data)[0])
+
+
+class BinaryCodec(MessageCodec):
+    """Compact codec with a fixed header and length prefixed raw fields.
+
+    The header is a magic byte that a JSON payload can never start with, so both codecs can be told apart
+    on every frame, followed by the message type tag. Every field is a 4 bytes length and the field's bytes,
+    base64 and hex fields are sent as raw bytes, a None field has the NONE_LENGTH length.
+    """
+
+    NAME = MessageCodecsEnum.BINARY
+    MAGIC = 0xB1
+    HEADER = struct.Struct("!BB")
+    FIELD_LENGTH = struct.Struct("!I")
+    NONE_LENGTH = 0xFFFFFFFF
+
+    # type tag and the (field, kind) of every field of each message, in the order they're written
+    SCHEMAS: dict[type, tuple[int, tuple[tuple[str, _FieldKind], ...]]] = {
+        ContentMessage: (1, (("uid", TEXT),
+                             ("des_uid", TEXT),
+                             ("content", BASE64),
+                             ("hmac", HEX),
+                             ("signature", BASE64),
+                             ("e2e", BOOL),
+                             ("compression", TEXT))),
+        ClientRegistrationMessage: (2, (("uid", TEXT),
+                                        ("public_key", TEXT),
+                                        ("suites", TEXT_LIST),
+                                        ("codecs", TEXT_LIST),
+                                        ("compressions", TEXT_LIST))),
+        KeyMessage: (3, (("uid", TEXT),
+                         ("encrypted_key", TEXT),
+                         ("suite", TEXT),
+                         ("agreement_key", TEXT),
+                         ("codec", TEXT),
+                         ("compression", TEXT))),
+        OptMessage: (4, (("uid", TEXT),
+                         ("opt", TEXT))),
+        AckMessage: (5, (("uid", TEXT),
+                         ("ack", TEXT),
+                         ("error", TEXT))),
+        PublicKeyRequestMessage: (6, (("uid", TEXT),
+                                      ("peer_uid", TEXT))),
+        PeerKeyMessage: (7, (("uid", TEXT),
+                             ("peer_uid", TEXT),
+                             ("suite", TEXT),
+                             ("public_key", TEXT),
+                             ("agreement_key", TEXT),
+                             ("signature", BASE64),
+                             ("compression", TEXT))),
+        SessionKeyMessage: (8, (("uid", TEXT),
+                                ("des_uid", TEXT),
+                                ("wrapped_key", TEXT),
+                                ("signature", BASE64))),
+        GroupMessage: (9, (("uid", TEXT),
+                           ("group_id", TEXT),
+                           ("members", TEXT_LIST))),
+        GroupContentMessage: (10, (("uid", TEXT),
+                                   ("group_id", TEXT),
+                                   ("des_uid", TEXT),
+                                   ("content", BASE64),
+                                   ("hmac", HEX),
+                                   ("signature", BASE64),
+                                   ("compression", TEXT))),
+        HeartbeatMessage: (11, (("uid", TEXT),
+                                ("pong", BOOL))),
+        ResumeMessage: (12, (("uid", TEXT),
+                             ("ticket", TEXT),
+                             ("timestamp", TEXT),
+                             ("hmac", HEX))),
+        TicketMessage: (13, (("uid", TEXT),
+                             ("ticket", TEXT),
+                             ("expires", TEXT))),
+        StreamStartMessage: (14, (("uid", TEXT),
+                                  ("des_uid", TEXT),
+                                  ("stream_id", TEXT),
+                                  ("nonce", BASE64),
+                                  ("name", TEXT),
+                                  ("size", INT),
+                                  ("e2e", BOOL))),
+        StreamChunkMessage: (15, (("uid", TEXT),
+                                  ("des_uid", TEXT),
+                                  ("stream_id", TEXT),
+                                  ("data", BASE64))),
+        StreamEndMessage: (16, (("uid", TEXT),
+                                ("des_uid", TEXT),
+                                ("stream_id", TEXT),
+                                ("hmac", HEX),
+                                ("signature", BASE64),
+                                ("error", TEXT))),
+    }
+    MESSAGE_CLASSES: dict[int, type] = {tag: message_class for message_class, (tag, _) in SCHEMAS.items()}
+
+    def encode(self, message: CommunicationMessage) -> bytes:
+        tag, fields = self.SCHEMAS[type(message)]
+        if len(fields) != len(message.__dict__):
+            raise ValueError(f"The binary schema of {type(message).__name__} doesn't match its fields.")
+
+        parts = [self.HEADER.pack(self.MAGIC, tag)]
+        for field, kind in fields:
+            value = getattr(message, field)
+            if value is None:
+                parts.append(self.FIELD_LENGTH.pack(self.NONE_LENGTH))
+                continue
+            data = kind.to_bytes(value)
+            parts.append(self.FIELD_LENGTH.pack(len(data)))
+            parts.append(data)
+        return b"".join(parts)
+
+    def decode(self, payload: bytes) -> CommunicationMessage:
+        try:
+            return self._decode(payload)
+        except MessageDecodeError:
+            raise
+        except _DECODE_ERRORS as e:
+            raise MessageDecodeError(f"Invalid binary message: {e}") from e
+
+    def _decode(self, payload: bytes) -> CommunicationMessage:
+        magic, tag = self.HEADER.unpack_from(payload)
+        if magic != self.MAGIC:
+            raise MessageDecodeError("Not a binary message.")
+        message_class = self.MESSAGE_CLASSES.get(tag)
+        if message_class is None:
+            raise MessageDecodeError(f"Unknown binary message type {tag}.")
+
+        view = memoryview(payload)
+        offset = self.HEADER.size
+        values = {}
+        for field, kind in self.SCHEMAS[message_class][1]:
+            (length,) = self.FIELD_LENGTH.unpack_from(payload, offset)
+            offset += self.FIELD_LENGTH.size
+            if length == self.NONE_LENGTH:
+                values[field] = None
+                continue
+            if offset + length > len(payload):
+                raise MessageDecodeError(f"The field {field} of {message_class.__name__} is truncated.")
+            values[field] = kind.from_bytes(bytes(view[offset:offset + length]))
+            offset += length
+        return message_class(**values)
+
+
+MESSAGE_CODECS: dict[MessageCodecsEnum, MessageCodec] = {
+    MessageCodecsEnum.BINARY: BinaryCodec(),
+    MessageCodecsEnum.JSON: JsonCodec(),
+}
+
+
+def get_codec(name: Optional[str]) -> MessageCodec:
+    """The codec by its name, peers that didn't negotiate a codec use JSON."""
+    return MESSAGE_CODECS[MessageCodecsEnum(name or MessageCodecsEnum.JSON)]
+
+
+def choose_codec(offered: Optional[list[str]]) -> MessageCodec:
+    """Pick the first codec the peer offered that is supported here."""
+    for name in offered or []:
+        if name in MESSAGE_CODECS.keys():
+            return MESSAGE_CODECS[MessageCodecsEnum(name)]
+    return MESSAGE_CODECS[MessageCodecsEnum.JSON]
+
+
+def decode_message(payload: bytes) -> CommunicationMessage:
+    """Decode a frame's payload with the codec it was written with, raise MessageDecodeError if it's malformed."""
+    if payload[:1] == bytes([BinaryCodec.MAGIC]):
+        return MESSAGE_CODECS[MessageCodecsEnum.BINARY].decode(payload)
+    return MESSAGE_CODECS[MessageCodecsEnum.JSON].decode(payload)
+
@@ -1,6 +1,9 @@
 import json
 from abc import abstractmethod, ABC
 from enum import Enum
+from typing import Optional
+
+from Communication.framing import encode_frame
 
 
 # all supported types for messages between server and client and vise versa.
@@ -10,6 +13,40 @@ class CommunicationMessageTypesEnum(str,Enum):
     KEY_MESSAGE = "key_message"
     OPT_MESSAGE = "opt_message"
     ACK_MESSAGE = "ack_message"
+    PUBLIC_KEY_REQUEST_MESSAGE = "public_key_request_message"
+    PEER_KEY_MESSAGE = "peer_key_message"
+    SESSION_KEY_MESSAGE = "session_key_message"
+    GROUP_MESSAGE = "group_message"
+    GROUP_CONTENT_MESSAGE = "group_content_message"
+    HEARTBEAT_MESSAGE = "heartbeat_message"
+    RESUME_MESSAGE = "resume_message"
+    TICKET_MESSAGE = "ticket_message"
+    STREAM_START_MESSAGE = "stream_start_message"
+    STREAM_CHUNK_MESSAGE = "stream_chunk_message"
+    STREAM_END_MESSAGE = "stream_end_message"
+
+
+# why a stream ended before it was delivered, the error of its StreamEndMessage
+class StreamErrorsEnum(str, Enum):
+    # the receiver isn't registered, or isn't connected (streams don't wait in the mailbox)
+    NOT_REGISTERED = "not_registered"
+    OFFLINE = "offline"
+    # the receiver's connection closed or didn't take the chunks in time
+    DISCONNECTED = "disconnected"
+    # the stream id is in use, or the HMAC or the signature of the stream are wrong
+    INVALID = "invalid"
+    TOO_MANY_STREAMS = "too_many_streams"
+    # the sender gave up on the stream or its connection closed
+    ABORTED = "aborted"
+
+
+# why the server refused a registration, the error of the AckMessage in place of the ack of its keys
+class RegistrationErrorsEnum(str, Enum):
+    # the uid is registered already, or its registration is going on on another connection
+    ACCOUNT_EXISTS = "account_exists"
+    # the key message came before the OPT was answered, after the registration was done, or from a connection
+    # the registration didn't start on
+    NOT_VERIFIED = "not_verified"
 
 
 class CommunicationMessage(ABC):
@@ -18,30 +55,43 @@ class CommunicationMessage(ABC):
     def to_dict(self):
         pass
 
-    def encode(self) -> bytes:
+    def encode(self, codec=None) -> bytes:
+        """Serialize the message with the codec (a MessageCodec, JSON if not set) and wrap it in a frame."""
+        if codec is not None:
+            return encode_frame(codec.encode(self))
+
         data = self.to_dict()
         serialized_message = json.dumps(data)
         content = serialized_message.encode()
-        return content
+        return encode_frame(content)
 
     def __str__(self):
         return self.__dict__.__str__()
 
 
 class ContentMessage(CommunicationMessage):
-    """This is a Class that hold the message content that passed between client to client."""
+    """This is a Class that hold the message content that passed between client to client.
+
+    With e2e the content is encrypted with the session key of the two clients and signed by the sender,
+    the server forwards it as is. Otherwise the server decrypts it and encrypts it again for the receiver.
+    compression is the compression of the content before it was encrypted, empty if it isn't compressed.
+    """
 
     def __init__(self,
                  uid: str,
                  des_uid: str,
                  content: str,
                  hmac: str,
-                 signature: str):
+                 signature: str,
+                 e2e: bool = False,
+                 compression: str = ""):
         self.uid = uid
         self.des_uid = des_uid
         self.content = content
         self.hmac = hmac
         self.signature = signature
+        self.e2e = e2e
+        self.compression = compression
 
     def to_dict(self):
         return {
@@ -51,12 +101,25 @@ class ContentMessage(CommunicationMessage):
 
 
 class ClientRegistrationMessage(CommunicationMessage):
-    """This class holds the registration data that sent to the server by the client."""
+    """This class holds the registration data that sent to the server by the client.
+
+    suites are the signature and key exchange suites the client supports in order of preference,
+    public_key belongs to the first of them. Clients that don't send suites use RSA.
+    codecs are the wire codecs the client can decode, clients that don't send codecs use JSON.
+    compressions are the content compressions the client supports, clients that don't send them get
+    uncompressed content.
+    """
     def __init__(self,
                  uid: str,
-                 public_key: str):
+                 public_key: str,
+                 suites: Optional[list[str]] = None,
+                 codecs: Optional[list[str]] = None,
+                 compressions: Optional[list[str]] = None):
         self.uid = uid
         self.public_key = public_key
+        self.suites = suites
+        self.codecs = codecs
+        self.compressions = compressions
 
     def to_dict(self):
         return {
@@ -67,11 +130,28 @@ class ClientRegistrationMessage(CommunicationMessage):
 
 
 class KeyMessage(CommunicationMessage):
-    """Holds a key value"""
+    """Holds a key value
 
-    def __init__(self,uid:str ,encrypted_key: str):
+    From the server it holds the server's public key of the suite that was chosen for the client, with the
+    server's key agreement public key if the suite uses one, the codec the client should send with and the
+    compression of the content.
+    From the client it holds the client's AES key encrypted with the server's public key, or the client's
+    key agreement public key.
+    """
+
+    def __init__(self,
+                 uid:str ,
+                 encrypted_key: str,
+                 suite: str = "",
+                 agreement_key: str = "",
+                 codec: str = "",
+                 compression: str = ""):
         self.uid = uid
         self.encrypted_key = encrypted_key
+        self.suite = suite
+        self.agreement_key = agreement_key
+        self.codec = codec
+        self.compression = compression
 
     def to_dict(self):
         return {
@@ -95,14 +175,281 @@ class OptMessage(CommunicationMessage):
 
 
 class AckMessage(CommunicationMessage):
-    """Message that sent as an acknowledgment to another side that he/her got the message."""
+    """Message that sent as an acknowledgment to another side that he/her got the message.
 
-    def __init__(self,uid: str, ack: str):
+    An error refuses what is acknowledged instead.
+    """
+
+    def __init__(self,uid: str, ack: str, error: str = ""):
         self.uid = uid
         self.ack = ack
+        self.error = error
+
+    # what is acknowledged is in the ack's namespace, a group id can't be taken for the key message of a uid
+    @staticmethod
+    def key_ack(uid: str) -> str:
+        return f"key:{uid}"
+
+    @staticmethod
+    def group_ack(group_id: str) -> str:
+        return f"group:{group_id}"
 
     def to_dict(self):
         return {
             "type": CommunicationMessageTypesEnum.ACK_MESSAGE,
             "data": self.__dict__.copy()
         }
+
+
+class PublicKeyRequestMessage(CommunicationMessage):
+    """Sent by a client to get the public keys of another client."""
+
+    def __init__(self, uid: str, peer_uid: str):
+        self.uid = uid
+        self.peer_uid = peer_uid
+
+    def to_dict(self):
+        return {
+            "type": CommunicationMessageTypesEnum.PUBLIC_KEY_REQUEST_MESSAGE,
+            "data": self.__dict__.copy()
+        }
+
+
+class PeerKeyMessage(CommunicationMessage):
+    """The public keys and the compression of peer_uid as the server knows them, signed by the server."""
+
+    def __init__(self,
+                 uid: str,
+                 peer_uid: str,
+                 suite: str,
+                 public_key: str,
+                 agreement_key: str,
+                 signature: str,
+                 compression: str = ""):
+        self.uid = uid
+        self.peer_uid = peer_uid
+        self.suite = suite
+        self.public_key = public_key
+        self.agreement_key = agreement_key
+        self.signature = signature
+        self.compression = compression
+
+    def to_dict(self):
+        return {
+            "type": CommunicationMessageTypesEnum.PEER_KEY_MESSAGE,
+            "data": self.__dict__.copy()
+        }
+
+
+class SessionKeyMessage(CommunicationMessage):
+    """A session key for e2e messages from uid to des_uid, wrapped with des_uid's public key.
+
+    The server forwards it as is, the signature is made by the sender over the wrapped key.
+    """
+
+    def __init__(self, uid: str, des_uid: str, wrapped_key: str, signature: str):
+        self.uid = uid
+        self.des_uid = des_uid
+        self.wrapped_key = wrapped_key
+        self.signature = signature
+
+    def to_dict(self):
+        return {
+            "type": CommunicationMessageTypesEnum.SESSION_KEY_MESSAGE,
+            "data": self.__dict__.copy()
+        }
+
+
+class GroupMessage(CommunicationMessage):
+    """Creates the group group_id with the given members, or replaces its members if uid owns it."""
+
+    def __init__(self, uid: str, group_id: str, members: list[str]):
+        self.uid = uid
+        self.group_id = group_id
+        self.members = members
+
+    def to_dict(self):
+        return {
+            "type": CommunicationMessageTypesEnum.GROUP_MESSAGE,
+            "data": self.__dict__.copy()
+        }
+
+
+class GroupContentMessage(CommunicationMessage):
+    """A message to every member of a group.
+
+    The sender encrypts and signs it once like a ContentMessage, with an empty des_uid. The server
+    encrypts it for every member (des_uid) with a HMAC of its own, the signature is the server's signature of
+    the group payload (see Tools.group_fingerprint), made once for all the members.
+    """
+
+    def __init__(self,
+                 uid: str,
+                 group_id: str,
+                 des_uid: str,
+                 content: str,
+                 hmac: str,
+                 signature: str,
+                 compression: str = ""):
+        self.uid = uid
+        self.group_id = group_id
+        self.des_uid = des_uid
+        self.content = content
+        self.hmac = hmac
+        self.signature = signature
+        self.compression = compression
+
+    def to_dict(self):
+        return {
+            "type": CommunicationMessageTypesEnum.GROUP_CONTENT_MESSAGE,
+            "data": self.__dict__.copy()
+        }
+
+
+class HeartbeatMessage(CommunicationMessage):
+    """Sent by the server to a connection that was quiet for a while, the client answers with a pong."""
+
+    def __init__(self, uid: str, pong: bool = False):
+        self.uid = uid
+        self.pong = pong
+
+    def to_dict(self):
+        return {
+            "type": CommunicationMessageTypesEnum.HEARTBEAT_MESSAGE,
+            "data": self.__dict__.copy()
+        }
+
+
+class ResumeMessage(CommunicationMessage):
+    """Binds a new connection to a registered client with the ticket the server gave it, instead of registering.
+
+    The hmac is made with the client's session key over the uid, the ticket and the timestamp (see
+    Tools.resumption_fingerprint), the timestamp is the client's time.time().
+    """
+
+    def __init__(self, uid: str, ticket: str, timestamp: str, hmac: str):
+        self.uid = uid
+        self.ticket = ticket
+        self.timestamp = timestamp
+        self.hmac = hmac
+
+    def to_dict(self):
+        return {
+            "type": CommunicationMessageTypesEnum.RESUME_MESSAGE,
+            "data": self.__dict__.copy()
+        }
+
+
+class TicketMessage(CommunicationMessage):
+    """A resumption ticket from the server, after the registration and every resumption.
+
+    An empty ticket answers a ResumeMessage that was rejected, the client has to register. expires is the
+    time.time() the ticket expires at.
+    """
+
+    def __init__(self, uid: str, ticket: str, expires: str = ""):
+        self.uid = uid
+        self.ticket = ticket
+        self.expires = expires
+
+    def to_dict(self):
+        return {
+            "type": CommunicationMessageTypesEnum.TICKET_MESSAGE,
+            "data": self.__dict__.copy()
+        }
+
+
+class StreamStartMessage(CommunicationMessage):
+    """Opens a stream of uid to des_uid, a payload that is sent in chunks instead of in one message.
+
+    The chunks are one AES-CTR encryption with the nonce, the counter continues from chunk to chunk, and the HMAC
+    in the StreamEndMessage covers them all (see EncryptorAESStream). Like a ContentMessage the stream is encrypted
+    for the server, that relays every chunk as it arrives encrypted for des_uid, or with e2e for des_uid itself.
+    The name and the size (in bytes, None if unknown) aren't encrypted.
+    """
+
+    def __init__(self,
+                 uid: str,
+                 des_uid: str,
+                 stream_id: str,
+                 nonce: str,
+                 name: str = "",
+                 size: Optional[int] = None,
+                 e2e: bool = False):
+        self.uid = uid
+        self.des_uid = des_uid
+        self.stream_id = stream_id
+        self.nonce = nonce
+        self.name = name
+        self.size = size
+        self.e2e = e2e
+
+    def to_dict(self):
+        return {
+            "type": CommunicationMessageTypesEnum.STREAM_START_MESSAGE,
+            "data": self.__dict__.copy()
+        }
+
+
+class StreamChunkMessage(CommunicationMessage):
+    """The next encrypted bytes of a stream."""
+
+    def __init__(self, uid: str, des_uid: str, stream_id: str, data: str):
+        self.uid = uid
+        self.des_uid = des_uid
+        self.stream_id = stream_id
+        self.data = data
+
+    def to_dict(self):
+        return {
+            "type": CommunicationMessageTypesEnum.STREAM_CHUNK_MESSAGE,
+            "data": self.__dict__.copy()
+        }
+
+
+class StreamEndMessage(CommunicationMessage):
+    """Closes a stream with the HMAC of all its chunks and the signature of the HMAC.
+
+    An error ends the stream without them, the data that was received is to be thrown away. The server also
+    answers the sender with a StreamEndMessage of its own stream, with an empty error once des_uid got it all.
+    """
+
+    def __init__(self, uid: str, des_uid: str, stream_id: str, hmac: str = "", signature: str = "", error: str = ""):
+        self.uid = uid
+        self.des_uid = des_uid
+        self.stream_id = stream_id
+        self.hmac = hmac
+        self.signature = signature
+        self.error = error
+
+    def to_dict(self):
+        return {
+            "type": CommunicationMessageTypesEnum.STREAM_END_MESSAGE,
+            "data": self.__dict__.copy()
+        }
+
+
+# the message class of every message type
+MESSAGE_CLASSES: dict[CommunicationMessageTypesEnum, type[CommunicationMessage]] = {
+    CommunicationMessageTypesEnum.CONTENT_MESSAGE: ContentMessage,
+    CommunicationMessageTypesEnum.CLIENT_REGISTRATION_MESSAGE: ClientRegistrationMessage,
+    CommunicationMessageTypesEnum.KEY_MESSAGE: KeyMessage,
+    CommunicationMessageTypesEnum.OPT_MESSAGE: OptMessage,
+    CommunicationMessageTypesEnum.ACK_MESSAGE: AckMessage,
+    CommunicationMessageTypesEnum.PUBLIC_KEY_REQUEST_MESSAGE: PublicKeyRequestMessage,
+    CommunicationMessageTypesEnum.PEER_KEY_MESSAGE: PeerKeyMessage,
+    CommunicationMessageTypesEnum.SESSION_KEY_MESSAGE: SessionKeyMessage,
+    CommunicationMessageTypesEnum.GROUP_MESSAGE: GroupMessage,
+    CommunicationMessageTypesEnum.GROUP_CONTENT_MESSAGE: GroupContentMessage,
+    CommunicationMessageTypesEnum.HEARTBEAT_MESSAGE: HeartbeatMessage,
+    CommunicationMessageTypesEnum.RESUME_MESSAGE: ResumeMessage,
+    CommunicationMessageTypesEnum.TICKET_MESSAGE: TicketMessage,
+    CommunicationMessageTypesEnum.STREAM_START_MESSAGE: StreamStartMessage,
+    CommunicationMessageTypesEnum.STREAM_CHUNK_MESSAGE: StreamChunkMessage,
+    CommunicationMessageTypesEnum.STREAM_END_MESSAGE: StreamEndMessage,
+}
+
+
+def parse_message(message: dict) -> CommunicationMessage:
+    """Build the message object back from the output of to_dict."""
+    return MESSAGE_CLASSES[CommunicationMessageTypesEnum(message.get("type"))](**message.get("data"))
@@ -0,0 +1,91 @@
+import asyncio
+import socket
+import struct
+from typing import Iterator
+
+# every frame on the wire is a 4 bytes big-endian length followed by the payload itself.
+FRAME_HEADER = struct.Struct("!I")
+MAX_FRAME_SIZE = 16 * 1024 * 1024
+
+
+class FrameTooLargeError(ValueError):
+    """Raised when a peer announces a frame bigger than the allowed maximum."""
+
+
+def encode_frame(payload: bytes) -> bytes:
+    """Prefix the payload with its length."""
+    if len(payload) > MAX_FRAME_SIZE:
+        raise FrameTooLargeError(f"Frame of {len(payload)} bytes exceeds the maximum of {MAX_FRAME_SIZE} bytes.")
+    return FRAME_HEADER.pack(len(payload)) + payload
+
+
+async def read_frame(reader: asyncio.StreamReader, max_frame_size: int = MAX_FRAME_SIZE) -> bytes:
+    """Read one complete frame from an asyncio stream, raise asyncio.IncompleteReadError on EOF."""
+    header = await reader.readexactly(FRAME_HEADER.size)
+    (length,) = FRAME_HEADER.unpack(header)
+    if length > max_frame_size:
+        raise FrameTooLargeError(f"Peer announced a frame of {length} bytes.")
+    return await reader.readexactly(length)
+
+
+class FrameDecoder:
+    """Incremental decoder that reads from a socket into one reusable buffer and yields complete frames.
+
+    TCP may merge several frames into one read or split one frame across several reads, the decoder keeps
+    the partial data between reads. The buffer only grows when a single frame doesn't fit into it.
+    """
+
+    def __init__(self, initial_size: int = 64 * 1024, max_frame_size: int = MAX_FRAME_SIZE):
+        self._buffer = bytearray(initial_size)
+        self._view = memoryview(self._buffer)
+        self._start = 0  # first byte that wasn't consumed yet
+        self._end = 0  # first free byte
+        self._max_frame_size = max_frame_size
+
+    def recv_from(self, sock: socket.socket) -> int:
+        """Read whatever is available on the socket into the buffer, return 0 when the peer closed."""
+        self._reserve(1)
+        received = sock.recv_into(self._view[self._end:])
+        self._end += received
+        return received
+
+    def feed(self, data: bytes):
+        """Append data that was already read by someone else."""
+        self._reserve(len(data))
+        self._view[self._end:self._end + len(data)] = data
+        self._end += len(data)
+
+    def frames(self) -> Iterator[bytes]:
+        """Yield every complete frame that is currently in the buffer."""
+        while self._end - self._start >= FRAME_HEADER.size:
+            (length,) = FRAME_HEADER.unpack_from(self._buffer, self._start)
+            if length > self._max_frame_size:
+                raise FrameTooLargeError(f"Peer announced a frame of {length} bytes.")
+            frame_end = self._start + FRAME_HEADER.size + length
+            if frame_end > self._end:
+                # make sure the rest of this frame will fit into the buffer on the next reads
+                self._reserve(frame_end - self._end)
+                return
+            frame = bytes(self._view[self._start + FRAME_HEADER.size:frame_end])
+            self._start = frame_end
+            yield frame
+
+        if self._start == self._end:
+            self._start = self._end = 0
+
+    def _reserve(self, size: int):
+        """Make sure there are at least `size` free bytes after the buffered data."""
+        if len(self._buffer) - self._end >= size:
+            return
+
+        pending = self._end - self._start
+        if pending + size <= len(self._buffer):
+            # enough room if we move the pending bytes to the beginning of the buffer
+            self._view[:pending] = self._view[self._start:self._end]
+        else:
+            new_buffer = bytearray(max(len(self._buffer) * 2, pending + size))
+            new_buffer[:pending] = self._view[self._start:self._end]
+            self._view.release()
+            self._buffer = new_buffer
+            self._view = memoryview(self._buffer)
+        self._start, self._end = 0, pending
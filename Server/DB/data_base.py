@@ -1,9 +1,39 @@
-from Server.DB.tables import UserKeyTable, RegistrationTable, PendingMessageTable
+from typing import Optional
+
+from Server.DB.storage import StorageBackend
+from Server.DB.tables import UserKeyTable, RegistrationTable, PendingMessageTable, GroupTable, Table
 
 
 class DataBase:
 
-    def __init__(self):
-        self.user_key_table: UserKeyTable = UserKeyTable()
-        self.registration_table: RegistrationTable = RegistrationTable()
-        self.pending_message_table: PendingMessageTable = PendingMessageTable()
+    def __init__(self, storage: Optional[StorageBackend] = None, node_id: Optional[str] = None):
+        """Without a storage the data base lives only in memory.
+
+        With a node_id the data base belongs to one node (a worker or a server of a cluster), nodes that share the
+        storage keep the pending messages of their own mailboxes under their own table names.
+        """
+        self._storage = storage
+        self.user_key_table: UserKeyTable = UserKeyTable(storage=storage)
+        self.registration_table: RegistrationTable = RegistrationTable(storage=storage)
+        pending_message_table_name = None
+        if node_id is not None:
+            pending_message_table_name = f"{PendingMessageTable.TABLE_NAME}_{node_id}"
+        self.pending_message_table: PendingMessageTable = PendingMessageTable(storage=storage,
+                                                                              table_name=pending_message_table_name)
+        self.group_table: GroupTable = GroupTable(storage=storage)
+
+    @property
+    def shared_tables(self) -> tuple[Table, ...]:
+        """The tables that the nodes keep the same, every node sends its changes of them to the others."""
+        return self.user_key_table, self.registration_table, self.group_table
+
+    def apply_change(self, table_name: str, uid: str, data: Optional[dict]):
+        """Apply a change of a shared table that another node made."""
+        tables: dict[str, Table] = {table.TABLE_NAME: table for table in self.shared_tables}
+        tables[table_name].apply_change(uid, data)
+
+    def close(self):
+        """Write every pending change to the storage and release it."""
+        if self._storage:
+            self._storage.flush()
+            self._storage.close()
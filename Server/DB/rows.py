@@ -1,6 +1,24 @@
+import copy
+import uuid
 from datetime import time, datetime
 
 
+def _encode_value(value):
+    if isinstance(value, datetime):
+        return {"__datetime__": value.isoformat()}
+    if isinstance(value, time):
+        return {"__time__": value.isoformat()}
+    return value
+
+
+def _decode_value(value):
+    if isinstance(value, dict) and "__datetime__" in value:
+        return datetime.fromisoformat(value["__datetime__"])
+    if isinstance(value, dict) and "__time__" in value:
+        return time.fromisoformat(value["__time__"])
+    return value
+
+
 class TableRow:
     def __init__(self,uid: str):
         self._uid = uid
@@ -10,15 +28,40 @@ class TableRow:
             return self._uid == other._uid
         return False
 
+    def copy(self) -> 'TableRow':
+        """Shallow copy, the rows with mutable values (lists, dicts) override it to copy them too."""
+        return copy.copy(self)
+
+    def to_dict(self) -> dict:
+        """JSON friendly representation of the row, used by the persistent storage."""
+        return {field: _encode_value(value) for field, value in self.__dict__.items()}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> 'TableRow':
+        row = cls.__new__(cls)
+        row.__dict__.update({field: _decode_value(value) for field, value in data.items()})
+        return row
+
     def __str__(self):
         return self.__dict__.__str__()
 
 
 class UserKeyTableRow(TableRow):
-    def __init__(self, uid: str, encrypted_aes_key: str = "", public_key: str = ""):
+    def __init__(self,
+                 uid: str,
+                 encrypted_aes_key: str = "",
+                 public_key: str = "",
+                 suite: str = "",
+                 agreement_key: str = "",
+                 compression: str = ""):
         super().__init__(uid)
         self.encrypted_aes_key = encrypted_aes_key
         self.public_key = public_key
+        # the crypto suite the user registered with and its key agreement public key, if the suite has one
+        self.suite = suite
+        self.agreement_key = agreement_key
+        # the compression of the content the user gets
+        self.compression = compression
 
 
 class RegistrationTableRow(TableRow):
@@ -39,9 +82,35 @@ class RegistrationTableRow(TableRow):
 
 
 class PendingMessageTableRow(TableRow):
-    def __init__(self, uid: str, des_uid: str, message: dict[str, str], timestamp: time, remain_tries):
+    def __init__(self,
+                 uid: str,
+                 des_uid: str,
+                 message: dict[str, str],
+                 timestamp: datetime,
+                 remain_tries: int,
+                 message_id: str = ""):
         super().__init__(uid)
         self.des_uid = des_uid
         self.message = message
         self.timestamp = timestamp
-        self.remain_tries = remain_tries
\ No newline at end of file
+        self.remain_tries = remain_tries
+        self.message_id = message_id or uuid.uuid4().hex
+
+    def copy(self) -> 'PendingMessageTableRow':
+        row = copy.copy(self)
+        # the message is the nested dict of to_dict()
+        row.message = copy.deepcopy(self.message)
+        return row
+
+
+class GroupTableRow(TableRow):
+    def __init__(self, uid: str, owner_uid: str, members: list[str]):
+        """uid is the id of the group, the owner is one of the members."""
+        super().__init__(uid)
+        self.owner_uid = owner_uid
+        self.members = members
+
+    def copy(self) -> 'GroupTableRow':
+        row = copy.copy(self)
+        row.members = list(self.members)
+        return row
@@ -0,0 +1,202 @@
+import json
+import queue
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from typing import Callable, Iterable, Optional
+
+
+class StorageBackend(ABC):
+    """Persistent storage behind the in-memory tables.
+
+    The tables keep serving reads from memory, the backend only receives every change and gives all the rows
+    back when the tables are created again after a restart.
+    """
+
+    @abstractmethod
+    def load(self, table_name: str) -> list[dict]:
+        """Return all the stored rows of the table."""
+        pass
+
+    @abstractmethod
+    def put(self, table_name: str, uid: str, row: dict):
+        """Insert or replace a row."""
+        pass
+
+    @abstractmethod
+    def delete(self, table_name: str, uid: str):
+        pass
+
+    @abstractmethod
+    def flush(self):
+        """Block until every change made so far is durable."""
+        pass
+
+    @abstractmethod
+    def close(self):
+        pass
+
+
+class SQLiteStorage(StorageBackend):
+    """SQLite in WAL mode with a background writer thread that group commits the changes.
+
+    put and delete only enqueue the change, the writer takes everything that is waiting in the queue and
+    commits it in a single transaction, so under load many changes share one fsync. A replaced row keeps its
+    place, the rows are loaded in the order they were first added.
+
+    The workers of one machine can share the file, a writer waits up to BUSY_TIMEOUT seconds for the others to
+    commit. SQLite's locks don't work over a network file system, the nodes of a cluster need a file each. Once
+    the writer failed, put, delete and flush raise its error instead of queueing changes that are never stored.
+    """
+
+    _CLOSE = object()
+    # how often flush checks that the writer is still alive while it waits for it
+    FLUSH_POLL = 0.5
+    # seconds a transaction waits for the lock of the file while another process writes it
+    BUSY_TIMEOUT = 30.0
+
+    def __init__(self, path: str, max_batch_size: int = 1000):
+        self._path = path
+        self._max_batch_size = max_batch_size
+        self._queue: queue.Queue = queue.Queue()
+        self._error: Optional[BaseException] = None
+
+        connection = self._connect()
+        connection.execute("CREATE TABLE IF NOT EXISTS rows ("
+                           "table_name TEXT NOT NULL, "
+                           "uid TEXT NOT NULL, "
+                           "data TEXT NOT NULL, "
+                           "PRIMARY KEY (table_name, uid))")
+        connection.commit()
+        connection.close()
+
+        self._writer = threading.Thread(target=self._write_loop, name="sqlite-storage-writer")
+        self._writer.daemon = True
+        self._writer.start()
+
+    def load(self, table_name: str) -> list[dict]:
+        connection = self._connect()
+        try:
+            cursor = connection.execute("SELECT data FROM rows WHERE table_name = ? ORDER BY rowid", (table_name,))
+            return [json.loads(data) for (data,) in cursor]
+        finally:
+            connection.close()
+
+    def put(self, table_name: str, uid: str, row: dict):
+        self._check_writer()
+        self._queue.put((table_name, uid, json.dumps(row)))
+
+    def delete(self, table_name: str, uid: str):
+        self._check_writer()
+        self._queue.put((table_name, uid, None))
+
+    def flush(self):
+        self._check_writer()
+        flushed = threading.Event()
+        self._queue.put(flushed)
+        # the writer sets the event once the changes before it are committed, unless it died on one of them
+        while not flushed.wait(self.FLUSH_POLL):
+            self._check_writer()
+
+    def close(self):
+        self._queue.put(self._CLOSE)
+        self._writer.join()
+
+    def _check_writer(self):
+        if self._error is not None or not self._writer.is_alive():
+            raise RuntimeError("The storage writer stopped, the changes since aren't stored.") from self._error
+
+    def _connect(self) -> sqlite3.Connection:
+        connection = sqlite3.connect(self._path, timeout=self.BUSY_TIMEOUT)
+        connection.execute("PRAGMA journal_mode=WAL")
+        # with WAL, NORMAL keeps the database consistent after a crash and syncs only on checkpoints
+        connection.execute("PRAGMA synchronous=NORMAL")
+        return connection
+
+    def _write_loop(self):
+        connection = self._connect()
+        try:
+            self._write_batches(connection)
+        except BaseException as error:
+            # flush raises it, instead of waiting for a writer that is gone
+            self._error = error
+            raise
+        finally:
+            connection.close()
+
+    def _write_batches(self, connection: sqlite3.Connection):
+        closing = False
+        while not closing:
+            batch = [self._queue.get()]
+            while len(batch) < self._max_batch_size:
+                try:
+                    batch.append(self._queue.get_nowait())
+                except queue.Empty:
+                    break
+
+            # only the last change of every row in the batch matters, a row that was deleted is added again at
+            # the end
+            puts: dict[tuple[str, str], str] = {}
+            deletes: set[tuple[str, str]] = set()
+            flushed: list[threading.Event] = []
+            for item in batch:
+                if item is self._CLOSE:
+                    closing = True
+                elif isinstance(item, threading.Event):
+                    flushed.append(item)
+                else:
+                    table_name, uid, data = item
+                    if data is None:
+                        puts.pop((table_name, uid), None)
+                        deletes.add((table_name, uid))
+                    else:
+                        puts[(table_name, uid)] = data
+
+            # an upsert keeps the rowid of the row, which is the order the rows are loaded in
+            with connection:
+                connection.executemany("DELETE FROM rows WHERE table_name = ? AND uid = ?", deletes)
+                connection.executemany("INSERT INTO rows (table_name, uid, data) VALUES (?, ?, ?) "
+                                       "ON CONFLICT (table_name, uid) DO UPDATE SET data = excluded.data",
+                                       [(table_name, uid, data) for (table_name, uid), data in puts.items()])
+
+            for event in flushed:
+                event.set()
+
+
+class ReplicatedStorage(StorageBackend):
+    """Passes every change to a storage, if there is one, and the changes of the shared tables also to publish.
+
+    The workers of a multi-worker server keep their own in-memory tables, publish sends the changes that this
+    worker made to the other workers, which apply them to their tables.
+    """
+
+    def __init__(self,
+                 publish: Callable[[str, str, Optional[dict]], None],
+                 shared_tables: Iterable[str],
+                 storage: Optional[StorageBackend] = None):
+        self._publish = publish
+        self._shared_tables = frozenset(shared_tables)
+        self._storage = storage
+
+    def load(self, table_name: str) -> list[dict]:
+        return self._storage.load(table_name) if self._storage else []
+
+    def put(self, table_name: str, uid: str, row: dict):
+        if self._storage:
+            self._storage.put(table_name, uid, row)
+        if table_name in self._shared_tables:
+            self._publish(table_name, uid, row)
+
+    def delete(self, table_name: str, uid: str):
+        if self._storage:
+            self._storage.delete(table_name, uid)
+        if table_name in self._shared_tables:
+            self._publish(table_name, uid, None)
+
+    def flush(self):
+        if self._storage:
+            self._storage.flush()
+
+    def close(self):
+        if self._storage:
+            self._storage.close()
@@ -1,69 +1,179 @@
-import copy
-from typing import Generic, TypeVar, Optional
+import threading
+from typing import Generic, TypeVar, Optional, Any
 
-from Server.DB.rows import UserKeyTableRow, RegistrationTableRow, PendingMessageTableRow
+from Server.DB.rows import TableRow, UserKeyTableRow, RegistrationTableRow, PendingMessageTableRow, GroupTableRow
+from Server.DB.storage import StorageBackend
 
 T = TypeVar('T', bound='TableRow')
 
 class Table(Generic[T]):
-    def __init__(self):
-        self.rows: list[T] = []
+    """Rows indexed by their key (the uid by default), every operation on a single row is O(1).
+
+    The table never hands out its own row objects. Rows are copied on the way in and on the way out,
+    the copies are shallow since the rows hold only immutable values, to change a stored row either
+    pass a modified copy to update_row or change single fields with update_fields.
+    """
+
+    # name of the table in the persistent storage
+    TABLE_NAME: str = ""
+    # the row class, used to restore the rows from the persistent storage
+    ROW_TYPE: type = TableRow
+    # name of the row attribute that identifies the row in the table
+    KEY_FIELD: str = "_uid"
+    # names of row attributes that get a secondary index, e.g. ("des_uid",)
+    INDEXED_FIELDS: tuple[str, ...] = ()
+
+    def __init__(self, storage: Optional[StorageBackend] = None, table_name: Optional[str] = None):
+        """table_name replaces the TABLE_NAME in the storage, for tables of the same kind that share a storage."""
+        self._table_name = table_name or self.TABLE_NAME
+        self._rows: dict[str, T] = {}
+        self._indexes: dict[str, dict[Any, dict[str, None]]] = {field: {} for field in self.INDEXED_FIELDS}
+        self._lock = threading.RLock()
+        self._storage = storage
+
+        # replay the stored rows into the in-memory index
+        if self._storage:
+            for data in self._storage.load(self._table_name):
+                row = self.ROW_TYPE.from_dict(data)
+                self._insert(row)
+
+    @property
+    def rows(self) -> list[T]:
+        """Copy of all the rows in the table."""
+        with self._lock:
+            return [row.copy() for row in self._rows.values()]
 
     def find_by_uid(self, uid: str) -> Optional[T]:
         """Find a row by its uid."""
-        for row in self.rows:
-            if row._uid == uid:
-                return copy.deepcopy(row)
+        # update_fields changes the stored row in place, don't copy it halfway through a change
+        with self._lock:
+            row = self._rows.get(uid)
+            if row is None:
+                return None
 
-        return None
+            return row.copy()
+
+    def find_by_field(self, field: str, value) -> list[T]:
+        """Find all the rows with the value in an indexed field, ordered by insertion."""
+        with self._lock:
+            uids = self._indexes[field].get(value, {})
+            return [self._rows[uid].copy() for uid in uids]
 
     def is_row_exist(self,row:T) -> bool:
         """find row by passed row object."""
-        for row_in_table in self.rows:
-            if row_in_table == row:
-                return True
-
-        return False
+        return self._key(row) in self._rows
 
     def add_row(self,row:T) -> bool:
-        row_exist = self.is_row_exist(row)
-        if not row_exist:
-            self.rows.append(copy.deepcopy(row))
-            return True
+        with self._lock:
+            if self._key(row) in self._rows:
+                return False
 
-        return False
-
-    def remove_row(self,row:T):
-        row_exist = self.is_row_exist(row)
-        if row_exist:
-            self.rows.remove(row)
+            self._insert(row.copy())
+            self._persist(self._key(row))
             return True
 
-        return False
+    def remove_row(self,row:T):
+        return self.remove_row_by_uid(self._key(row))
 
     def update_row(self,row:T):
-        row_in_data_base = self.find_by_uid(uid=row._uid)
-        if row_in_data_base:
-            self.remove_row(row_in_data_base)
-            self.add_row(row)
-
+        with self._lock:
+            if self._key(row) in self._rows:
+                self._delete(self._key(row))
+                self._insert(row.copy())
+                self._persist(self._key(row))
+
+    def update_fields(self, uid: str, **fields) -> bool:
+        """Change only the passed fields of the stored row, without copying the whole row."""
+        with self._lock:
+            row = self._rows.get(uid)
+            if row is None:
+                return False
+
+            for field, value in fields.items():
+                if field in self._indexes:
+                    self._unindex(field, getattr(row, field), uid)
+                    self._index(field, value, uid)
+                setattr(row, field, value)
+            self._persist(uid)
+            return True
 
     def remove_row_by_uid(self,uid: str) -> bool:
-        row = self.find_by_uid(uid=uid)
-        if row:
-            self.remove_row(row)
+        with self._lock:
+            if uid not in self._rows:
+                return False
+
+            self._delete(uid)
+            self._persist(uid)
             return True
 
-        return False
+    def apply_change(self, uid: str, data: Optional[dict]):
+        """Apply a change that was made and stored by another process, a None data removes the row.
+
+        Nothing is passed to the storage, the process that made the change already did.
+        """
+        with self._lock:
+            if uid in self._rows:
+                self._delete(uid)
+            if data is not None:
+                self._insert(self.ROW_TYPE.from_dict(data))
+
+    def __len__(self):
+        return len(self._rows)
+
+    def _persist(self, uid: str):
+        """Pass the current state of the row to the persistent storage."""
+        if not self._storage:
+            return
+
+        row = self._rows.get(uid)
+        if row is None:
+            self._storage.delete(self._table_name, uid)
+        else:
+            self._storage.put(self._table_name, uid, row.to_dict())
+
+    def _key(self, row: T) -> str:
+        return getattr(row, self.KEY_FIELD)
+
+    def _insert(self, row: T):
+        self._rows[self._key(row)] = row
+        for field in self._indexes:
+            self._index(field, getattr(row, field), self._key(row))
+
+    def _delete(self, uid: str):
+        row = self._rows.pop(uid)
+        for field in self._indexes:
+            self._unindex(field, getattr(row, field), uid)
+
+    def _index(self, field: str, value, uid: str):
+        # a dict keeps the insertion order, so rows of the same value come back in FIFO order
+        self._indexes[field].setdefault(value, {})[uid] = None
+
+    def _unindex(self, field: str, value, uid: str):
+        uids = self._indexes[field].get(value)
+        if uids is not None:
+            uids.pop(uid, None)
+            if not uids:
+                del self._indexes[field][value]
 
 
 class UserKeyTable(Table[UserKeyTableRow]):
-    pass
+    TABLE_NAME = "user_key"
+    ROW_TYPE = UserKeyTableRow
 
 
 class RegistrationTable(Table[RegistrationTableRow]):
-    pass
+    TABLE_NAME = "registration"
+    ROW_TYPE = RegistrationTableRow
 
 
 class PendingMessageTable(Table[PendingMessageTableRow]):
-    pass
+    TABLE_NAME = "pending_message"
+    ROW_TYPE = PendingMessageTableRow
+    # a user may have many pending messages, so the rows are identified by the message
+    KEY_FIELD = "message_id"
+    INDEXED_FIELDS = ("des_uid",)
+
+
+class GroupTable(Table[GroupTableRow]):
+    TABLE_NAME = "group"
+    ROW_TYPE = GroupTableRow
@@ -0,0 +1,53 @@
+import ipaddress
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from Utils.metrics import MetricsRegistry
+
+
+class AdminServer:
+    """Serves the server's metrics in the Prometheus text format on a loopback port.
+
+    GET /metrics (or /) returns the metrics, e.g. `curl localhost:9100/metrics`. The requests are served on their
+    own threads, a scrape never waits for the chat connections. Only loopback addresses are accepted, the
+    metrics aren't meant to leave the machine.
+    """
+
+    def __init__(self, metrics: MetricsRegistry, host: str = "127.0.0.1", port: int = 9100):
+        if host != "localhost" and not ipaddress.ip_address(host).is_loopback:
+            raise ValueError(f"The admin server listens on loopback only, not on {host}.")
+        self._metrics = metrics
+
+        admin_server = self
+
+        class MetricsRequestHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path not in ("/", "/metrics"):
+                    self.send_error(404)
+                    return
+                body = admin_server._metrics.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                # a scrape every few seconds would flood the server's log
+                pass
+
+        self._http_server = ThreadingHTTPServer((host, port), MetricsRequestHandler)
+        self._http_server.daemon_threads = True
+        self._thread = threading.Thread(target=self._http_server.serve_forever, name="admin-server")
+        self._thread.daemon = True
+
+    @property
+    def port(self) -> int:
+        return self._http_server.server_address[1]
+
+    def start(self):
+        self._thread.start()
+
+    def close(self):
+        self._http_server.shutdown()
+        self._http_server.server_close()
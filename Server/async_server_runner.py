@@ -0,0 +1,297 @@
+import asyncio
+import logging
+import time
+from typing import Callable, Optional
+
+from Communication.Messages.message_codecs import decode_message, MessageDecodeError
+from Communication.Messages.messages import ContentMessage, GroupContentMessage, StreamChunkMessage, \
+    StreamErrorsEnum
+from Communication.framing import read_frame, FrameTooLargeError
+from Server.crypto_pool import CryptoJob
+from Server.outbound_queue import SlowConsumerPolicyEnum
+from Server.server_runner import ServerRunner
+
+
+class AsyncServerRunner(ServerRunner):
+    """Server that serves all the connections from a single asyncio event loop.
+
+    The registration, OPT, key and content handlers are the same ones the threaded server uses,
+    the only difference is that every connection is an (asyncio.StreamReader, asyncio.StreamWriter)
+    pair instead of a socket with its own thread, the StreamWriter takes the place of the socket.
+    The transport already coalesces the writes of a loop iteration and never blocks the loop, the outbound
+    watermarks are the transport's write buffer limits.
+    """
+
+    # seconds between the checks of the buffer of a stream's receiver while the stream waits for room
+    STREAM_ROOM_POLL = 0.01
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        # connections over the high watermark, until their transport drains to the low watermark
+        self._slow_writers: set[asyncio.StreamWriter] = set()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        # the blocking crypto of a handler that runs off the loop and its finish, by connection, see run_blocking
+        self._blocking: dict[asyncio.StreamWriter, tuple[asyncio.Future, Callable]] = {}
+
+    async def handle_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        address = writer.get_extra_info("peername")
+        self._logger.info("Server handle message from %s", address)
+        self.start_connection_timer(self._connections.open(writer, address=address))
+        self.count_receive_loop(1)
+        writer.transport.set_write_buffer_limits(high=self._outbound_high_watermark, low=self._outbound_low_watermark)
+
+        # content and group messages that wait for their crypto, finished in the order they arrived
+        relays: asyncio.Queue = asyncio.Queue()
+        relays_task = asyncio.create_task(self.finish_relays_in_order(relays))
+
+        try:
+            while True:  # Continuous loop to keep receiving messages
+                try:
+                    frame = await read_frame(reader)
+                except asyncio.IncompleteReadError:
+                    self._logger.warning("Connection closed by the client")
+                    break
+                except FrameTooLargeError as e:
+                    self._logger.error("Invalid frame from client %s: %s", address, e)
+                    break
+                except OSError as e:
+                    self._logger.error("Socket error with client %s: %s", address, e)
+                    break
+
+                self.touch(writer)
+                try:
+                    message = decode_message(frame)
+                except MessageDecodeError as e:
+                    self._logger.error("Invalid message from client %s: %s", address, e)
+                    break
+                if isinstance(message, ContentMessage) and not message.e2e:
+                    # don't wait for the crypto, keep reading the next messages of this connection meanwhile
+                    start = time.perf_counter()
+                    self.submit_relay(content_message=message, sock=writer, relays=relays)
+                    self.record_message(message=message, seconds=time.perf_counter() - start)
+                elif isinstance(message, GroupContentMessage):
+                    start = time.perf_counter()
+                    self.submit_group_fan_out(group_content_message=message, sock=writer, relays=relays)
+                    self.record_message(message=message, seconds=time.perf_counter() - start)
+                else:
+                    self.dispatch_message(message=message, sock=writer)
+                    blocking = self._blocking.pop(writer, None)
+                    if blocking is not None:
+                        # the next message of the connection may need what the handler finishes, e.g. a resumed uid
+                        result, finish = blocking
+                        finish(await result)
+                    # don't read the next chunk before the receiver took this one
+                    if isinstance(message, StreamChunkMessage) and \
+                            not await self.wait_for_stream_room(stream_chunk_message=message, sock=writer):
+                        self.drop_stream(sock=writer, message=message, error=StreamErrorsEnum.DISCONNECTED)
+        finally:
+            # also when a handler failed, the connection is released whatever ended the loop
+            self.cleanup_client(writer)
+            self.count_receive_loop(-1)
+            await relays.put(None)
+            await relays_task
+
+    def submit_relay(self, content_message: ContentMessage, sock, relays: asyncio.Queue):
+        self._logger.sampled(logging.INFO, "Server received message %s", content_message)
+
+        def finish(result):
+            if result is not None:
+                self.finish_relay(content_message=content_message, result=result)
+
+        if not self.keys_cached(content_message.uid, content_message.des_uid):
+            # unwrapping a stored session key, or importing a public key, is crypto too
+            relays.put_nowait((asyncio.ensure_future(self.run_relay(content_message=content_message, sock=sock)),
+                               finish))
+            return
+        job = self.prepare_relay(content_message=content_message, sock=sock)
+        if job is not None:
+            relays.put_nowait((self.submit_crypto(job), finish))
+
+    def keys_cached(self, *uids: str) -> bool:
+        """True if the session and public keys of the uids are cached, preparing their relay needs no crypto."""
+        return all(uid in self._session_keys and uid in self._public_keys for uid in uids)
+
+    async def run_relay(self, content_message: ContentMessage, sock):
+        """Prepare the relay off the loop and run its crypto, None if the message can't be relayed."""
+        job = await self._loop.run_in_executor(None, self.prepare_relay, content_message, sock)
+        if job is None:
+            return None
+        return await self.submit_crypto(job)
+
+    def submit_group_fan_out(self, group_content_message: GroupContentMessage, sock, relays: asyncio.Queue):
+        self._logger.sampled(logging.INFO, "Server received group message %s", group_content_message)
+
+        def finish(result):
+            if result is not None:
+                open_result, sealed = result
+                self.finish_group_fan_out(group_content_message=group_content_message,
+                                          open_result=open_result,
+                                          sealed=sealed)
+
+        relays.put_nowait((asyncio.ensure_future(self.run_group_fan_out(group_content_message=group_content_message,
+                                                                        sock=sock)),
+                           finish))
+
+    def submit_crypto(self, job: CryptoJob) -> asyncio.Future:
+        """Submit the job to the worker pool, or without one to a thread of the loop's default executor.
+
+        The crypto never runs on the loop itself, the other connections are served while it runs.
+        """
+        if self._crypto_pool:
+            return asyncio.wrap_future(super().submit_crypto(job))
+        return self._loop.run_in_executor(None, self.run_crypto, job)
+
+    def run_blocking(self, sock: asyncio.StreamWriter, function, args: tuple, finish):
+        # handle_connection waits for the result before it reads the next message of sock
+        self._blocking[sock] = (self._loop.run_in_executor(None, function, *args), finish)
+
+    async def run_group_fan_out(self, group_content_message: GroupContentMessage, sock):
+        """The crypto of a group message on the workers, None if the sender's message is invalid.
+
+        The members' session keys are collected off the loop too, unwrapping them on a cache miss is crypto.
+        """
+        fan_out = await self._loop.run_in_executor(None, self.prepare_group_fan_out, group_content_message, sock)
+        if fan_out is None:
+            return None
+        open_job, recipients = fan_out
+        open_result = await self.submit_crypto(open_job)
+        if open_result.error:
+            self._logger.error(open_result.error)
+            self._metrics.counter("crypto_errors_total", "Messages rejected by the crypto checks.",
+                                  error=open_result.error).inc()
+            return None
+        seal_jobs = self.split_group_seal_jobs(data=open_result.data, recipients=recipients)
+        seal_results = await asyncio.gather(*(self.submit_crypto(job) for job in seal_jobs))
+        return open_result, [content for seal_result in seal_results for content in seal_result.sealed]
+
+    async def finish_relays_in_order(self, relays: asyncio.Queue):
+        while True:
+            relay = await relays.get()
+            if relay is None:
+                return
+            result, finish = relay
+            try:
+                finish(await result)
+            except Exception as e:
+                # a failed relay drops only its own message, the ones behind it are still delivered
+                self._logger.error("Unable to relay a message: %s", e, exc_info=True)
+                self._metrics.counter("crypto_errors_total", "Messages rejected by the crypto checks.",
+                                      error=type(e).__name__).inc()
+
+    def send_msg(self, sock: asyncio.StreamWriter, content: bytes) -> bool:
+        self._logger.sampled(logging.DEBUG, "Server sending %d bytes", len(content))
+        if sock.is_closing():
+            self._logger.error("Connection closed. Unable to send data.")
+            return False
+        if sock in self._slow_writers:
+            self._logger.warning("The connection is too slow, the data wasn't sent.")
+            return False
+
+        # the transport buffers the data and flushes it when the socket is writable
+        with self._metrics.histogram("stage_seconds", stage="send").time():
+            sock.write(content)
+        self.record_sent(content)
+        if sock.transport.get_write_buffer_size() > self._outbound_high_watermark:
+            self._slow_writers.add(sock)
+            self.handle_slow_consumer(sock)
+            if self._slow_consumer_policy == SlowConsumerPolicyEnum.PARK:
+                asyncio.ensure_future(self.wait_until_drained(sock))
+        return True
+
+    async def wait_until_drained(self, sock: asyncio.StreamWriter):
+        try:
+            # returns once the transport's buffer is below the low watermark
+            await sock.drain()
+        except ConnectionError:
+            return
+        finally:
+            self._slow_writers.discard(sock)
+        self.handle_drained(sock)
+
+    def can_send(self, sock) -> bool:
+        return sock not in self._slow_writers
+
+    def wait_for_room(self, sock: asyncio.StreamWriter) -> bool:
+        # the loop can't wait here, the receive loop of the stream's sender waits after the chunk was written
+        return True
+
+    async def wait_for_stream_room(self, stream_chunk_message: StreamChunkMessage, sock) -> bool:
+        """Wait while the transport of the chunk's receiver has more than the low watermark buffered, False if
+        it didn't drain in time.
+
+        drain() only waits once the transport is over the high watermark, that makes the connection a slow
+        consumer, so the size of the buffer is checked every STREAM_ROOM_POLL seconds instead.
+        """
+        connection = self._connections.get(sock)
+        writer = self._connections.socket_of(stream_chunk_message.des_uid)
+        if connection is None or stream_chunk_message.stream_id not in connection.streams or writer is None:
+            # the chunk wasn't relayed, or its receiver is on another node or gone and the next chunk finds out
+            return True
+        deadline = time.monotonic() + self._stream_room_timeout
+        with self._metrics.histogram("stage_seconds", stage="stream_wait").time():
+            while writer.transport.get_write_buffer_size() > self._outbound_low_watermark:
+                if writer.is_closing() or time.monotonic() >= deadline:
+                    return False
+                await asyncio.sleep(self.STREAM_ROOM_POLL)
+        return True
+
+    def outbound_queued_bytes(self) -> int:
+        return sum(connection.sock.transport.get_write_buffer_size() for connection in self._connections.connections()
+                   if not connection.sock.is_closing())
+
+    def slow_consumer_count(self) -> int:
+        return len(self._slow_writers)
+
+    def disconnect(self, sock: asyncio.StreamWriter):
+        # drop what is buffered instead of waiting for the slow reader to take it
+        sock.transport.abort()
+        self.cleanup_client(sock)
+
+    def cleanup_client(self, client_socket: asyncio.StreamWriter):
+        self._slow_writers.discard(client_socket)
+        super().cleanup_client(client_socket)
+
+    @staticmethod
+    def is_closed(sock: asyncio.StreamWriter) -> bool:
+        return sock.is_closing()
+
+    def on_bus_message(self, node_id: str, message: dict):
+        # the connections belong to the loop, the messages of the other nodes are handled on it too
+        self._loop.call_soon_threadsafe(self.handle_bus_message, node_id, message)
+
+    def on_bus_undelivered(self, node_id: str, message: dict):
+        self._loop.call_soon_threadsafe(self.handle_bus_undelivered, node_id, message)
+
+    def run_timer(self, callback, args: tuple):
+        # the timers close connections and send to them, they run on the loop too
+        if self._loop is None:
+            callback(*args)
+        else:
+            self._loop.call_soon_threadsafe(callback, *args)
+
+    async def serve(self, host: str, port: int):
+        self._loop = asyncio.get_running_loop()
+        self.start_peer_bus()
+        server = await asyncio.start_server(self.handle_connection, host, port, reuse_address=True,
+                                            reuse_port=self._reuse_port)
+        self._logger.info("Server is listening for connections...")
+        async with server:
+            await server.serve_forever()
+
+    def start(self, host: str = 'localhost', port: int = 12345):
+        self._logger.info("Start asyncio server")
+
+        # create server's private and public keys
+        self.create_keys()
+        self.start_crypto_pool()
+        self.start_admin_server()
+        self._timer_wheel.start()
+
+        try:
+            asyncio.run(self.serve(host=host, port=port))
+        finally:
+            self._timer_wheel.stop()
+            self.stop_peer_bus()
+            self.stop_admin_server()
+            self.stop_crypto_pool()
+            self._db.close()
@@ -0,0 +1,109 @@
+import threading
+import time
+from typing import Callable, Optional
+
+from Communication.Messages.message_codecs import MessageCodec
+from Server.outbound_queue import OutboundQueue
+from Server.stream_relay import StreamRelay
+from Tools.timer_wheel import Timer
+
+
+class Connection:
+    """Everything the server keeps for one client connection, released together when it's closed."""
+
+    def __init__(self, sock, address=None, outbound_queue: Optional[OutboundQueue] = None):
+        self.sock = sock
+        self.address = address
+        # the users bound to the connection, and the codec it negotiated
+        self.uids: set[str] = set()
+        self.codec: Optional[MessageCodec] = None
+        self.outbound_queue = outbound_queue
+        # the heartbeat and idle timer, and when the connection last received data and was sent a heartbeat
+        self.timer: Optional[Timer] = None
+        self.last_received = time.monotonic()
+        self.last_heartbeat = 0.0
+        # the streams that the connection sends through the server, by stream id
+        self.streams: dict[str, StreamRelay] = {}
+
+
+class ConnectionManager:
+    """The open connections of the server and the users bound to them.
+
+    Every structure of a connection hangs on its Connection, release() removes the connection and its users
+    under one lock, so a connection is torn down once whichever thread closes it, and nothing of it is left
+    behind when it's gone.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._connections: dict[object, Connection] = {}
+        self._uid_connections: dict[str, Connection] = {}
+
+    def __len__(self):
+        return len(self._connections)
+
+    @property
+    def online_count(self) -> int:
+        return len(self._uid_connections)
+
+    def open(self, sock, address=None, outbound_queue: Optional[OutboundQueue] = None) -> Connection:
+        connection = Connection(sock=sock, address=address, outbound_queue=outbound_queue)
+        with self._lock:
+            self._connections[sock] = connection
+        return connection
+
+    def get(self, sock) -> Optional[Connection]:
+        return self._connections.get(sock)
+
+    def connections(self) -> list[Connection]:
+        with self._lock:
+            return list(self._connections.values())
+
+    def bind(self, uid: str, sock) -> bool:
+        """Messages to the user go to the connection from now on, False if the connection is closed."""
+        with self._lock:
+            connection = self._connections.get(sock)
+            if connection is None:
+                return False
+            # the user moved from another connection
+            previous_connection = self._uid_connections.get(uid)
+            if previous_connection is not None and previous_connection is not connection:
+                previous_connection.uids.discard(uid)
+            self._uid_connections[uid] = connection
+            connection.uids.add(uid)
+            return True
+
+    def socket_of(self, uid: str):
+        connection = self._uid_connections.get(uid)
+        return connection.sock if connection else None
+
+    def uids_of(self, sock) -> list[str]:
+        connection = self._connections.get(sock)
+        return list(connection.uids) if connection else []
+
+    def codec_of(self, sock) -> Optional[MessageCodec]:
+        connection = self._connections.get(sock)
+        return connection.codec if connection else None
+
+    def release(self, sock) -> Optional[Connection]:
+        """Remove the connection and its users, None if it was already released."""
+        with self._lock:
+            connection = self._connections.pop(sock, None)
+            if connection is None:
+                return None
+            for uid in connection.uids:
+                if self._uid_connections.get(uid) is connection:
+                    del self._uid_connections[uid]
+        if connection.timer:
+            connection.timer.cancel()
+        return connection
+
+    def leaked_connections(self, is_closed: Callable[[object], bool]) -> int:
+        """Connections whose socket is closed but that were never released."""
+        return sum(1 for connection in self.connections() if is_closed(connection.sock))
+
+    def leaked_uids(self) -> int:
+        """Users bound to a connection that isn't open any more."""
+        with self._lock:
+            return sum(1 for connection in self._uid_connections.values()
+                       if self._connections.get(connection.sock) is not connection)
@@ -0,0 +1,318 @@
+import queue
+import threading
+from concurrent.futures import Future, ProcessPoolExecutor
+from typing import NamedTuple, Optional, Union
+
+from Tools.compression import CompressionsEnum, compress, decompress, get_compression
+from Tools.crypto_suites import CryptoSuitesEnum, SigningKey, get_suite
+from Tools.encryptors import EncryptorAES, EncryptorAESKey
+from Tools.lru_cache import LRUCache
+from Tools.tools import Tools
+from Utils.metrics import StageClock
+
+# the (stage, seconds) durations of a job's stages, see StageClock
+StageTimings = tuple[tuple[str, float], ...]
+
+
+class RelayJob(NamedTuple):
+    """Everything the crypto part of relaying a content message needs."""
+    sender_aes_key: EncryptorAESKey
+    recipient_aes_key: EncryptorAESKey
+    sender_public_key: SigningKey
+    # the suites of the sender's signature and of the signature the recipient expects from the server
+    sender_suite: CryptoSuitesEnum
+    recipient_suite: CryptoSuitesEnum
+    content: str
+    hmac: str
+    signature: str
+    # the compression flag of the content and the compression the recipient negotiated
+    compression: str = ""
+    recipient_compression: CompressionsEnum = CompressionsEnum.NONE
+
+
+class RelayResult(NamedTuple):
+    content: str = ""
+    hmac: str = ""
+    signature: str = ""
+    compression: str = ""
+    # empty if the job succeeded
+    error: str = ""
+    timings: StageTimings = ()
+
+
+def relay_crypto(job: RelayJob, server_private_keys: dict[CryptoSuitesEnum, SigningKey]) -> RelayResult:
+    """Verify the message of the sender and encrypt, authenticate and sign it again for the recipient."""
+    clock = StageClock()
+    # ------------- compare hmac --------------- #
+    hmac_valid = Tools.verify_hmac(key=job.sender_aes_key, content=job.content.encode(), hmac=job.hmac)
+    clock.lap("hmac_verify")
+    if not hmac_valid:
+        return RelayResult(error="The HMAC not identical", timings=tuple(clock.timings))
+
+    # ------------- varify signature ----------- #
+    try:
+        get_suite(job.sender_suite).verify(public_key=job.sender_public_key, signature=job.signature, hmac=job.hmac)
+    except (ValueError, TypeError):
+        clock.lap("signature_verify")
+        return RelayResult(error="Signature is invalid.", timings=tuple(clock.timings))
+    clock.lap("signature_verify")
+
+    # decrypt the content with sender's aes key and encrypt it with recipient's aes key
+    encryptor_aes = EncryptorAES()
+    decrypted_content = encryptor_aes.decrypt_bytes(key=job.sender_aes_key, content=job.content)
+    clock.lap("aes_decrypt")
+
+    # content that is already compressed the way the recipient expects is passed as is
+    compression = job.compression
+    if compression not in ("", job.recipient_compression):
+        try:
+            decrypted_content, compression = compress(decompress(decrypted_content, flag=compression),
+                                                      get_compression(job.recipient_compression))
+        except ValueError:
+            return RelayResult(error="The compressed content is invalid.", timings=tuple(clock.timings))
+        clock.lap("transcode")
+    encrypted_content = encryptor_aes.encrypt_bytes(key=job.recipient_aes_key, data=decrypted_content)
+    clock.lap("aes_encrypt")
+
+    # set a new hmac on encrypted_content and a new signature on hmac
+    hmac = Tools.generate_hmac(key=job.recipient_aes_key, content=encrypted_content.encode())
+    clock.lap("hmac_generate")
+    signature = get_suite(job.recipient_suite).sign(private_key=server_private_keys[job.recipient_suite], hmac=hmac)
+    clock.lap("sign")
+    return RelayResult(content=encrypted_content,
+                       hmac=hmac,
+                       signature=signature,
+                       compression=compression,
+                       timings=tuple(clock.timings))
+
+
+class GroupOpenJob(NamedTuple):
+    """Verify and decrypt a group message once, and sign it once for every suite of the members."""
+    uid: str
+    group_id: str
+    sender_aes_key: EncryptorAESKey
+    sender_public_key: SigningKey
+    sender_suite: CryptoSuitesEnum
+    content: str
+    hmac: str
+    signature: str
+    compression: str
+    signing_suites: tuple[CryptoSuitesEnum, ...]
+
+
+class GroupOpenResult(NamedTuple):
+    # the decrypted and decompressed content
+    data: bytes = b""
+    signatures: Optional[dict[CryptoSuitesEnum, str]] = None
+    error: str = ""
+    timings: StageTimings = ()
+
+
+class GroupRecipient(NamedTuple):
+    uid: str
+    aes_key: EncryptorAESKey
+    suite: CryptoSuitesEnum
+    compression: CompressionsEnum
+
+
+class GroupSealJob(NamedTuple):
+    """Encrypt and authenticate the decrypted content of a group message for some of its members."""
+    data: bytes
+    recipients: tuple[GroupRecipient, ...]
+
+
+class SealedContent(NamedTuple):
+    des_uid: str
+    # the suite of the server's signature the member expects
+    suite: CryptoSuitesEnum
+    content: str
+    hmac: str
+    compression: str
+
+
+class GroupSealResult(NamedTuple):
+    sealed: list[SealedContent]
+    timings: StageTimings = ()
+
+
+def open_group_message(job: GroupOpenJob,
+                       server_private_keys: dict[CryptoSuitesEnum, SigningKey]) -> GroupOpenResult:
+    clock = StageClock()
+    hmac_valid = Tools.verify_hmac(key=job.sender_aes_key, content=job.content.encode(), hmac=job.hmac)
+    clock.lap("hmac_verify")
+    if not hmac_valid:
+        return GroupOpenResult(error="The HMAC not identical", timings=tuple(clock.timings))
+
+    try:
+        get_suite(job.sender_suite).verify(public_key=job.sender_public_key, signature=job.signature, hmac=job.hmac)
+    except (ValueError, TypeError):
+        clock.lap("signature_verify")
+        return GroupOpenResult(error="Signature is invalid.", timings=tuple(clock.timings))
+    clock.lap("signature_verify")
+
+    try:
+        data = decompress(EncryptorAES().decrypt_bytes(key=job.sender_aes_key, content=job.content),
+                          flag=job.compression)
+        content = data.decode()
+    except ValueError:
+        return GroupOpenResult(error="The compressed content is invalid.", timings=tuple(clock.timings))
+    clock.lap("aes_decrypt")
+
+    # the members trust the server's signature, so one signature of the content serves all of them
+    fingerprint = Tools.group_fingerprint(uid=job.uid, group_id=job.group_id, content=content)
+    signatures = {suite: get_suite(suite).sign(private_key=server_private_keys[suite], hmac=fingerprint)
+                  for suite in job.signing_suites}
+    clock.lap("sign")
+    return GroupOpenResult(data=data, signatures=signatures, timings=tuple(clock.timings))
+
+
+def seal_group_message(job: GroupSealJob) -> GroupSealResult:
+    clock = StageClock()
+    encryptor_aes = EncryptorAES()
+    # the content is compressed once for every compression the members use
+    compressed: dict[CompressionsEnum, tuple[bytes, str]] = {}
+    for recipient in job.recipients:
+        if recipient.compression not in compressed:
+            compressed[recipient.compression] = compress(job.data, get_compression(recipient.compression))
+    clock.lap("compress")
+
+    sealed = []
+    for recipient in job.recipients:
+        data, compression = compressed[recipient.compression]
+        content = encryptor_aes.encrypt_bytes(key=recipient.aes_key, data=data)
+        hmac = Tools.generate_hmac(key=recipient.aes_key, content=content.encode())
+        sealed.append(SealedContent(des_uid=recipient.uid,
+                                    suite=recipient.suite,
+                                    content=content,
+                                    hmac=hmac,
+                                    compression=compression))
+    clock.lap("group_seal")
+    return GroupSealResult(sealed=sealed, timings=tuple(clock.timings))
+
+
+CryptoJob = Union[RelayJob, GroupOpenJob, GroupSealJob]
+
+
+def run_crypto_job(job: CryptoJob, server_private_keys: dict[CryptoSuitesEnum, SigningKey]):
+    """Run a job of any type, returns the result of the job's function."""
+    if isinstance(job, RelayJob):
+        return relay_crypto(job, server_private_keys=server_private_keys)
+    if isinstance(job, GroupOpenJob):
+        return open_group_message(job, server_private_keys=server_private_keys)
+    return seal_group_message(job)
+
+
+# state of a worker process, set by _init_worker
+_worker_private_keys: dict[CryptoSuitesEnum, SigningKey] = {}
+_worker_public_keys: Optional[LRUCache[str, SigningKey]] = None
+
+
+def _init_worker(private_keys: dict[CryptoSuitesEnum, SigningKey], public_key_cache_size: int):
+    global _worker_private_keys, _worker_public_keys
+    _worker_private_keys = private_keys
+    _worker_public_keys = LRUCache(max_size=public_key_cache_size)
+
+
+def _run_batch(jobs: list[CryptoJob]) -> list:
+    results = []
+    for job in jobs:
+        if isinstance(job, (RelayJob, GroupOpenJob)):
+            # the public key arrives as PEM only, import every key once per worker
+            public_key = _worker_public_keys.get(job.sender_public_key.str())
+            if public_key is None:
+                public_key = job.sender_public_key
+                _worker_public_keys.put(public_key.str(), public_key)
+            job = job._replace(sender_public_key=public_key)
+        results.append(run_crypto_job(job, _worker_private_keys))
+    return results
+
+
+class CryptoWorkerPool:
+    """Runs the relay crypto on a pool of processes, so it isn't limited to one core by the GIL.
+
+    Jobs are collected by a batching thread and sent to the workers in batches, to pay the inter process
+    overhead once per batch instead of once per message. Every job gets its own future, a connection that
+    waits on its futures in the order it submitted them gets the results back in the same order.
+    """
+
+    _CLOSE = object()
+
+    def __init__(self,
+                 server_private_keys: dict[CryptoSuitesEnum, SigningKey],
+                 workers: int,
+                 max_batch_size: int = 64,
+                 max_batch_delay: float = 0.001,
+                 public_key_cache_size: int = 10000):
+        self._executor = ProcessPoolExecutor(max_workers=workers,
+                                             initializer=_init_worker,
+                                             initargs=(server_private_keys, public_key_cache_size))
+        self._max_batch_size = max_batch_size
+        self._max_batch_delay = max_batch_delay
+        self._jobs: queue.Queue = queue.Queue()
+        # jobs that were submitted and aren't resolved yet
+        self._pending = 0
+        self._pending_lock = threading.Lock()
+
+        self._batcher = threading.Thread(target=self._batch_loop, name="crypto-pool-batcher")
+        self._batcher.daemon = True
+        self._batcher.start()
+
+    def submit(self, job: CryptoJob) -> Future:
+        """Return a future that is resolved with the result of the job (see run_crypto_job)."""
+        future = Future()
+        with self._pending_lock:
+            self._pending += 1
+        self._jobs.put((job, future))
+        return future
+
+    @property
+    def pending(self) -> int:
+        return self._pending
+
+    def close(self):
+        self._jobs.put(self._CLOSE)
+        self._batcher.join()
+        self._executor.shutdown()
+
+    def _batch_loop(self):
+        while True:
+            item = self._jobs.get()
+            if item is self._CLOSE:
+                return
+
+            # wait a little for more jobs to join the batch
+            batch = [item]
+            closing = False
+            while len(batch) < self._max_batch_size:
+                try:
+                    item = self._jobs.get(timeout=self._max_batch_delay)
+                except queue.Empty:
+                    break
+                if item is self._CLOSE:
+                    closing = True
+                    break
+                batch.append(item)
+
+            jobs = [job for job, _ in batch]
+            futures = [future for _, future in batch]
+            batch_future = self._executor.submit(_run_batch, jobs)
+            batch_future.add_done_callback(lambda done, futures=futures: self._resolve(done, futures))
+            batch_future.add_done_callback(lambda done, size=len(futures): self._batch_done(size))
+
+            if closing:
+                return
+
+    def _batch_done(self, size: int):
+        with self._pending_lock:
+            self._pending -= size
+
+    @staticmethod
+    def _resolve(batch_future: Future, futures: list[Future]):
+        error = batch_future.exception()
+        if error is not None:
+            for future in futures:
+                future.set_exception(error)
+            return
+
+        for future, result in zip(futures, batch_future.result()):
+            future.set_result(result)
@@ -0,0 +1,233 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from enum import Enum
+from typing import Callable, Optional
+
+from Server.DB.rows import PendingMessageTableRow
+from Server.DB.tables import PendingMessageTable
+from Tools.timer_wheel import Timer, TimerWheel
+
+
+# why a message left the mailbox without being delivered
+class MailboxDropReasonsEnum(str, Enum):
+    # it was in the mailbox longer than the ttl
+    EXPIRED = "expired"
+    # its delivery failed every time it was tried
+    NO_TRIES_LEFT = "no_tries_left"
+
+
+class OfflineMailbox:
+    """Store and forward queues of messages for users that are offline.
+
+    Every recipient has a FIFO queue. The queue is kept in the pending_message_table as long as the whole
+    mailbox holds less than max_messages_in_memory messages, after that the messages of a recipient are
+    appended to segment files on disk. Once a recipient has a message on disk all its newer messages go to
+    disk too, so draining memory first and then the segments keeps the FIFO order.
+
+    With a timer_wheel every message in memory is removed when its ttl is over, without it and for the messages
+    on disk the expired messages are dropped when they are drained. Either way on_expired is called with them, as
+    it is with a message that runs out of tries.
+
+    The sender of a recipient's messages holds delivery_lock(des_uid) from checking or draining the queue until
+    the messages are sent, otherwise a new message could overtake the ones that were just drained.
+    """
+
+    SEGMENT_SUFFIX = ".seg"
+    # the recipients share this many delivery locks
+    DELIVERY_LOCKS = 64
+
+    def __init__(self,
+                 pending_message_table: PendingMessageTable,
+                 spill_dir: Optional[str] = None,
+                 max_messages_in_memory: int = 10000,
+                 max_segment_bytes: int = 1024 * 1024,
+                 ttl: timedelta = timedelta(days=7),
+                 max_tries: int = 3,
+                 timer_wheel: Optional[TimerWheel] = None,
+                 on_expired: Optional[Callable[[PendingMessageTableRow, MailboxDropReasonsEnum], None]] = None):
+        self._table = pending_message_table
+        self._spill_dir = spill_dir
+        self._max_messages_in_memory = max_messages_in_memory
+        self._max_segment_bytes = max_segment_bytes
+        self._ttl = ttl
+        self._max_tries = max_tries
+        self._lock = threading.Lock()
+        # reentrant, delivering a message flushes the queue of its recipient with the lock already held
+        self._delivery_locks = [threading.RLock() for _ in range(self.DELIVERY_LOCKS)]
+        # recipients that currently have messages on disk
+        self._spilled_uids: set[str] = set()
+        # the expiry timers of the messages in memory, by message id
+        self._timer_wheel = timer_wheel
+        self._expiry_timers: dict[str, Timer] = {}
+        self._on_expired = on_expired
+
+        if self._timer_wheel is not None:
+            # the messages of a previous run
+            with self._lock:
+                for row in self._table.rows:
+                    self._schedule_expiry(row)
+
+        if self._spill_dir and os.path.isdir(self._spill_dir):
+            self._spilled_uids.update(self._read_spilled_uids())
+
+    def park(self, uid: str, des_uid: str, message: dict, remain_tries: Optional[int] = None,
+             timestamp: Optional[datetime] = None):
+        """Keep the message until the recipient is back online."""
+        row = PendingMessageTableRow(uid=uid,
+                                     des_uid=des_uid,
+                                     message=message,
+                                     timestamp=timestamp or datetime.now(),
+                                     remain_tries=self._max_tries if remain_tries is None else remain_tries)
+        with self._lock:
+            self._add(row)
+
+    def delivery_lock(self, des_uid: str) -> threading.RLock:
+        return self._delivery_locks[hash(des_uid) % len(self._delivery_locks)]
+
+    def has_messages(self, des_uid: str) -> bool:
+        return des_uid in self._spilled_uids or bool(self._table.find_by_field("des_uid", des_uid))
+
+    def drain(self, des_uid: str) -> list[PendingMessageTableRow]:
+        """Remove and return all the messages of the recipient in FIFO order, expired messages are dropped."""
+        with self._lock:
+            rows = self._take(des_uid)
+
+        live_rows = []
+        for row in rows:
+            if not self._is_expired(row):
+                live_rows.append(row)
+            elif self._on_expired:
+                self._on_expired(row, MailboxDropReasonsEnum.EXPIRED)
+        return live_rows
+
+    def retry(self, rows: list[PendingMessageTableRow]):
+        """Park again the messages of a recipient that couldn't be delivered, each until it runs out of tries.
+
+        The messages go back in front of the queue in their order, before the messages that were parked since
+        they were drained. The ones without tries left are passed to on_expired.
+        """
+        retried_rows = [PendingMessageTableRow(uid=row._uid,
+                                               des_uid=row.des_uid,
+                                               message=row.message,
+                                               timestamp=row.timestamp,
+                                               remain_tries=row.remain_tries - 1,
+                                               message_id=row.message_id)
+                        for row in rows if row.remain_tries > 1]
+        if retried_rows:
+            with self._lock:
+                for row in retried_rows + self._take(retried_rows[0].des_uid):
+                    self._add(row)
+
+        if self._on_expired:
+            for row in rows:
+                if row.remain_tries <= 1:
+                    self._on_expired(row, MailboxDropReasonsEnum.NO_TRIES_LEFT)
+
+    def purge_expired(self) -> int:
+        """Remove the expired messages that are kept in memory, return how many were removed."""
+        with self._lock:
+            expired_rows = [row for row in self._table.rows if self._is_expired(row)]
+            for row in expired_rows:
+                self._table.remove_row(row)
+                self._cancel_expiry(row)
+        return len(expired_rows)
+
+    def _add(self, row: PendingMessageTableRow):
+        if row.des_uid in self._spilled_uids or len(self._table) >= self._max_messages_in_memory:
+            self._spill(row)
+        else:
+            self._table.add_row(row)
+            self._schedule_expiry(row)
+
+    def _take(self, des_uid: str) -> list[PendingMessageTableRow]:
+        """Remove all the messages of the recipient, memory first and then the segments."""
+        rows = self._table.find_by_field("des_uid", des_uid)
+        for row in rows:
+            self._table.remove_row(row)
+            self._cancel_expiry(row)
+        if des_uid in self._spilled_uids:
+            rows.extend(self._read_segments(des_uid))
+            self._spilled_uids.discard(des_uid)
+        return rows
+
+    def _schedule_expiry(self, row: PendingMessageTableRow):
+        if self._timer_wheel is not None:
+            delay = (row.timestamp + self._ttl - datetime.now()).total_seconds()
+            self._expiry_timers[row.message_id] = self._timer_wheel.schedule(delay, self._expire, row.message_id)
+
+    def _cancel_expiry(self, row: PendingMessageTableRow):
+        timer = self._expiry_timers.pop(row.message_id, None)
+        if timer:
+            timer.cancel()
+
+    def _expire(self, message_id: str):
+        """Called by the timer wheel when the ttl of a message in memory is over."""
+        with self._lock:
+            # a message that was drained meanwhile has no timer
+            if self._expiry_timers.pop(message_id, None) is None:
+                return
+            row = self._table.find_by_uid(message_id)
+            if row is None:
+                return
+            self._table.remove_row(row)
+        if self._on_expired:
+            self._on_expired(row, MailboxDropReasonsEnum.EXPIRED)
+
+    def _is_expired(self, row: PendingMessageTableRow) -> bool:
+        return datetime.now() - row.timestamp > self._ttl
+
+    def _recipient_dir(self, des_uid: str) -> str:
+        # the uid is a phone number typed by the user, hash it to get a safe directory name
+        return os.path.join(self._get_spill_dir(), hashlib.sha256(des_uid.encode()).hexdigest())
+
+    def _get_spill_dir(self) -> str:
+        if not self._spill_dir:
+            self._spill_dir = tempfile.mkdtemp(prefix="chat_sjenko_mailbox_")
+        return self._spill_dir
+
+    def _segments(self, recipient_dir: str) -> list[str]:
+        return sorted(name for name in os.listdir(recipient_dir) if name.endswith(self.SEGMENT_SUFFIX))
+
+    def _spill(self, row: PendingMessageTableRow):
+        recipient_dir = self._recipient_dir(row.des_uid)
+        os.makedirs(recipient_dir, exist_ok=True)
+
+        # append to the last segment, start a new one when it's full
+        segments = self._segments(recipient_dir)
+        segment_number = int(segments[-1][:-len(self.SEGMENT_SUFFIX)]) if segments else 0
+        segment_path = os.path.join(recipient_dir, f"{segment_number:08d}{self.SEGMENT_SUFFIX}")
+        if os.path.exists(segment_path) and os.path.getsize(segment_path) >= self._max_segment_bytes:
+            segment_path = os.path.join(recipient_dir, f"{segment_number + 1:08d}{self.SEGMENT_SUFFIX}")
+
+        with open(segment_path, "a", encoding="utf-8") as segment_file:
+            segment_file.write(json.dumps(row.to_dict()) + "\n")
+        self._spilled_uids.add(row.des_uid)
+
+    def _read_segments(self, des_uid: str) -> list[PendingMessageTableRow]:
+        recipient_dir = self._recipient_dir(des_uid)
+        if not os.path.isdir(recipient_dir):
+            return []
+
+        rows = []
+        for segment in self._segments(recipient_dir):
+            segment_path = os.path.join(recipient_dir, segment)
+            with open(segment_path, encoding="utf-8") as segment_file:
+                rows.extend(PendingMessageTableRow.from_dict(json.loads(line)) for line in segment_file if line.strip())
+            os.remove(segment_path)
+        os.rmdir(recipient_dir)
+        return rows
+
+    def _read_spilled_uids(self) -> set[str]:
+        """Find the recipients that have segments left from a previous run."""
+        uids = set()
+        for recipient_dir in os.listdir(self._spill_dir):
+            path = os.path.join(self._spill_dir, recipient_dir)
+            segments = self._segments(path) if os.path.isdir(path) else []
+            if segments:
+                with open(os.path.join(path, segments[0]), encoding="utf-8") as segment_file:
+                    uids.add(json.loads(segment_file.readline())["des_uid"])
+        return uids
@@ -0,0 +1,100 @@
+import multiprocessing
+import os
+import shutil
+import signal
+import sys
+import tempfile
+from typing import Optional
+
+from Server.uid_directory import FileUidDirectory
+from Server.worker_bus import WorkerBus
+from Utils.internal_logger import configure_logging
+
+
+def run_worker(worker_id: int,
+               workers: int,
+               bus_dir: str,
+               mode: str,
+               host: str,
+               port: int,
+               runner_arguments: dict,
+               logging_arguments: dict):
+    """Entry point of a worker process."""
+    configure_logging(**logging_arguments)
+    exit_on_terminate()
+
+    runner_arguments = dict(runner_arguments)
+    # every worker spills its own mailbox and serves its own metrics
+    if runner_arguments.get("mailbox_dir"):
+        runner_arguments["mailbox_dir"] = os.path.join(runner_arguments["mailbox_dir"], f"worker-{worker_id}")
+    if runner_arguments.get("admin_port") is not None:
+        runner_arguments["admin_port"] += worker_id
+
+    runner_arguments.update(peer_bus=WorkerBus(worker_id=worker_id, workers=workers, bus_dir=bus_dir),
+                            uid_directory=FileUidDirectory(uid_directory_path(bus_dir)),
+                            reuse_port=True)
+    if mode == "asyncio":
+        from Server.async_server_runner import AsyncServerRunner
+        runner = AsyncServerRunner(**runner_arguments)
+    else:
+        from Server.server_runner import ServerRunner
+        runner = ServerRunner(**runner_arguments)
+    try:
+        runner.start(host=host, port=port)
+    except KeyboardInterrupt:
+        pass
+
+
+def run_workers(workers: int,
+                mode: str = "threaded",
+                host: str = 'localhost',
+                port: int = 12345,
+                runner_arguments: Optional[dict] = None,
+                logging_arguments: Optional[dict] = None):
+    """Run the server as worker processes that share the port with SO_REUSEPORT, until they exit.
+
+    A single process runs the handlers on one core at a time (the GIL), the workers run them on all the cores.
+    The workers pass each other the changes of the registrations, keys and groups, and the messages of the users
+    connected to another worker, over Unix sockets in a temporary directory, where they also share the directory
+    of the users' workers. They must all have the same server keys, without a keys_dir in the runner_arguments the
+    keys are created here in that directory.
+    """
+    from Server.server_runner import ServerRunner
+
+    exit_on_terminate()
+    runner_arguments = dict(runner_arguments or {})
+    bus_dir = tempfile.mkdtemp(prefix="chat-workers-")
+    try:
+        if not runner_arguments.get("keys_dir"):
+            runner_arguments["keys_dir"] = os.path.join(bus_dir, "keys")
+        ServerRunner(keys_dir=runner_arguments["keys_dir"]).create_keys()
+        # created before the workers, so they don't race to create its table
+        FileUidDirectory(uid_directory_path(bus_dir)).close()
+
+        context = multiprocessing.get_context("spawn")
+        processes = [context.Process(target=run_worker,
+                                     name=f"chat-worker-{worker_id}",
+                                     args=(worker_id, workers, bus_dir, mode, host, port,
+                                           runner_arguments, logging_arguments or {}))
+                     for worker_id in range(workers)]
+        for process in processes:
+            process.start()
+        try:
+            for process in processes:
+                process.join()
+        finally:
+            for process in processes:
+                if process.is_alive():
+                    process.terminate()
+                process.join()
+    finally:
+        shutil.rmtree(bus_dir, ignore_errors=True)
+
+
+def uid_directory_path(bus_dir: str) -> str:
+    return os.path.join(bus_dir, "uid_directory.db")
+
+
+def exit_on_terminate():
+    """Exit on SIGTERM like on Ctrl+C, the finally blocks stop the workers and write the data base."""
+    signal.signal(signal.SIGTERM, lambda signal_number, frame: sys.exit(0))
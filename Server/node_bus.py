@@ -0,0 +1,56 @@
+import socket
+from typing import Optional
+
+from Server.peer_bus import PeerBus
+
+# the default connections to every other node
+DEFAULT_NODE_POOL_SIZE = 4
+
+
+def parse_nodes(value: str) -> dict[str, tuple[str, int]]:
+    """Parse 'a=10.0.0.1:7000,b=10.0.0.2:7000' to {node id: (host, port)} of the cluster's bus."""
+    nodes = {}
+    for item in value.split(","):
+        if not item:
+            continue
+        node_id, address = item.split("=", 1)
+        host, port = address.rsplit(":", 1)
+        nodes[node_id] = (host, int(port))
+    return nodes
+
+
+class NodeBus(PeerBus):
+    """The bus of the servers of a cluster, over TCP.
+
+    nodes has the bus address of every node of the cluster, this one too. Every node keeps a pool of persistent
+    connections to every other node. A node accepts only the nodes that answer its challenge with the secret,
+    but the messages themselves aren't encrypted or authenticated. The bus belongs on the cluster's private
+    network, or in a tunnel (WireGuard, stunnel) where the network between the nodes isn't trusted.
+    """
+
+    def __init__(self,
+                 node_id: str,
+                 nodes: dict[str, tuple[str, int]],
+                 pool_size: int = DEFAULT_NODE_POOL_SIZE,
+                 secret: Optional[str] = None):
+        if node_id not in nodes:
+            raise ValueError(f"The node {node_id} isn't one of the cluster's nodes {list(nodes)}.")
+        # anyone who reaches the port could pass itself off as a node, and change the registrations and keys
+        if not secret:
+            raise ValueError("The bus of a cluster needs a secret that all its nodes know.")
+        super().__init__(node_id=node_id, peers=list(nodes), pool_size=pool_size, secret=secret)
+        self._nodes = nodes
+
+    def create_listener(self) -> socket.socket:
+        listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        listener.bind(self._nodes[self.node_id])
+        listener.listen()
+        return listener
+
+    def create_connection(self, node_id: str) -> socket.socket:
+        connection = socket.create_connection(self._nodes[node_id], timeout=self.CONNECT_TIMEOUT)
+        connection.settimeout(None)
+        # the frames are small and every one is a message that someone waits for
+        connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return connection
@@ -0,0 +1,133 @@
+import threading
+from collections import deque
+from enum import Enum
+from typing import Callable
+
+
+# what the server does with a connection that doesn't read its messages fast enough
+class SlowConsumerPolicyEnum(str, Enum):
+    # messages for the connection go to the mailbox until its queue drains to the low watermark
+    PARK = "park"
+    # the connection is closed, its users get their messages in the mailbox once they reconnect
+    DISCONNECT = "disconnect"
+
+
+class OutboundQueue:
+    """The frames waiting to be written to one connection, written by a dedicated thread.
+
+    Senders only append to the queue, so a slow reader doesn't block the threads that relay to it and frames
+    of different senders never interleave. The writer sends everything that is queued with one vectored send.
+    Once more than high_watermark bytes are queued the connection is a slow consumer, put() refuses frames
+    and on_slow_consumer is called. When the queue drains to low_watermark on_drained is called. A sender that
+    can wait (the relay of a stream) waits for room with wait_for_room() instead of making the connection slow.
+    """
+
+    # buffers in one sendmsg call, IOV_MAX is 1024 on Linux
+    MAX_BUFFERS = 512
+
+    def __init__(self,
+                 sock,
+                 high_watermark: int,
+                 low_watermark: int,
+                 on_slow_consumer: Callable[[], None],
+                 on_drained: Callable[[], None]):
+        self._sock = sock
+        self._high_watermark = high_watermark
+        self._low_watermark = low_watermark
+        self._on_slow_consumer = on_slow_consumer
+        self._on_drained = on_drained
+        self._frames: deque[bytes] = deque()
+        self._queued_bytes = 0
+        self._slow = False
+        self._closed = False
+        lock = threading.Lock()
+        self._condition = threading.Condition(lock)
+        # notified when the writer sent frames, for the senders that wait for room in the queue
+        self._room = threading.Condition(lock)
+
+        self._writer = threading.Thread(target=self._write_loop, name="outbound-writer")
+        self._writer.daemon = True
+        self._writer.start()
+
+    @property
+    def is_slow(self) -> bool:
+        return self._slow
+
+    @property
+    def queued_bytes(self) -> int:
+        return self._queued_bytes
+
+    def put(self, frame: bytes) -> bool:
+        """Queue the frame, return False if the connection is closed or is a slow consumer."""
+        with self._condition:
+            if self._closed or self._slow:
+                return False
+            self._frames.append(frame)
+            self._queued_bytes += len(frame)
+            became_slow = self._queued_bytes > self._high_watermark
+            self._slow = became_slow
+            self._condition.notify()
+
+        if became_slow:
+            self._on_slow_consumer()
+        return True
+
+    def wait_for_room(self, timeout: float) -> bool:
+        """Wait until no more than low_watermark bytes are queued, False if it didn't happen in timeout seconds
+        or the connection is closed."""
+        with self._room:
+            self._room.wait_for(lambda: self._closed or self._queued_bytes <= self._low_watermark, timeout)
+            return not self._closed and self._queued_bytes <= self._low_watermark
+
+    def close(self):
+        """Stop the writer, frames that weren't written yet are dropped."""
+        with self._condition:
+            self._closed = True
+            self._frames.clear()
+            self._queued_bytes = 0
+            self._condition.notify()
+            self._room.notify_all()
+
+    def _write_loop(self):
+        while True:
+            with self._condition:
+                while not self._frames and not self._closed:
+                    self._condition.wait()
+                if self._closed:
+                    return
+                buffers = [self._frames.popleft() for _ in range(min(len(self._frames), self.MAX_BUFFERS))]
+
+            try:
+                self._send(buffers)
+            except OSError:
+                # the receiving side of the connection finds out it's closed and cleans it up
+                self.close()
+                return
+
+            with self._condition:
+                if self._closed:
+                    # close() already dropped the count of every queued frame, these included
+                    return
+                self._queued_bytes -= sum(len(buffer) for buffer in buffers)
+                drained = self._slow and self._queued_bytes <= self._low_watermark
+                if drained:
+                    self._slow = False
+                self._room.notify_all()
+
+            if drained:
+                self._on_drained()
+
+    def _send(self, buffers: list[bytes]):
+        if not hasattr(self._sock, "sendmsg"):
+            # no vectored send on this platform
+            self._sock.sendall(b"".join(buffers))
+            return
+
+        views = deque(memoryview(buffer) for buffer in buffers)
+        while views:
+            sent = self._sock.sendmsg(views)
+            # drop what was sent, a partial send leaves the end of a buffer
+            while views and sent >= len(views[0]):
+                sent -= len(views.popleft())
+            if sent:
+                views[0] = views[0][sent:]
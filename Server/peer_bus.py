@@ -0,0 +1,391 @@
+import hashlib
+import hmac
+import json
+import logging
+import secrets
+import select
+import socket
+import threading
+import time
+import zlib
+from abc import ABC, abstractmethod
+from collections import deque
+from typing import Callable, Iterable, Optional
+
+from Communication.framing import FrameDecoder, FrameTooLargeError, encode_frame
+from Utils.internal_logger import InternalLogger
+
+# what a node does with a message of another node: on_message(node_id, message)
+BusHandler = Callable[[str, dict], None]
+# the (key, message) pairs a node sends first on every new connection to another node
+BusSnapshot = Callable[[], Iterable[tuple[str, dict]]]
+
+
+class _PeerLink:
+    """One of the connections to a node, with the frames that wait for its sender thread."""
+
+    def __init__(self, node_id: str, slot: int):
+        self.node_id = node_id
+        self.slot = slot
+        self.connection: Optional[socket.socket] = None
+        # (frame, message) in the order they were sent
+        self.pending: deque[tuple[bytes, dict]] = deque()
+        self.condition = threading.Condition()
+        # the sequence number of the next frame, the node drops the frames it already got when they're sent again
+        self.next_seq = 1
+        # the node wasn't reachable for CONNECT_TIMEOUT, sends to it fail right away until it's reached again
+        self.down = False
+        # the instance of the node that got the snapshot last, and whether messages to it were refused since
+        self.peer_instance: Optional[str] = None
+        self.missed = False
+        self.thread: Optional[threading.Thread] = None
+
+
+class PeerBus(ABC):
+    """JSON messages between the nodes of a server, the workers of one machine or the servers of a cluster.
+
+    Every node listens for the other nodes and keeps pool_size connections to every other node, the messages of
+    the same key (e.g. the receiver's uid) always go over the same connection, so they arrive in the order they
+    were sent. A node that accepts a connection sends a nonce first, the node that connected answers with its id
+    and an HMAC of the nonce with the secret of the bus, the secret itself is never sent.
+
+    send only queues the message, every connection has its own sender thread that connects, reconnects with a
+    backoff and writes the queued frames, so the handlers never wait for another node. Frames that may have been
+    written before a connection failed are written again on the next one, every frame has a sequence number and
+    the node drops the ones it already got. A node that isn't reachable for CONNECT_TIMEOUT is down: the messages
+    that waited for it are passed to on_undelivered and sends to it return False until it's reached again. The
+    snapshot, e.g. the rows of the tables the nodes share, is sent right after connecting to a node that
+    restarted or that missed messages, so it catches up.
+    """
+
+    # how long the frames to a node wait for it to listen before it's down, the nodes may be started together
+    CONNECT_TIMEOUT = 10.0
+    # the first and the longest wait between the attempts to connect to a node
+    RECONNECT_BACKOFF = 0.05
+    MAX_RECONNECT_BACKOFF = 5.0
+    # frames that wait for a connection, a send beyond them fails like a send to a node that is down
+    MAX_PENDING_FRAMES = 10000
+    # frames of the snapshot in one write
+    SNAPSHOT_BATCH_SIZE = 256
+    # how long close lets the sender threads write the frames that were already queued
+    CLOSE_TIMEOUT = 1.0
+
+    def __init__(self, node_id: str, peers: list[str], pool_size: int = 1, secret: Optional[str] = None):
+        if pool_size <= 0:
+            raise ValueError("pool_size must be a positive number.")
+        self._logger = InternalLogger(logging_level=logging.DEBUG, name="Server.peer_bus")
+        self._node_id = node_id
+        self._peers = [peer_id for peer_id in peers if peer_id != node_id]
+        self._pool_size = pool_size
+        self._secret = secret
+        self._on_message: Optional[BusHandler] = None
+        self._on_undelivered: Optional[BusHandler] = None
+        self._snapshot: Optional[BusSnapshot] = None
+        self._listener: Optional[socket.socket] = None
+        # (node id, slot in the pool) -> connection that this node sends on
+        self._links: dict[tuple[str, int], _PeerLink] = {(peer_id, slot): _PeerLink(peer_id, slot)
+                                                          for peer_id in self._peers
+                                                          for slot in range(pool_size)}
+        self._closed = False
+        # wakes the sender threads that wait to connect again
+        self._closing = threading.Event()
+        # tells the other nodes that this node restarted, the sequence numbers of its frames start over
+        self._instance = secrets.token_hex(8)
+        # (node id, slot) -> (instance, sequence number) of the last frame received on that connection
+        self._received: dict[tuple[str, int], tuple[str, int]] = {}
+        self._received_lock = threading.Lock()
+
+    @property
+    def node_id(self) -> str:
+        return self._node_id
+
+    @property
+    def peers(self) -> list[str]:
+        return list(self._peers)
+
+    @abstractmethod
+    def create_listener(self) -> socket.socket:
+        """A bound and listening socket for the other nodes."""
+        pass
+
+    @abstractmethod
+    def create_connection(self, node_id: str) -> socket.socket:
+        """A socket connected to the node, raises OSError if the node doesn't listen."""
+        pass
+
+    def remove_listener(self):
+        """Release what the listener left behind, after it was closed."""
+        pass
+
+    def is_gone(self, error: OSError) -> bool:
+        """Whether the error of a connection attempt shows the node is down, without waiting CONNECT_TIMEOUT."""
+        return False
+
+    def start(self,
+              on_message: BusHandler,
+              on_undelivered: Optional[BusHandler] = None,
+              snapshot: Optional[BusSnapshot] = None):
+        """Listen for the other nodes and connect to them, the callbacks are called on the bus threads."""
+        self._on_message = on_message
+        self._on_undelivered = on_undelivered
+        self._snapshot = snapshot
+        self._listener = self.create_listener()
+
+        accept_thread = threading.Thread(target=self._accept_loop, name="peer-bus-accept")
+        accept_thread.daemon = True
+        accept_thread.start()
+
+        for link in self._links.values():
+            link.thread = threading.Thread(target=self._send_loop, args=(link,),
+                                           name=f"peer-bus-send-{link.node_id}-{link.slot}")
+            link.thread.daemon = True
+            link.thread.start()
+
+    def slot(self, key: str) -> int:
+        """The connection of the pool that the messages of the key go over."""
+        return zlib.crc32(key.encode()) % self._pool_size
+
+    def send(self, node_id: str, message: dict, key: str = "") -> bool:
+        """Queue the message to the node, return False if the node is down or too far behind."""
+        data = json.dumps(message)
+        link = self._links[(node_id, self.slot(key))]
+        with link.condition:
+            if self._closed:
+                return False
+            if link.down or len(link.pending) >= self.MAX_PENDING_FRAMES:
+                link.missed = True
+                return False
+            link.pending.append((self._encode(link.next_seq, data), message))
+            link.next_seq += 1
+            link.condition.notify()
+        return True
+
+    def broadcast(self, message: dict, key: str = ""):
+        for peer_id in self._peers:
+            self.send(peer_id, message, key=key)
+
+    def close(self):
+        self._closed = True
+        self._closing.set()
+        if self._listener is not None:
+            self._listener.close()
+            self.remove_listener()
+        for link in self._links.values():
+            with link.condition:
+                link.condition.notify()
+
+        # the frames that were queued before are sent, unless the node doesn't take them in time
+        deadline = time.monotonic() + self.CLOSE_TIMEOUT
+        for link in self._links.values():
+            if link.thread is not None:
+                link.thread.join(max(0.0, deadline - time.monotonic()))
+            connection = link.connection
+            if link.thread is not None and link.thread.is_alive() and connection is not None:
+                # unblocks the sender thread, which closes the connection
+                try:
+                    connection.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+
+    def _send_loop(self, link: _PeerLink):
+        failing_since: Optional[float] = None
+        backoff = self.RECONNECT_BACKOFF
+        while True:
+            if link.connection is None:
+                if self._closed:
+                    break
+                try:
+                    link.connection = self._connect(link)
+                except OSError as e:
+                    failing_since = failing_since or time.monotonic()
+                    if not link.down and (self.is_gone(e) or time.monotonic() - failing_since >= self.CONNECT_TIMEOUT):
+                        self._set_down(link, e)
+                    self._closing.wait(backoff)
+                    backoff = min(backoff * 2, self.MAX_RECONNECT_BACKOFF)
+                    continue
+                if link.down:
+                    self._logger.info("Node %s is reachable again.", link.node_id)
+                    with link.condition:
+                        link.down = False
+                failing_since = None
+                backoff = self.RECONNECT_BACKOFF
+
+            with link.condition:
+                while not link.pending and not self._closed:
+                    link.condition.wait()
+                if not link.pending:
+                    break
+                batch = list(link.pending)
+            try:
+                if self._is_closed_by_node(link.connection):
+                    raise ConnectionResetError("The node closed the connection.")
+                link.connection.sendall(b"".join(frame for frame, _ in batch))
+            except OSError as e:
+                # a node that restarted has a new listener, the frames are sent again on a new connection
+                if not self._closed:
+                    self._logger.warning("Lost the connection to node %s: %s", link.node_id, e)
+                link.connection.close()
+                link.connection = None
+                continue
+            with link.condition:
+                for _ in batch:
+                    link.pending.popleft()
+
+        if link.connection is not None:
+            link.connection.close()
+            link.connection = None
+
+    @staticmethod
+    def _is_closed_by_node(connection: socket.socket) -> bool:
+        """The node never writes on the connections to it, a readable one was closed, e.g. the node was killed.
+
+        The write would still succeed and the frames would be lost, they go on a new connection instead.
+        """
+        readable, _, _ = select.select([connection], [], [], 0)
+        if not readable:
+            return False
+        try:
+            return not connection.recv(1, socket.MSG_PEEK)
+        except OSError:
+            return True
+
+    @staticmethod
+    def _encode(seq: int, data: str) -> bytes:
+        """The frame of a message, data is its JSON. A seq of 0 is never dropped, e.g. the snapshot's messages."""
+        return encode_frame(f"[{seq},{data}]".encode())
+
+    def _proof(self, nonce: str, node_id: str, slot: int, instance: str) -> str:
+        """Shows that the node that connected knows the secret, for this nonce only."""
+        content = json.dumps([nonce, node_id, slot, instance]).encode()
+        return hmac.new((self._secret or "").encode(), content, hashlib.sha256).hexdigest()
+
+    @staticmethod
+    def _recv_frame(connection: socket.socket) -> bytes:
+        frame_decoder = FrameDecoder(initial_size=1024)
+        while True:
+            for frame in frame_decoder.frames():
+                return frame
+            if not frame_decoder.recv_from(connection):
+                raise ConnectionResetError("The node closed the connection.")
+
+    def _connect(self, link: _PeerLink) -> socket.socket:
+        """Connect to the node of the link and send the snapshot if the node needs it, raises OSError if the node
+        isn't reachable."""
+        connection = self.create_connection(link.node_id)
+        try:
+            connection.settimeout(self.CONNECT_TIMEOUT)
+            try:
+                challenge = json.loads(self._recv_frame(connection))
+                nonce, instance = str(challenge["nonce"]), str(challenge["instance"])
+            except (FrameTooLargeError, ValueError, KeyError, TypeError) as e:
+                raise ConnectionError(f"Invalid challenge from node {link.node_id}: {e}") from e
+            hello = {"node_id": self._node_id,
+                     "slot": link.slot,
+                     "instance": self._instance,
+                     "proof": self._proof(nonce, self._node_id, link.slot, self._instance)}
+            connection.sendall(encode_frame(json.dumps(hello).encode()))
+            connection.settimeout(None)
+
+            with link.condition:
+                needs_snapshot = link.missed or link.peer_instance != instance
+                link.missed = False
+            try:
+                if needs_snapshot:
+                    self._send_snapshot(connection, link)
+            except OSError:
+                with link.condition:
+                    link.missed = True
+                raise
+            link.peer_instance = instance
+        except OSError:
+            connection.close()
+            raise
+        return connection
+
+    def _send_snapshot(self, connection: socket.socket, link: _PeerLink):
+        # what the node may have missed goes before the new messages, over the connection of its key
+        if self._snapshot is None:
+            return
+        frames = []
+        for key, message in self._snapshot():
+            if self.slot(key) == link.slot:
+                frames.append(self._encode(0, json.dumps(message)))
+            if len(frames) >= self.SNAPSHOT_BATCH_SIZE:
+                connection.sendall(b"".join(frames))
+                frames.clear()
+        connection.sendall(b"".join(frames))
+
+    def _set_down(self, link: _PeerLink, error: OSError):
+        with link.condition:
+            link.down = True
+            link.missed = True
+            undelivered = [message for _, message in link.pending]
+            link.pending.clear()
+        self._logger.error("Node %s isn't reachable, %s messages to it weren't sent: %s",
+                           link.node_id, len(undelivered), error)
+        if self._on_undelivered is not None:
+            for message in undelivered:
+                self._call(self._on_undelivered, link.node_id, message)
+
+    def _accept_loop(self):
+        while not self._closed:
+            try:
+                connection, _ = self._listener.accept()
+            except OSError:
+                return
+            receive_thread = threading.Thread(target=self._receive_loop, args=(connection,), name="peer-bus-receive")
+            receive_thread.daemon = True
+            receive_thread.start()
+
+    def _receive_loop(self, connection: socket.socket):
+        frame_decoder = FrameDecoder()
+        nonce = secrets.token_hex(16)
+        node_id = None
+        # (node id, slot) of the connection and the instance of the node
+        link_key, instance = None, None
+        with connection:
+            try:
+                # a connection that doesn't answer the challenge in time doesn't keep the thread
+                connection.settimeout(self.CONNECT_TIMEOUT)
+                connection.sendall(encode_frame(json.dumps({"nonce": nonce, "instance": self._instance}).encode()))
+            except OSError:
+                return
+            while True:
+                try:
+                    if not frame_decoder.recv_from(connection):
+                        return
+                    for frame in frame_decoder.frames():
+                        message = json.loads(frame)
+                        if link_key is None:
+                            proof = self._proof(nonce, message["node_id"], message["slot"], message["instance"])
+                            if not hmac.compare_digest(str(message["proof"]).encode(), proof.encode()):
+                                self._logger.error("A node connected with a wrong secret.")
+                                return
+                            node_id, instance = message["node_id"], message["instance"]
+                            link_key = (node_id, message["slot"])
+                            connection.settimeout(None)
+                            continue
+                        seq, message = message
+                        if seq and not self._is_new(link_key, instance, seq):
+                            continue
+                        self._call(self._on_message, node_id, message)
+                except (OSError, FrameTooLargeError, ValueError, KeyError, TypeError) as e:
+                    if not self._closed:
+                        self._logger.error("Bus connection of node %s failed: %s", node_id, e)
+                    return
+
+    def _is_new(self, link_key: tuple[str, int], instance: str, seq: int) -> bool:
+        """False for a frame that was already received, the node wrote it again after a connection failed."""
+        with self._received_lock:
+            last_instance, last_seq = self._received.get(link_key, (None, 0))
+            if last_instance == instance and seq <= last_seq:
+                return False
+            self._received[link_key] = (instance, seq)
+            return True
+
+    def _call(self, handler: BusHandler, node_id: str, message: dict):
+        try:
+            handler(node_id, message)
+        except Exception:
+            # one bad message shouldn't cut the nodes apart
+            self._logger.exception("Failed to handle the bus message %s of node %s", message.get("type"), node_id)
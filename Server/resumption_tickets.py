@@ -0,0 +1,64 @@
+import json
+import time
+from typing import Optional
+
+from Crypto.Hash import HMAC, SHA256
+
+from Server.DB.rows import UserKeyTableRow
+from Tools.encryptors import EncryptorAES, EncryptorAESKey
+from Tools.tools import Tools
+
+
+class ResumptionTickets:
+    """Issues and opens the tickets that let a registered client bind a new connection without registering again.
+
+    A ticket is the uid, a fingerprint of the user's stored keys, the codec of the connection and the expiry time,
+    encrypted and HMACed with keys derived from a key that only the servers have. The client can't read or change
+    it, a ticket of keys that were replaced since it was issued doesn't open. The client proves that it's the
+    ticket's owner with a HMAC made with its session key, which the ticket doesn't hold.
+    """
+
+    SEPARATOR = "."
+    FIELDS = ("uid", "keys", "codec", "expires")
+
+    def __init__(self, key: EncryptorAESKey, lifetime: float):
+        # the cipher and the HMAC each get their own key, as in EncryptorAESStream
+        self._enc_key = self._subkey(key, b"enc")
+        self._mac_key = self._subkey(key, b"mac")
+        self._lifetime = lifetime
+
+    @staticmethod
+    def _subkey(key: EncryptorAESKey, label: bytes) -> EncryptorAESKey:
+        return EncryptorAESKey(HMAC.new(key.bytes(), label, digestmod=SHA256).digest())
+
+    @staticmethod
+    def keys_fingerprint(user_key_row: UserKeyTableRow) -> str:
+        return Tools.fingerprint(user_key_row.suite,
+                                 user_key_row.public_key,
+                                 user_key_row.encrypted_aes_key,
+                                 user_key_row.agreement_key)
+
+    def issue(self, uid: str, user_key_row: UserKeyTableRow, codec: str) -> tuple[str, float]:
+        """Return a new ticket of the user and its expiry time."""
+        expires = time.time() + self._lifetime
+        payload = json.dumps({"uid": uid,
+                              "keys": self.keys_fingerprint(user_key_row),
+                              "codec": codec,
+                              "expires": expires})
+        sealed = EncryptorAES().encrypt(key=self._enc_key, content=payload)
+        hmac = Tools.generate_hmac(key=self._mac_key, content=sealed.encode())
+        return f"{sealed}{self.SEPARATOR}{hmac}", expires
+
+    def open(self, ticket: str) -> Optional[dict]:
+        """The payload of the ticket, None if it wasn't issued with this key, it's malformed or it expired."""
+        sealed, _, hmac = ticket.partition(self.SEPARATOR)
+        if not hmac or not Tools.verify_hmac(key=self._mac_key, content=sealed.encode(), hmac=hmac):
+            return None
+        try:
+            payload = json.loads(EncryptorAES().decrypt(key=self._enc_key, content=sealed))
+            if not all(field in payload for field in self.FIELDS) or payload["expires"] < time.time():
+                return None
+        except (ValueError, KeyError, TypeError):
+            # e.g. a ticket of an older format that still verifies
+            return None
+        return payload
@@ -1,279 +1,1663 @@
+import argparse
+import base64
 import copy
-import json
 import logging
+import os
 import random
 import socket
 import threading
+import time
+from concurrent.futures import Future
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Callable, Optional
 
+from Communication.Messages.message_codecs import choose_codec, decode_message, get_codec, MessageDecodeError
 from Communication.Messages.messages import ClientRegistrationMessage, OptMessage, KeyMessage, ContentMessage, \
-    CommunicationMessageTypesEnum
+    CommunicationMessage, PublicKeyRequestMessage, PeerKeyMessage, SessionKeyMessage, GroupMessage, \
+    GroupContentMessage, AckMessage, HeartbeatMessage, ResumeMessage, TicketMessage, StreamStartMessage, \
+    StreamChunkMessage, StreamEndMessage, StreamErrorsEnum, RegistrationErrorsEnum, parse_message
 from Communication.communication_service import CommunicationService
+from Communication.framing import FrameDecoder, FrameTooLargeError
 from Server.DB.data_base import DataBase
-from Server.DB.rows import RegistrationTableRow, UserKeyTableRow
-from Tools.encryptors import EncryptorAES, EncryptorAESKey, EncryptorRSAKey, EncryptorRSA
+from Server.admin_server import AdminServer
+from Server.connection_manager import Connection, ConnectionManager
+from Server.DB.rows import RegistrationTableRow, UserKeyTableRow, GroupTableRow, PendingMessageTableRow
+from Server.DB.storage import ReplicatedStorage, SQLiteStorage
+from Server.DB.tables import GroupTable, RegistrationTable, UserKeyTable
+from Server.crypto_pool import CryptoWorkerPool, RelayJob, RelayResult, GroupOpenJob, GroupOpenResult, \
+    GroupRecipient, GroupSealJob, SealedContent, CryptoJob, StageTimings, run_crypto_job
+from Server.mailbox import MailboxDropReasonsEnum, OfflineMailbox
+from Server.outbound_queue import OutboundQueue, SlowConsumerPolicyEnum
+from Server.node_bus import DEFAULT_NODE_POOL_SIZE, NodeBus, parse_nodes
+from Server.peer_bus import PeerBus
+from Server.resumption_tickets import ResumptionTickets
+from Server.stream_relay import StreamRelay
+from Server.uid_directory import CachedUidDirectory, FileUidDirectory, UidDirectory
+from Tools.compression import choose_compression, get_compression
+from Tools.crypto_suites import CRYPTO_SUITES, CryptoSuitesEnum, SigningKey, choose_suite, get_suite
+from Tools.encryptors import EncryptorAESKey, EncryptorAESStream, EncryptorRSAKey, EncryptorRSA, EncryptorECCKey
+from Tools.lru_cache import LRUCache
+from Tools.timer_wheel import Timer, TimerWheel
 from Tools.tools import Tools
-from Utils.internal_logger import InternalLogger
+from Utils.internal_logger import InternalLogger, configure_logging
+from Utils.metrics import MetricsRegistry, StageClock
 
 class ServerRunner(CommunicationService):
     _logger: InternalLogger
 
-    def __init__(self):
-        self._logger = InternalLogger(logging_level=logging.DEBUG)
+    # the fewest members of a group that are encrypted for by one job of the crypto workers
+    GROUP_SEAL_CHUNK_SIZE = 64
+    # seconds between the client's time in a resume message and the server's time that are accepted
+    RESUME_MAX_SKEW = 60
+    # the pending messages that are sent together when the mailbox of a user is flushed
+    MAILBOX_FLUSH_BATCH = 256
+    # streams that one connection sends at the same time
+    MAX_STREAMS_PER_CONNECTION = 16
+
+    def __init__(self,
+                 session_key_cache_size: int = 10000,
+                 public_key_cache_size: int = 10000,
+                 db_path: Optional[str] = None,
+                 mailbox_dir: Optional[str] = None,
+                 crypto_workers: int = 0,
+                 outbound_high_watermark: int = 4 * 1024 * 1024,
+                 outbound_low_watermark: int = 1024 * 1024,
+                 slow_consumer_policy: SlowConsumerPolicyEnum = SlowConsumerPolicyEnum.PARK,
+                 keys_dir: Optional[str] = None,
+                 admin_port: Optional[int] = None,
+                 peer_bus: Optional[PeerBus] = None,
+                 uid_directory: Optional[UidDirectory] = None,
+                 reuse_port: bool = False,
+                 opt_timeout: float = 30,
+                 opt_resends: int = 3,
+                 registration_timeout: float = 120,
+                 heartbeat_interval: Optional[float] = 30,
+                 idle_timeout: Optional[float] = 90,
+                 ticket_lifetime: float = 7 * 24 * 3600,
+                 stream_room_timeout: float = 5):
+        self._logger = InternalLogger(logging_level=logging.DEBUG, name="Server.server_runner")
+        # with a keys_dir the server keeps its keys between runs, so the clients see the same server keys
+        self._keys_dir = keys_dir
         self._private_key: Optional[EncryptorRSAKey] = None
         self._public_key: Optional[EncryptorRSAKey] = None
-        self._clients: list[socket] = []
-        self._uid_socket: dict[str, socket] = {}
-        self._db = DataBase()
+        # the open connections with everything that is kept for them, and the users bound to them
+        self._connections = ConnectionManager()
+        # the receive loops that run, one for every connection
+        self._receive_loops = 0
+        # the frames waiting to be written to every connection, and what is done when too many wait
+        self._outbound_high_watermark = outbound_high_watermark
+        self._outbound_low_watermark = outbound_low_watermark
+        self._slow_consumer_policy = slow_consumer_policy
+        # the seconds a chunk waits for room in the receiver's outbound queue before the stream is ended, the
+        # connection of the stream's sender reads nothing else meanwhile
+        self._stream_room_timeout = stream_room_timeout
+        # with a peer_bus this server is one node of several, the workers of a multi-worker server or the servers
+        # of a cluster, the nodes see each other's registrations, keys and groups and pass each other the messages
+        # of the users that are connected to them. The uid_directory, that all the nodes share, has the node of
+        # every user, and its answers are cached here until the node of the user tells that it (dis)connected.
+        if peer_bus is not None and uid_directory is None:
+            raise ValueError("The nodes of a peer_bus need a uid_directory that they share.")
+        self._peer_bus = peer_bus
+        self._uid_directory: Optional[CachedUidDirectory] = CachedUidDirectory(uid_directory) if peer_bus else None
+        # the workers of a multi-worker server all listen on the same port
+        self._reuse_port = reuse_port
+        # with a db_path the registrations and keys survive a restart of the server
+        storage = SQLiteStorage(db_path) if db_path else None
+        if peer_bus is not None:
+            storage = ReplicatedStorage(publish=self.publish_change,
+                                        shared_tables=(UserKeyTable.TABLE_NAME,
+                                                       RegistrationTable.TABLE_NAME,
+                                                       GroupTable.TABLE_NAME),
+                                        storage=storage)
+        self._db = DataBase(storage=storage, node_id=peer_bus.node_id if peer_bus else None)
+        # the deadlines of the registrations, the mailbox and the idle connections, run by one thread
+        self._timer_wheel = TimerWheel()
+        # an OPT that isn't answered in opt_timeout seconds is sent again, up to opt_resends times, and a
+        # registration that isn't done in registration_timeout seconds is removed with its connection
+        self._opt_timeout = opt_timeout
+        self._opt_resends = opt_resends
+        self._registration_timeout = registration_timeout
+        self._opt_timers: dict[str, Timer] = {}
+        self._registration_timers: dict[str, Timer] = {}
+        # the receive threads and the timer wheel's thread both change the timers above
+        self._timers_lock = threading.Lock()
+        # a connection that receives nothing for heartbeat_interval seconds is sent a heartbeat, that the client
+        # answers, and one that receives nothing for idle_timeout seconds is closed, None turns them off
+        if heartbeat_interval and idle_timeout and idle_timeout <= heartbeat_interval:
+            raise ValueError("The idle_timeout must be longer than the heartbeat_interval.")
+        self._heartbeat_interval = heartbeat_interval
+        self._idle_timeout = idle_timeout
+        # a registered client binds a new connection with a ticket, that is good for ticket_lifetime seconds
+        self._ticket_lifetime = ticket_lifetime
+        self._tickets: Optional[ResumptionTickets] = None
+        # messages for users that are offline, delivered when they are back
+        self._mailbox = OfflineMailbox(self._db.pending_message_table,
+                                       spill_dir=mailbox_dir,
+                                       timer_wheel=self._timer_wheel,
+                                       on_expired=self.handle_expired_message)
+        # number of processes for the relay crypto, 0 runs it on the connection's own thread
+        self._crypto_workers = crypto_workers
+        self._crypto_pool: Optional[CryptoWorkerPool] = None
         self._lock: threading.Lock = threading.Lock()
+        # decrypted AES keys by uid, so relaying a message doesn't need RSA decryption of the stored keys
+        self._session_keys: LRUCache[str, EncryptorAESKey] = LRUCache(max_size=session_key_cache_size)
+        # imported public keys by uid, so verifying a signature doesn't parse the PEM again
+        self._public_keys: LRUCache[str, SigningKey] = LRUCache(max_size=public_key_cache_size)
+        # server's (private, public) keys of every suite
+        self._signing_keys: dict[CryptoSuitesEnum, tuple[SigningKey, SigningKey]] = {}
+        self._agreement_keys: dict[CryptoSuitesEnum, tuple[EncryptorECCKey, EncryptorECCKey]] = {}
+        self._server_private_keys: dict[CryptoSuitesEnum, SigningKey] = {}
+        # counters, gauges and latency histograms, served on the loopback admin_port if it's set
+        self._metrics = MetricsRegistry(prefix="chat_")
+        self._admin_port = admin_port
+        self._admin_server: Optional[AdminServer] = None
+        self.register_gauges()
+        self.schedule_stale_registrations()
 
     def handle_msg_receiving(self, sock, address):
-        self._logger.info(f"Server handle message from {address}")
+        self._logger.info("Server handle message from %s", address)
+        frame_decoder = FrameDecoder()
+        self.count_receive_loop(1)
 
-        while True:  # Continuous loop to keep receiving messages
-            try:
-                raw_data = sock.recv(1024)
-            except OSError as e:
-                self._logger.error(f"Socket error with client {address}: {e}")
-                break
-
-            if not raw_data:
-                self._logger.warning("Connection closed by the server")
-                self.cleanup_client(sock)
-            else:
-                message = json.loads(raw_data)
-                message_type = message.get("type")
-                data = message.get("data")
+        try:
+            while True:  # Continuous loop to keep receiving messages
+                try:
+                    received = frame_decoder.recv_from(sock)
+                except OSError as e:
+                    self._logger.error("Socket error with client %s: %s", address, e)
+                    break
+
+                if not received:
+                    self._logger.warning("Connection closed by the client")
+                    break
+
+                self.touch(sock)
+                try:
+                    for frame in frame_decoder.frames():
+                        self.dispatch_message(message=decode_message(frame), sock=sock)
+                except FrameTooLargeError as e:
+                    self._logger.error("Invalid frame from client %s: %s", address, e)
+                    break
+                except MessageDecodeError as e:
+                    self._logger.error("Invalid message from client %s: %s", address, e)
+                    break
+        finally:
+            # also when a handler failed, the connection is released whatever ended the loop
+            self.cleanup_client(sock)
+            self.count_receive_loop(-1)
+
+    def count_receive_loop(self, change: int):
+        with self._lock:
+            self._receive_loops += change
+
+    def dispatch_message(self, message: CommunicationMessage, sock):
+        """Route a decoded message to its handler, shared by the threaded and the asyncio servers."""
+        start = time.perf_counter()
+        try:
+            self.handle_message(message=message, sock=sock)
+        finally:
+            self.record_message(message=message, seconds=time.perf_counter() - start)
+
+    def handle_message(self, message: CommunicationMessage, sock):
+        if isinstance(message, ClientRegistrationMessage):
+            self.handle_client_registration_msg_receiving(client_reg_message=message, sock=sock)
+
+        if isinstance(message, OptMessage):
+            self.handle_opt_msg_receiving(opt_message=message, sock=sock)
+
+        if isinstance(message, KeyMessage):
+            self.handle_key_msg_receiving(key_message=message, sock=sock)
+
+        if isinstance(message, ContentMessage):
+            self.handle_content_message(content_message=message, sock=sock)
 
-                if message_type == CommunicationMessageTypesEnum.CLIENT_REGISTRATION_MESSAGE:
-                    client_reg_message = ClientRegistrationMessage(**data)
-                    self.handle_client_registration_msg_receiving(client_reg_message=client_reg_message, sock=sock)
+        if isinstance(message, PublicKeyRequestMessage):
+            self.handle_public_key_request_msg(public_key_request_message=message, sock=sock)
 
-                if message_type == CommunicationMessageTypesEnum.OPT_MESSAGE:
-                    opt_message = OptMessage(**data)
-                    self.handle_opt_msg_receiving(opt_message=opt_message, sock=sock)
+        if isinstance(message, SessionKeyMessage):
+            self.handle_session_key_msg(session_key_message=message, sock=sock)
 
-                if message_type == CommunicationMessageTypesEnum.KEY_MESSAGE:
-                    key_message = KeyMessage(**data)
-                    self.handle_key_msg_receiving(key_message=key_message)
+        if isinstance(message, GroupMessage):
+            self.handle_group_msg(group_message=message, sock=sock)
 
-                if message_type == CommunicationMessageTypesEnum.CONTENT_MESSAGE:
-                    content_message = ContentMessage(**data)
-                    self.handle_content_message(content_message=content_message)
+        if isinstance(message, GroupContentMessage):
+            self.handle_group_content_message(group_content_message=message, sock=sock)
+
+        if isinstance(message, HeartbeatMessage):
+            self.handle_heartbeat_msg(heartbeat_message=message, sock=sock)
+
+        if isinstance(message, ResumeMessage):
+            self.handle_resume_msg(resume_message=message, sock=sock)
+
+        if isinstance(message, StreamStartMessage):
+            self.handle_stream_start_msg(stream_start_message=message, sock=sock)
+
+        if isinstance(message, StreamChunkMessage):
+            self.handle_stream_chunk_msg(stream_chunk_message=message, sock=sock)
+
+        if isinstance(message, StreamEndMessage):
+            self.handle_stream_end_msg(stream_end_message=message, sock=sock)
 
     def handle_client_registration_msg_receiving(self, client_reg_message: ClientRegistrationMessage, sock: socket):
-        self._logger.info(f"Received Client Registration msg {client_reg_message}")
-        # bind the socket to the uid
-        self._uid_socket[client_reg_message.uid] = sock
+        self._logger.info("Received Client Registration msg %s", client_reg_message)
+        # the client's public key belongs to the first suite it offers
+        suite = choose_suite(client_reg_message.suites)
+        if suite is None:
+            self._logger.error("None of the suites %s is supported.", client_reg_message.suites)
+            return
+
+        # send with the best codec the client can decode
+        connection = self._connections.get(sock)
+        if connection is not None:
+            connection.codec = choose_codec(client_reg_message.codecs)
+        compression = choose_compression(client_reg_message.compressions)
+
+        # the uid is bound to this connection only once it's known to be new, binding first would take the
+        # connection of the registered user away from it
+        if self._db.registration_table.find_by_uid(client_reg_message.uid) \
+                or self._db.user_key_table.find_by_uid(client_reg_message.uid):
+            self._logger.error("This account already exists in data base: %s", client_reg_message.uid)
+            self.refuse_registration(uid=client_reg_message.uid, sock=sock,
+                                     error=RegistrationErrorsEnum.ACCOUNT_EXISTS)
+            return
 
         # add client to the registration_table
         success = self._db.registration_table.add_row(RegistrationTableRow(uid=client_reg_message.uid))
         if not success:
-            raise ValueError("This account already exists in data base")
+            self.refuse_registration(uid=client_reg_message.uid, sock=sock,
+                                     error=RegistrationErrorsEnum.ACCOUNT_EXISTS)
+            return
+        self._connections.bind(client_reg_message.uid, sock)
 
         # add client public key to the user_key_table
-        success = self._db.user_key_table.add_row(UserKeyTableRow(uid=client_reg_message.uid,
-                                                                  public_key=client_reg_message.public_key))
-        if not success:
-            raise ValueError("This user already exists in the data base")
+        self._db.user_key_table.add_row(UserKeyTableRow(uid=client_reg_message.uid,
+                                                        public_key=client_reg_message.public_key,
+                                                        suite=suite.NAME,
+                                                        compression=compression.NAME))
+        self._public_keys.invalidate(client_reg_message.uid)
 
         # update the registration_table with info that client provided the public key
-        registration_row = self._db.registration_table.find_by_uid(client_reg_message.uid)
-        registration_row.recieved_pub_key = True
-        self._db.registration_table.update_row(registration_row)
+        self._db.registration_table.update_fields(client_reg_message.uid, recieved_pub_key=True)
+
+        self.send_opt(uid=client_reg_message.uid, sock=sock)
+        self.start_registration_timers(uid=client_reg_message.uid, sock=sock)
+
+    def send_opt(self, uid: str, sock: socket):
+        # update the time of the opt before sending it, the client may answer before we return from sending
+        self._db.registration_table.update_fields(uid, opt_time=datetime.now(), sent_opt=True)
 
         # send to the client opt
         opt = str(random.randint(100000, 999999))
-        opt_message = OptMessage(uid=client_reg_message.uid, opt=str(opt))
-        self.send_by_secure_channel(sock=sock, content=opt_message.encode())
-
-        # update the time of the opt that sent
-        registration_row.opt_time = datetime.now()
-        registration_row.sent_opt = True
-        self._db.registration_table.update_row(registration_row)
+        opt_message = OptMessage(uid=uid, opt=str(opt))
+        self.send_by_secure_channel(sock=sock, content=self.encode_for(sock, opt_message))
 
     def handle_opt_msg_receiving(self, opt_message: OptMessage, sock: socket):
-        self._logger.info(f"Received OPT message {opt_message.opt}.")
+        self._logger.info("Received OPT message %s.", opt_message.opt)
         registration_row = self._db.registration_table.find_by_uid(opt_message.uid)
         if not registration_row:
             self._logger.error("Client not registered and sent OPT code!")
+            return
+        if self._connections.socket_of(opt_message.uid) is not sock:
+            self._logger.error("The OPT of %s came from a connection its registration didn't start on.",
+                               opt_message.uid)
+            return
 
-        if datetime.now() - registration_row.opt_time >= timedelta(seconds=30):
+        if datetime.now() - registration_row.opt_time >= timedelta(seconds=self._opt_timeout):
             self._logger.error("Time Limit reached for OPT,resending new opt to the client")
-
-            # send to the client opt
-            opt = str(random.randint(100000, 999999))
-            new_opt_message = OptMessage(uid=opt_message.uid, opt=str(opt))
-            self.send_msg(sock=sock, content=new_opt_message.encode())
-
-            # update the time of opt message sending
-            registration_row.opt_time = datetime.now()
-            self._db.registration_table.update_row(registration_row)
+            # the OPT timer sees the new opt_time and waits for the new OPT
+            self.send_opt(uid=opt_message.uid, sock=sock)
             return
 
         # update registration table that server received opt from client
-        registration_row.recieved_opt = True
-        self._db.registration_table.update_row(registration_row)
+        self._db.registration_table.update_fields(opt_message.uid, recieved_opt=True)
+        self.cancel_timer(self._opt_timers, opt_message.uid)
 
-        # send server public key
-        key_message = KeyMessage(uid=opt_message.uid, encrypted_key=self._public_key.str())
-        self.send_msg(sock=sock, content=key_message.encode())
+        # send server public key of the client's suite
+        user_key_row = self._db.user_key_table.find_by_uid(opt_message.uid)
+        suite = get_suite(user_key_row.suite)
+        key_message = KeyMessage(uid=opt_message.uid,
+                                 encrypted_key=self._signing_keys[suite.NAME][1].str(),
+                                 suite=suite.NAME,
+                                 codec=(self._connections.codec_of(sock) or get_codec(None)).NAME,
+                                 compression=get_compression(user_key_row.compression).NAME)
+        if suite.USES_KEY_AGREEMENT:
+            key_message.agreement_key = self._agreement_keys[suite.NAME][1].str()
+        self.send_msg(sock=sock, content=self.encode_for(sock, key_message))
 
-    def handle_key_msg_receiving(self, key_message: KeyMessage):
-        self._logger.info(f"Received Key Message {key_message.encrypted_key}")
+    def handle_key_msg_receiving(self, key_message: KeyMessage, sock):
+        self._logger.info("Received Key Message %s", key_message.encrypted_key)
 
         registration_row = self._db.registration_table.find_by_uid(key_message.uid)
         if not registration_row:
             self._logger.error("Client not registered and sent OPT code!")
+            return
+
+        # only the connection that registered the uid and answered its OPT sets the keys, once, anyone else would
+        # take the account over
+        if (self._connections.socket_of(key_message.uid) is not sock or not registration_row.recieved_opt
+                or registration_row.passed_registration):
+            self._logger.error("Refused the key message of %s, its registration isn't verified on this connection.",
+                               key_message.uid)
+            self.refuse_registration(uid=key_message.uid, sock=sock, error=RegistrationErrorsEnum.NOT_VERIFIED)
+            return
 
         # update registration table
-        registration_row.recieved_aes = True
-        registration_row.passed_registration = True
-        self._logger.info(f"Registration Row: {registration_row}")
-        self._db.registration_table.update_row(registration_row)
+        self._db.registration_table.update_fields(key_message.uid, recieved_aes=True, passed_registration=True)
+        self.cancel_timer(self._opt_timers, key_message.uid)
+        self.cancel_timer(self._registration_timers, key_message.uid)
+        self._logger.info("Registration Row: %s", self._db.registration_table.find_by_uid(key_message.uid))
 
         user_key_row = self._db.user_key_table.find_by_uid(key_message.uid)
         if not user_key_row:
             self._logger.error("The user doesn't have a row in user key database.")
+            return
+
+        # update user key row table, with a key agreement the client sends its public key instead of the AES key
+        if get_suite(user_key_row.suite).USES_KEY_AGREEMENT:
+            self._db.user_key_table.update_fields(key_message.uid, agreement_key=key_message.encrypted_key)
+        else:
+            self._db.user_key_table.update_fields(key_message.uid, encrypted_aes_key=key_message.encrypted_key)
+
+        # the cached session key was made from the previous key
+        self._session_keys.invalidate(key_message.uid)
+
+        # tell the client it's registered, messages to it are accepted from now on, and give it a ticket to
+        # resume the session on its next connections
+        ack_message = AckMessage(uid=key_message.uid, ack=AckMessage.key_ack(key_message.uid))
+        self.send_msg(sock=sock, content=self.encode_for(sock, ack_message))
+        self.send_ticket(uid=key_message.uid, sock=sock)
+
+        # the user can receive messages now, deliver whatever waited for it, also on the other nodes
+        self.flush_mailbox(key_message.uid)
+        self.publish_online(key_message.uid)
+
+    def refuse_registration(self, uid: str, sock, error: RegistrationErrorsEnum):
+        """Answer the registration of uid with an error in place of the ack of its keys."""
+        self._metrics.counter("registrations_refused_total", "Registrations the server refused.",
+                              error=error.value).inc()
+        ack_message = AckMessage(uid=uid, ack=AckMessage.key_ack(uid), error=error)
+        self.send_msg(sock=sock, content=self.encode_for(sock, ack_message))
 
-        # update user key row table
-        user_key_row.encrypted_aes_key = key_message.encrypted_key
-        self._db.user_key_table.update_row(user_key_row)
+    def handle_resume_msg(self, resume_message: ResumeMessage, sock):
+        """Bind the connection to a registered user that shows its ticket, in place of the whole registration."""
+        self._logger.info("Received Resume Message of %s", resume_message.uid)
+
+        def finish(ticket: Optional[dict]):
+            if ticket is None:
+                self._metrics.counter("resumptions_total", "Sessions resumed with a ticket.", result="rejected").inc()
+                self.send_msg(sock=sock, content=self.encode_for(sock, TicketMessage(uid=resume_message.uid,
+                                                                                     ticket="")))
+                return
+
+            connection = self._connections.get(sock)
+            if connection is not None:
+                connection.codec = get_codec(ticket["codec"])
+            self._connections.bind(resume_message.uid, sock)
+            self._metrics.counter("resumptions_total", "Sessions resumed with a ticket.", result="resumed").inc()
+            self.send_ticket(uid=resume_message.uid, sock=sock)
+
+            # the same as after the registration, the messages that waited for the user are delivered
+            self.flush_mailbox(resume_message.uid)
+            self.publish_online(resume_message.uid)
+
+        # the proof of the client is checked with its session key, on a cache miss the key is unwrapped first
+        self.run_blocking(sock, self.open_ticket, (resume_message,), finish)
+
+    def open_ticket(self, resume_message: ResumeMessage) -> Optional[dict]:
+        """The payload of the message's ticket, None if the ticket or the proof of the client isn't valid."""
+        uid = resume_message.uid
+        ticket = self._tickets.open(resume_message.ticket)
+        if ticket is None or ticket["uid"] != uid:
+            self._logger.warning("The ticket of %s is invalid or expired.", uid)
+            return None
+        user_key_row = self._db.user_key_table.find_by_uid(uid)
+        if not self.is_registered(uid) or not user_key_row \
+                or ticket["keys"] != ResumptionTickets.keys_fingerprint(user_key_row):
+            self._logger.warning("The keys of %s changed since its ticket was issued.", uid)
+            return None
+        # an old resume message that is sent again doesn't bind the connection
+        try:
+            skew = abs(time.time() - float(resume_message.timestamp))
+        except ValueError:
+            skew = float("inf")
+        if skew > self.RESUME_MAX_SKEW:
+            self._logger.warning("The resume message of %s is %s seconds off.", uid, skew)
+            return None
+        fingerprint = Tools.resumption_fingerprint(uid, resume_message.ticket, resume_message.timestamp)
+        if not Tools.verify_hmac(key=self.get_session_key(uid), content=fingerprint.encode(), hmac=resume_message.hmac):
+            self._logger.warning("The resume message of %s isn't signed with its session key.", uid)
+            return None
+        return ticket
+
+    def run_blocking(self, sock, function, args: tuple, finish):
+        """Call finish with the result of function(*args), crypto of a handler that takes a while.
+
+        The threaded server runs it on the receive thread of sock, the asyncio server runs it off the loop
+        and reads the next message of sock once finish was called.
+        """
+        finish(function(*args))
+
+    def send_ticket(self, uid: str, sock):
+        user_key_row = self._db.user_key_table.find_by_uid(uid)
+        codec = self._connections.codec_of(sock) or get_codec(None)
+        ticket, expires = self._tickets.issue(uid=uid, user_key_row=user_key_row, codec=codec.NAME)
+        self.send_msg(sock=sock, content=self.encode_for(sock, TicketMessage(uid=uid, ticket=ticket,
+                                                                             expires=str(expires))))
+
+    def handle_content_message(self, content_message: ContentMessage, sock=None):
+        self._logger.sampled(logging.INFO, "Server received message %s", content_message)
+        if content_message.e2e:
+            self.pass_through(content_message=content_message, sock=sock)
+            return
+
+        job = self.prepare_relay(content_message=content_message, sock=sock)
+        if job is None:
+            return
 
-    def handle_content_message(self, content_message: ContentMessage):
-        self._logger.info(f"Server received message {content_message}")
+        # verify, decrypt, encrypt for the receiver and sign, on the worker pool if there is one
+        self.finish_relay(content_message=content_message, result=self.run_crypto(job))
+
+    def run_crypto(self, job: CryptoJob):
+        """Run the job on the worker pool if there is one, or on this thread, and return its result."""
+        if self._crypto_pool:
+            return self.submit_crypto(job).result()
+        start = time.perf_counter()
+        result = run_crypto_job(job, server_private_keys=self._server_private_keys)
+        self.record_crypto(job=job, timings=result.timings, seconds=time.perf_counter() - start)
+        return result
+
+    def submit_crypto(self, job: CryptoJob) -> Future:
+        """Submit the job to the worker pool, its time is recorded when it's done."""
+        start = time.perf_counter()
+
+        def record(done: Future):
+            if done.exception() is None:
+                self.record_crypto(job=job, timings=done.result().timings, seconds=time.perf_counter() - start)
+
+        future = self._crypto_pool.submit(job)
+        future.add_done_callback(record)
+        return future
+
+    def prepare_relay(self, content_message: ContentMessage, sock) -> Optional[RelayJob]:
+        """Check both sides are registered and collect their keys, None if the message can't be relayed."""
+        # before any crypto, a connection relays only the messages of the uid that it registered
+        if not self.is_sender_authenticated(uid=content_message.uid, sock=sock):
+            self._logger.error("Client with uid = %s isn't authenticated on this connection.", content_message.uid)
+            return None
+
+        clock = StageClock()
         # check if the user passed the registration
         registration_row_client_from = self._db.registration_table.find_by_uid(content_message.uid)
         registration_row_client_to = self._db.registration_table.find_by_uid(content_message.des_uid)
+        clock.lap("db_lookup")
 
         if not registration_row_client_from or not registration_row_client_from.passed_registration:
-            self._logger.error(f"Client with uid = {content_message.uid} not registered.")
-            return
+            self._logger.error("Client with uid = %s not registered.", content_message.uid)
+            return None
         if not registration_row_client_to or not registration_row_client_to.passed_registration:
-            self._logger.error(f"Client that message need to be delivered to with uid = "
-                               f"{content_message.des_uid} not registered.")
+            self._logger.error("Client that message need to be delivered to with uid = %s not registered.",
+                               content_message.des_uid)
+            return None
+
+        sender_key_row = self._db.user_key_table.find_by_uid(content_message.uid)
+        recipient_key_row = self._db.user_key_table.find_by_uid(content_message.des_uid)
+        clock.lap("db_lookup")
+        sender_aes_key = self.get_session_key(content_message.uid)
+        recipient_aes_key = self.get_session_key(content_message.des_uid)
+        clock.lap("session_key_lookup")
+        sender_public_key = self.get_public_key(content_message.uid)
+        clock.lap("public_key_lookup")
+        self.record_stages(clock.timings)
+
+        return RelayJob(sender_aes_key=sender_aes_key,
+                        recipient_aes_key=recipient_aes_key,
+                        sender_public_key=sender_public_key,
+                        sender_suite=get_suite(sender_key_row.suite).NAME,
+                        recipient_suite=get_suite(recipient_key_row.suite).NAME,
+                        content=content_message.content,
+                        hmac=content_message.hmac,
+                        signature=content_message.signature,
+                        compression=content_message.compression,
+                        recipient_compression=get_compression(recipient_key_row.compression).NAME)
+
+    def pass_through(self, content_message: ContentMessage, sock):
+        """Forward an e2e message as is, the server can't read it and the receiver verifies the sender."""
+        if not self.is_sender_authenticated(uid=content_message.uid, sock=sock):
+            self._logger.error("Client with uid = %s isn't authenticated on this connection.", content_message.uid)
+            return
+        if not self.is_registered(content_message.des_uid):
+            self._logger.error("Client that message need to be delivered to with uid = %s not registered.",
+                               content_message.des_uid)
+            return
+
+        self.deliver(des_uid=content_message.des_uid, message=content_message)
+
+    def handle_public_key_request_msg(self, public_key_request_message: PublicKeyRequestMessage, sock):
+        self._logger.info("Received public key request %s", public_key_request_message)
+        if not self.is_sender_authenticated(uid=public_key_request_message.uid, sock=sock):
+            self._logger.error("Client with uid = %s isn't authenticated on this connection.",
+                               public_key_request_message.uid)
+            return
+
+        def finish(peer_key_message: Optional[PeerKeyMessage]):
+            if peer_key_message is None:
+                self._logger.error("Client with uid = %s not registered.", public_key_request_message.peer_uid)
+                # an unsigned answer without keys tells the client there is no such peer
+                peer_key_message = PeerKeyMessage(uid=public_key_request_message.uid,
+                                                  peer_uid=public_key_request_message.peer_uid,
+                                                  suite="", public_key="", agreement_key="", signature="")
+            self.send_msg(sock=sock, content=self.encode_for(sock, peer_key_message))
+
+        self.run_blocking(sock, self.create_peer_key_message,
+                          (public_key_request_message.uid, public_key_request_message.peer_uid), finish)
+
+    def handle_session_key_msg(self, session_key_message: SessionKeyMessage, sock):
+        self._logger.info("Received session key message %s", session_key_message)
+        if not self.is_sender_authenticated(uid=session_key_message.uid, sock=sock):
+            self._logger.error("Client with uid = %s isn't authenticated on this connection.", session_key_message.uid)
+            return
+
+        def finish(peer_key_message: Optional[PeerKeyMessage]):
+            if peer_key_message is None:
+                self._logger.error("Client that message need to be delivered to with uid = %s not registered.",
+                                   session_key_message.des_uid)
+                return
+            self.deliver(des_uid=session_key_message.des_uid, message=peer_key_message)
+            self.deliver(des_uid=session_key_message.des_uid, message=session_key_message)
+
+        # the receiver needs the sender's public key to open and verify the session key, send it first
+        self.run_blocking(sock, self.create_peer_key_message, (session_key_message.des_uid, session_key_message.uid),
+                          finish)
+
+    def create_peer_key_message(self, uid: str, peer_uid: str) -> Optional[PeerKeyMessage]:
+        """The keys of peer_uid for uid, signed with the server's key of uid's suite, None if not registered."""
+        if not self.is_registered(peer_uid):
+            return None
+
+        peer_key_row = self._db.user_key_table.find_by_uid(peer_uid)
+        peer_key_message = PeerKeyMessage(uid=uid,
+                                          peer_uid=peer_uid,
+                                          suite=get_suite(peer_key_row.suite).NAME,
+                                          public_key=peer_key_row.public_key,
+                                          agreement_key=peer_key_row.agreement_key,
+                                          signature="",
+                                          compression=get_compression(peer_key_row.compression).NAME)
+        suite = get_suite(self._db.user_key_table.find_by_uid(uid).suite)
+        peer_key_message.signature = suite.sign(private_key=self._signing_keys[suite.NAME][0],
+                                                hmac=Tools.fingerprint(peer_key_message.peer_uid,
+                                                                       peer_key_message.suite,
+                                                                       peer_key_message.public_key,
+                                                                       peer_key_message.agreement_key,
+                                                                       peer_key_message.compression))
+        return peer_key_message
+
+    def handle_group_msg(self, group_message: GroupMessage, sock):
+        self._logger.info("Received group message %s", group_message)
+        if not self.is_sender_authenticated(uid=group_message.uid, sock=sock):
+            self._logger.error("Client with uid = %s isn't authenticated on this connection.", group_message.uid)
+            return
+
+        group_row = self._db.group_table.find_by_uid(group_message.group_id)
+        if group_row and group_row.owner_uid != group_message.uid:
+            self._logger.error("Only the owner of the group %s can change its members.", group_message.group_id)
+            return
+
+        # the owner is always a member, and every member is in the group once
+        members = list(dict.fromkeys([group_message.uid] + list(group_message.members)))
+        if group_row:
+            self._db.group_table.update_fields(group_message.group_id, members=members)
+        else:
+            self._db.group_table.add_row(GroupTableRow(uid=group_message.group_id,
+                                                       owner_uid=group_message.uid,
+                                                       members=members))
+
+        ack_message = AckMessage(uid=group_message.uid, ack=AckMessage.group_ack(group_message.group_id))
+        self.send_msg(sock=sock, content=self.encode_for(sock, ack_message))
+
+    def handle_group_content_message(self, group_content_message: GroupContentMessage, sock):
+        self._logger.sampled(logging.INFO, "Server received group message %s", group_content_message)
+        fan_out = self.prepare_group_fan_out(group_content_message=group_content_message, sock=sock)
+        if fan_out is None:
+            return
+        open_job, recipients = fan_out
+
+        # verify and decrypt once, then encrypt for the members in parallel on the worker pool if there is one
+        open_result = self.run_crypto(open_job)
+        if open_result.error:
+            self._logger.error(open_result.error)
+            self._metrics.counter("crypto_errors_total", "Messages rejected by the crypto checks.",
+                                  error=open_result.error).inc()
+            return
+        seal_jobs = self.split_group_seal_jobs(data=open_result.data, recipients=recipients)
+        if self._crypto_pool:
+            futures = [self.submit_crypto(job) for job in seal_jobs]
+            sealed = [content for future in futures for content in future.result().sealed]
+        else:
+            sealed = [content for job in seal_jobs for content in self.run_crypto(job).sealed]
+
+        self.finish_group_fan_out(group_content_message=group_content_message,
+                                  open_result=open_result,
+                                  sealed=sealed)
+
+    def prepare_group_fan_out(self,
+                              group_content_message: GroupContentMessage,
+                              sock) -> Optional[tuple[GroupOpenJob, list[GroupRecipient]]]:
+        """Check the sender and collect the keys of the sender and the members, None if there is nothing to send."""
+        uid = group_content_message.uid
+        if not self.is_sender_authenticated(uid=uid, sock=sock):
+            self._logger.error("Client with uid = %s isn't authenticated on this connection.", uid)
+            return None
+
+        group_row = self._db.group_table.find_by_uid(group_content_message.group_id)
+        if not group_row or uid not in group_row.members:
+            self._logger.error("Client with uid = %s isn't a member of %s.", uid, group_content_message.group_id)
+            return None
+
+        recipients = []
+        for member in group_row.members:
+            if member == uid:
+                continue
+            if not self.is_registered(member):
+                self._logger.warning("Member %s of %s not registered.", member, group_content_message.group_id)
+                continue
+            member_key_row = self._db.user_key_table.find_by_uid(member)
+            recipients.append(GroupRecipient(uid=member,
+                                             aes_key=self.get_session_key(member),
+                                             suite=get_suite(member_key_row.suite).NAME,
+                                             compression=get_compression(member_key_row.compression).NAME))
+        if not recipients:
+            return None
+
+        open_job = GroupOpenJob(uid=uid,
+                                group_id=group_content_message.group_id,
+                                sender_aes_key=self.get_session_key(uid),
+                                sender_public_key=self.get_public_key(uid),
+                                sender_suite=get_suite(self._db.user_key_table.find_by_uid(uid).suite).NAME,
+                                content=group_content_message.content,
+                                hmac=group_content_message.hmac,
+                                signature=group_content_message.signature,
+                                compression=group_content_message.compression,
+                                signing_suites=tuple(dict.fromkeys(recipient.suite for recipient in recipients)))
+        return open_job, recipients
+
+    def split_group_seal_jobs(self, data: bytes, recipients: list[GroupRecipient]) -> list[GroupSealJob]:
+        """One job for every worker, but not less than GROUP_SEAL_CHUNK_SIZE members in a job."""
+        chunk_size = len(recipients)
+        if self._crypto_pool:
+            chunk_size = max(self.GROUP_SEAL_CHUNK_SIZE, -(-len(recipients) // self._crypto_workers))
+        return [GroupSealJob(data=data, recipients=tuple(recipients[start:start + chunk_size]))
+                for start in range(0, len(recipients), chunk_size)]
+
+    def finish_group_fan_out(self,
+                             group_content_message: GroupContentMessage,
+                             open_result: GroupOpenResult,
+                             sealed: list[SealedContent]):
+        """Deliver the group message to every member, members that are offline get it in their mailbox."""
+        self._logger.info("Delivering group message of %s to %s members.", group_content_message.uid, len(sealed))
+        for sealed_content in sealed:
+            self.deliver(des_uid=sealed_content.des_uid,
+                         message=GroupContentMessage(uid=group_content_message.uid,
+                                                     group_id=group_content_message.group_id,
+                                                     des_uid=sealed_content.des_uid,
+                                                     content=sealed_content.content,
+                                                     hmac=sealed_content.hmac,
+                                                     signature=open_result.signatures[sealed_content.suite],
+                                                     compression=sealed_content.compression))
+
+    def handle_stream_start_msg(self, stream_start_message: StreamStartMessage, sock):
+        """Open the relay of a stream, its chunks are passed on to the receiver one by one as they arrive."""
+        self._logger.info("Received stream %s of %s", stream_start_message.stream_id, stream_start_message.uid)
+        connection = self._connections.get(sock)
+        if connection is None or not self.is_sender_authenticated(uid=stream_start_message.uid, sock=sock):
+            self._logger.error("Client with uid = %s isn't authenticated on this connection.",
+                               stream_start_message.uid)
+            return
+
+        if not self.is_registered(stream_start_message.des_uid):
+            error = StreamErrorsEnum.NOT_REGISTERED
+        elif stream_start_message.stream_id in connection.streams:
+            error = StreamErrorsEnum.INVALID
+        elif len(connection.streams) >= self.MAX_STREAMS_PER_CONNECTION:
+            error = StreamErrorsEnum.TOO_MANY_STREAMS
+        else:
+            relay, start_message = self.open_stream_relay(stream_start_message)
+            if relay is None:
+                error = StreamErrorsEnum.INVALID
+            elif not self.send_stream_message(des_uid=relay.des_uid, message=start_message):
+                # a stream is relayed to a receiver that is online, or not at all
+                error = StreamErrorsEnum.OFFLINE
+            else:
+                connection.streams[relay.stream_id] = relay
+                self._metrics.counter("streams_started_total", "Streams relayed to their receiver.").inc()
+                return
+
+        self._logger.warning("Stream %s of %s rejected: %s", stream_start_message.stream_id,
+                             stream_start_message.uid, error.value)
+        self._metrics.counter("streams_ended_total", "Streams that ended, by their error.", error=error.value).inc()
+        self.answer_stream(sock=sock, message=stream_start_message, error=error)
+
+    def open_stream_relay(self, stream_start_message: StreamStartMessage) -> tuple[Optional[StreamRelay],
+                                                                                  StreamStartMessage]:
+        """The relay of the stream and the start message for the receiver, None if the nonce is invalid."""
+        uid, des_uid, stream_id = stream_start_message.uid, stream_start_message.des_uid, stream_start_message.stream_id
+        if stream_start_message.e2e:
+            return StreamRelay(uid=uid, des_uid=des_uid, stream_id=stream_id), stream_start_message
+
+        # the receiver's chunks are the encryption of the payload with its own key and a nonce of the server
+        associated_data = Tools.stream_fingerprint(uid, des_uid, stream_id)
+        try:
+            opened = EncryptorAESStream(key=self.get_session_key(uid),
+                                        nonce=base64.b64decode(stream_start_message.nonce, validate=True),
+                                        associated_data=associated_data)
+        except ValueError as e:
+            self._logger.error("Invalid nonce of stream %s: %s", stream_id, e)
+            return None, stream_start_message
+        sealed = EncryptorAESStream(key=self.get_session_key(des_uid), associated_data=associated_data)
+        relay = StreamRelay(uid=uid,
+                            des_uid=des_uid,
+                            stream_id=stream_id,
+                            opened=opened,
+                            sealed=sealed,
+                            sender_suite=get_suite(self._db.user_key_table.find_by_uid(uid).suite),
+                            recipient_suite=get_suite(self._db.user_key_table.find_by_uid(des_uid).suite))
+
+        start_message = copy.copy(stream_start_message)
+        start_message.nonce = base64.b64encode(sealed.nonce).decode()
+        return relay, start_message
+
+    def handle_stream_chunk_msg(self, stream_chunk_message: StreamChunkMessage, sock):
+        connection = self._connections.get(sock)
+        relay = connection.streams.get(stream_chunk_message.stream_id) if connection else None
+        if relay is None or relay.uid != stream_chunk_message.uid:
+            # the stream was rejected or ended, its sender was told so and stops sending
+            self._logger.sampled(logging.WARNING, "Chunk of an unknown stream %s", stream_chunk_message.stream_id)
+            return
+
+        chunk_message = stream_chunk_message
+        try:
+            data = base64.b64decode(stream_chunk_message.data, validate=True)
+            if relay.opened is not None:
+                clock = StageClock()
+                data = relay.sealed.encrypt(relay.opened.decrypt(data))
+                clock.lap("stream_aes")
+                self.record_stages(clock.timings)
+        except ValueError as e:
+            self._logger.error("Invalid chunk of stream %s: %s", relay.stream_id, e)
+            self.drop_stream(sock=sock, message=stream_chunk_message, error=StreamErrorsEnum.INVALID)
+            return
+        if relay.opened is not None:
+            chunk_message = StreamChunkMessage(uid=relay.uid,
+                                               des_uid=relay.des_uid,
+                                               stream_id=relay.stream_id,
+                                               data=base64.b64encode(data).decode())
+
+        if not self.send_stream_message(des_uid=relay.des_uid, message=chunk_message):
+            self.drop_stream(sock=sock, message=stream_chunk_message, error=StreamErrorsEnum.DISCONNECTED)
+            return
+        relay.relayed_bytes += len(data)
+        self._metrics.counter("stream_bytes_total", "Bytes of the chunks of streams that were relayed.").inc(len(data))
+
+    def handle_stream_end_msg(self, stream_end_message: StreamEndMessage, sock):
+        connection = self._connections.get(sock)
+        relay = connection.streams.get(stream_end_message.stream_id) if connection else None
+        if relay is None or relay.uid != stream_end_message.uid:
+            self._logger.warning("End of an unknown stream %s", stream_end_message.stream_id)
+            return
+        del connection.streams[relay.stream_id]
+
+        if stream_end_message.error:
+            # the sender gave up on the stream
+            self.end_stream(relay=relay, error=StreamErrorsEnum.ABORTED)
             return
 
-        encryptor_aes = EncryptorAES()
-        encryptor_rsa = EncryptorRSA()
+        if relay.opened is None:
+            self.send_stream_end(relay=relay, sock=sock, stream_end_message=stream_end_message,
+                                 end_message=stream_end_message)
+            return
 
-        # decrypt the aes keys of the client's from and to
-        client_from_encrypted_aes_key = self._db.user_key_table.find_by_uid(content_message.uid).encrypted_aes_key
-        client_from_decrypted_aes_key = encryptor_rsa.decrypt(key=self._private_key,
-                                                              content=client_from_encrypted_aes_key)
-        client_from_aes_key = EncryptorAESKey(key=client_from_decrypted_aes_key)
+        def finish(end_message: Optional[StreamEndMessage]):
+            if end_message is None:
+                self.end_stream(relay=relay, error=StreamErrorsEnum.INVALID)
+                self.answer_stream(sock=sock, message=stream_end_message, error=StreamErrorsEnum.INVALID)
+                return
+            self.send_stream_end(relay=relay, sock=sock, stream_end_message=stream_end_message,
+                                 end_message=end_message)
 
-        client_to_encrypted_aes_key = self._db.user_key_table.find_by_uid(content_message.des_uid).encrypted_aes_key
-        client_to_decrypted_aes_key = encryptor_rsa.decrypt(key=self._private_key,
-                                                            content=client_to_encrypted_aes_key)
-        client_to_aes_key = EncryptorAESKey(key=client_to_decrypted_aes_key)
+        self.run_blocking(sock, self.seal_stream_end, (relay, stream_end_message), finish)
 
-        # ------------- compare hmac --------------- #
-        if not Tools.verify_hmac(key=client_from_aes_key,
-                                 content=content_message.content.encode(),
-                                 hmac=content_message.hmac):
-            self._logger.warning("The HMAC not identical")
+    def send_stream_end(self, relay: StreamRelay, sock, stream_end_message: StreamEndMessage,
+                        end_message: StreamEndMessage):
+        """Send the end of the stream to its receiver, and answer the sender whether it was delivered."""
+        if not self.send_stream_message(des_uid=relay.des_uid, message=end_message):
+            self._metrics.counter("streams_ended_total", "Streams that ended, by their error.",
+                                  error=StreamErrorsEnum.DISCONNECTED.value).inc()
+            self.answer_stream(sock=sock, message=stream_end_message, error=StreamErrorsEnum.DISCONNECTED)
             return
+        self._logger.info("Stream %s of %s delivered, %d bytes.", relay.stream_id, relay.uid, relay.relayed_bytes)
+        self._metrics.counter("streams_ended_total", "Streams that ended, by their error.", error="").inc()
+        self.answer_stream(sock=sock, message=stream_end_message)
 
-        # ------------- varify signature ----------- #
-        client_from_public_key = EncryptorRSAKey(self._db.user_key_table.find_by_uid(content_message.uid).public_key)
+    def seal_stream_end(self, relay: StreamRelay, stream_end_message: StreamEndMessage) -> Optional[StreamEndMessage]:
+        """Check the HMAC and the signature of the sender, and HMAC and sign the stream for the receiver."""
+        clock = StageClock()
+        if not relay.opened.verify(stream_end_message.hmac):
+            self._logger.error("The HMAC of stream %s isn't identical.", relay.stream_id)
+            return None
+        clock.lap("hmac_verify")
         try:
-            Tools.varify_signature(rsa_public_key=client_from_public_key,
-                                   signature=content_message.signature,
-                                   hmac=content_message.hmac)
-            self._logger.info("Signature is valid.")
+            relay.sender_suite.verify(public_key=self.get_public_key(relay.uid),
+                                      signature=stream_end_message.signature,
+                                      hmac=stream_end_message.hmac)
         except (ValueError, TypeError):
-            self._logger.error("Signature is invalid.")
+            self._logger.error("The signature of stream %s is invalid.", relay.stream_id)
+            return None
+        clock.lap("signature_verify")
+
+        hmac = relay.sealed.hexdigest()
+        signature = relay.recipient_suite.sign(private_key=self._server_private_keys[relay.recipient_suite.NAME],
+                                               hmac=hmac)
+        clock.lap("sign")
+        self.record_stages(clock.timings)
+        return StreamEndMessage(uid=relay.uid,
+                                des_uid=relay.des_uid,
+                                stream_id=relay.stream_id,
+                                hmac=hmac,
+                                signature=signature)
+
+    def drop_stream(self, sock, message: StreamChunkMessage, error: StreamErrorsEnum):
+        """End the stream of the chunk at both sides, its receiver is gone or doesn't take it, or the chunk is
+        invalid."""
+        connection = self._connections.get(sock)
+        relay = connection.streams.pop(message.stream_id, None) if connection else None
+        if relay is None:
             return
+        self._logger.warning("Stream %s of %s ended: %s", relay.stream_id, relay.uid, error.value)
+        self.end_stream(relay=relay, error=error)
+        self.answer_stream(sock=sock, message=message, error=error)
 
-        # first decrypt the content with client's aes key that sent the message
-        decrypted_content = encryptor_aes.decrypt(key=client_from_aes_key,
-                                                  content=content_message.content)
+    def end_stream(self, relay: StreamRelay, error: StreamErrorsEnum):
+        """End the stream at its receiver with the error, what it got of the stream is thrown away."""
+        self._metrics.counter("streams_ended_total", "Streams that ended, by their error.", error=error.value).inc()
+        self.send_stream_message(des_uid=relay.des_uid,
+                                 message=StreamEndMessage(uid=relay.uid,
+                                                          des_uid=relay.des_uid,
+                                                          stream_id=relay.stream_id,
+                                                          error=error))
 
-        # encrypt the content with aes_key of the client that the message will be delivered to
-        encrypted_content = encryptor_aes.encrypt(key=client_to_aes_key,
-                                                  content=decrypted_content)
+    def answer_stream(self, sock, message: CommunicationMessage, error: str = ""):
+        """Tell the sender of the stream of the message that it was delivered, or why not."""
+        answer = StreamEndMessage(uid=message.uid, des_uid=message.des_uid, stream_id=message.stream_id, error=error)
+        self.send_msg(sock=sock, content=self.encode_for(sock, answer))
 
-        # set a new hmac on encrypted_content
-        hmac = Tools.generate_hmac(key=client_to_aes_key,
-                                   content=encrypted_content.encode())
+    def send_stream_message(self, des_uid: str, message: CommunicationMessage, forward: bool = True) -> bool:
+        """Send a message of a stream to the user now, False if the user isn't connected.
 
-        # set a new signature on hmac
-        signature = Tools.create_signature(rsa_private_key=self._private_key,hmac=hmac)
+        The messages of a stream don't wait in the mailbox. A chunk waits while the user's connection has
+        more than the low watermark queued, that holds back the sender instead of queueing the stream.
+        """
+        sock = self._connections.socket_of(des_uid)
+        if sock is None:
+            return forward and self.forward_to_node(des_uid=des_uid, message=message.to_dict(), bus_type="stream")
+        if isinstance(message, StreamChunkMessage) and not self.wait_for_room(sock):
+            return False
+        return self.send_msg(sock=sock, content=self.encode_for(sock, message))
+
+    def wait_for_room(self, sock) -> bool:
+        """Wait until the connection's outbound queue is down to the low watermark, False if it didn't drain."""
+        connection = self._connections.get(sock)
+        if connection is None or connection.outbound_queue is None:
+            return True
+        with self._metrics.histogram("stage_seconds", stage="stream_wait").time():
+            return connection.outbound_queue.wait_for_room(self._stream_room_timeout)
+
+    def handle_stream_message_of_node(self, des_uid: str, message: CommunicationMessage):
+        """A message of a stream that another node passed on, between a user of it and a user of this node."""
+        if isinstance(message, StreamEndMessage) and message.uid == des_uid:
+            # the answer to the sender of a stream, that ends the stream if the receiver is gone
+            connection = self._connections.get(self._connections.socket_of(des_uid))
+            if message.error and connection is not None:
+                connection.streams.pop(message.stream_id, None)
+            self.send_stream_message(des_uid=des_uid, message=message, forward=False)
+            return
+
+        if not self.send_stream_message(des_uid=des_uid, message=message, forward=False) and \
+                not isinstance(message, StreamEndMessage):
+            # the receiver is gone, the node of the sender ends the stream
+            self.send_stream_message(des_uid=message.uid,
+                                     message=StreamEndMessage(uid=message.uid,
+                                                              des_uid=des_uid,
+                                                              stream_id=message.stream_id,
+                                                              error=StreamErrorsEnum.DISCONNECTED))
+
+    def is_registered(self, uid: str) -> bool:
+        registration_row = self._db.registration_table.find_by_uid(uid)
+        return bool(registration_row and registration_row.passed_registration)
+
+    def is_sender_authenticated(self, uid: str, sock) -> bool:
+        """A message is accepted from uid only on the connection uid registered on."""
+        return sock is not None and self._connections.socket_of(uid) is sock and self.is_registered(uid)
+
+    def finish_relay(self, content_message: ContentMessage, result: RelayResult):
+        """Deliver the message that the relay crypto produced to its receiver."""
+        if result.error:
+            self._logger.error(result.error)
+            self._metrics.counter("crypto_errors_total", "Messages rejected by the crypto checks.",
+                                  error=result.error).inc()
+            return
+        self._logger.sampled(logging.DEBUG, "Signature is valid.")
 
         # create a new message
-        new_content_message = copy.deepcopy(content_message)
-        new_content_message.content = encrypted_content
-        new_content_message.hmac = hmac
-        new_content_message.signature = signature
+        new_content_message = copy.copy(content_message)
+        new_content_message.content = result.content
+        new_content_message.hmac = result.hmac
+        new_content_message.signature = result.signature
+        new_content_message.compression = result.compression
+
+        # if both registered send message, or keep it until the receiver is online
+        self.deliver(des_uid=content_message.des_uid, message=new_content_message)
+
+    def deliver(self, des_uid: str, message: CommunicationMessage, forward: bool = True):
+        """Send the message to the user, park it in the mailbox if the user is offline.
+
+        A user that is connected to another node gets it through that node, unless forward is False (the
+        message came from another node, and isn't passed on again).
+        """
+        sock = self._connections.socket_of(des_uid)
+        if sock is None and forward and self.forward_to_node(des_uid=des_uid, message=message.to_dict()):
+            return
+
+        with self._mailbox.delivery_lock(des_uid):
+            # older messages are still waiting in the mailbox, keep the order by queueing behind them
+            if sock is not None and self._mailbox.has_messages(des_uid):
+                self._mailbox.park(uid=message.uid, des_uid=des_uid, message=message.to_dict())
+                self._metrics.counter("mailbox_parked_total", "Messages kept in the mailbox.").inc()
+                self.flush_mailbox(des_uid)
+                return
+
+            if sock is None or not self.send_msg(sock=sock, content=self.encode_for(sock, message)):
+                self._logger.info("Client %s is offline, keeping the message in the mailbox.", des_uid)
+                self._mailbox.park(uid=message.uid, des_uid=des_uid, message=message.to_dict())
+                self._metrics.counter("mailbox_parked_total", "Messages kept in the mailbox.").inc()
+
+    def flush_mailbox(self, uid: str):
+        """Send all the pending messages of the user, MAILBOX_FLUSH_BATCH messages per send."""
+        sock = self._connections.socket_of(uid)
+        if sock is None or not self._mailbox.has_messages(uid) or not self.can_send(sock):
+            return
 
-        # if both registered send message
-        self.send_msg(sock=self._uid_socket[content_message.des_uid],
-                      content=new_content_message.encode())
+        # a message that is delivered meanwhile waits until the drained ones were sent
+        with self._mailbox.delivery_lock(uid):
+            rows = self._mailbox.drain(uid)
+            if not rows:
+                return
+
+            self._logger.info("Delivering %s pending messages to %s", len(rows), uid)
+            for start in range(0, len(rows), self.MAILBOX_FLUSH_BATCH):
+                batch = rows[start:start + self.MAILBOX_FLUSH_BATCH]
+                content = b"".join(self.encode_for(sock, parse_message(row.message)) for row in batch)
+                if not self.send_msg(sock=sock, content=content):
+                    self._mailbox.retry(rows[start:])
+                    return
+                self._metrics.counter("mailbox_delivered_total",
+                                      "Messages delivered from the mailbox.").inc(len(batch))
+
+    def forward_to_node(self,
+                        des_uid: str,
+                        message: dict,
+                        node_id: Optional[str] = None,
+                        bus_type: str = "deliver") -> bool:
+        """Pass the message to the node that the user is connected to, False if it isn't on another node.
+
+        The node delivers a "deliver" message or keeps it in its mailbox, and sends a "stream" message now
+        or not at all.
+        """
+        if self._peer_bus is None:
+            return False
+        node_id = node_id or self._uid_directory.get_node(des_uid)
+        if node_id is None or node_id == self._peer_bus.node_id:
+            return False
+        # the messages to a user go over the same connection, in their order
+        if not self._peer_bus.send(node_id, {"type": bus_type, "des_uid": des_uid, "message": message}, key=des_uid):
+            return False
+        self._metrics.counter("forwarded_total", "Messages passed to the node of their receiver.").inc()
+        return True
+
+    def publish_change(self, table_name: str, uid: str, data: Optional[dict]):
+        """Send a change of a shared table to the other nodes."""
+        self._peer_bus.broadcast({"type": "change", "table": table_name, "uid": uid, "data": data}, key=uid)
+
+    def publish_online(self, uid: str):
+        if self._peer_bus is not None:
+            self._uid_directory.set_node(uid, self._peer_bus.node_id)
+            self._peer_bus.broadcast({"type": "online", "uid": uid}, key=uid)
+
+    def publish_offline(self, uid: str):
+        if self._peer_bus is not None:
+            self._uid_directory.remove_node(uid, self._peer_bus.node_id)
+            self._peer_bus.broadcast({"type": "offline", "uid": uid}, key=uid)
+
+    def on_bus_message(self, node_id: str, message: dict):
+        """Called on the bus threads with the messages of the other nodes."""
+        self.handle_bus_message(node_id=node_id, message=message)
+
+    def on_bus_undelivered(self, node_id: str, message: dict):
+        """Called on the bus threads with the messages that weren't sent since their node is down."""
+        self.handle_bus_undelivered(node_id=node_id, message=message)
+
+    def handle_bus_undelivered(self, node_id: str, message: dict):
+        if message["type"] == "deliver":
+            # the message waits here until its receiver connects again
+            self.deliver(des_uid=message["des_uid"], message=parse_message(message["message"]), forward=False)
+
+        elif message["type"] == "stream":
+            # the streams don't wait, a stream of a user of this node to a user of the node that is down ends
+            stream_message = parse_message(message["message"])
+            connection = self._connections.get(self._connections.socket_of(stream_message.uid))
+            if stream_message.uid != message["des_uid"] and connection is not None \
+                    and connection.streams.pop(stream_message.stream_id, None) is not None:
+                self._metrics.counter("streams_ended_total", "Streams that ended, by their error.",
+                                      error=StreamErrorsEnum.DISCONNECTED.value).inc()
+                self.answer_stream(sock=connection.sock, message=stream_message, error=StreamErrorsEnum.DISCONNECTED)
+
+    def bus_snapshot(self):
+        """The rows of the shared tables, sent to another node on every new connection, by the uid of the row.
+
+        A node that restarted or was unreachable gets the changes it missed, rows that were removed meanwhile
+        aren't removed on it.
+        """
+        for table in self._db.shared_tables:
+            for row in table.rows:
+                yield row._uid, {"type": "change", "table": table.TABLE_NAME, "uid": row._uid, "data": row.to_dict()}
+
+    def handle_bus_message(self, node_id: str, message: dict):
+        if message["type"] == "change":
+            self._db.apply_change(message["table"], message["uid"], message["data"])
+            if message["table"] == UserKeyTable.TABLE_NAME:
+                # the user registered again or sent a new key on the other node
+                self._session_keys.invalidate(message["uid"])
+                self._public_keys.invalidate(message["uid"])
+
+        elif message["type"] == "deliver":
+            self.deliver(des_uid=message["des_uid"], message=parse_message(message["message"]), forward=False)
+
+        elif message["type"] == "stream":
+            self.handle_stream_message_of_node(des_uid=message["des_uid"], message=parse_message(message["message"]))
+
+        elif message["type"] == "online":
+            uid = message["uid"]
+            # the user (re)connected to the node, the cached node of the user is out of date
+            self._uid_directory.invalidate(uid)
+            # what waited here for the user goes to its node, before the new messages to it
+            with self._mailbox.delivery_lock(uid):
+                rows = self._mailbox.drain(uid)
+                for index, row in enumerate(rows):
+                    if not self.forward_to_node(des_uid=uid, message=row.message, node_id=node_id):
+                        self._mailbox.retry(rows[index:])
+                        break
+
+        elif message["type"] == "offline":
+            self._uid_directory.invalidate(message["uid"])
+
+    def get_session_key(self, uid: str) -> EncryptorAESKey:
+        """Return the AES key of the user, decrypting or deriving it from the stored key only on a cache miss."""
+        aes_key = self._session_keys.get(uid)
+        self._metrics.counter("session_key_cache_total", "Session key cache lookups.",
+                              result="miss" if aes_key is None else "hit").inc()
+        if aes_key is None:
+            user_key_row = self._db.user_key_table.find_by_uid(uid)
+            suite = get_suite(user_key_row.suite)
+            start = time.perf_counter()
+            if suite.USES_KEY_AGREEMENT:
+                aes_key = suite.derive_aes_key(private_key=self._agreement_keys[suite.NAME][0],
+                                               peer_public_key=EncryptorECCKey(user_key_row.agreement_key))
+                stage = "key_agreement"
+            else:
+                decrypted_aes_key = EncryptorRSA().decrypt(key=self._private_key,
+                                                           content=user_key_row.encrypted_aes_key)
+                aes_key = EncryptorAESKey(key=decrypted_aes_key)
+                stage = "rsa_key_decrypt"
+            self.record_stages(((stage, time.perf_counter() - start),))
+            self._session_keys.put(uid, aes_key)
+        return aes_key
+
+    def get_public_key(self, uid: str) -> SigningKey:
+        """Return the public key of the user, the key is imported once and reused while it's in the cache."""
+        public_key = self._public_keys.get(uid)
+        if public_key is None:
+            user_key_row = self._db.user_key_table.find_by_uid(uid)
+            public_key = get_suite(user_key_row.suite).import_key(user_key_row.public_key)
+            self._public_keys.put(uid, public_key)
+        return public_key
+
+    def encode_for(self, sock, message: CommunicationMessage) -> bytes:
+        """Encode the message with the codec that was negotiated with the connection."""
+        with self._metrics.histogram("stage_seconds", stage="encode").time():
+            return message.encode(codec=self._connections.codec_of(sock))
 
     def send_by_secure_channel(self, sock: socket, content):
         """simulate secure channel for opt sending"""
-        self._logger.info(f"Sending opt by secured channel")
+        self._logger.info("Sending opt by secured channel")
         self.send_msg(sock=sock,content=content)
 
-    def send_msg(self, sock: socket, content:bytes):
-        self._logger.info(f"Server sending message to {content.decode()}")
+    def send_msg(self, sock: socket, content:bytes) -> bool:
+        """Send the data, return False if the connection failed or can't take more data now."""
+        self._logger.sampled(logging.DEBUG, "Server sending %d bytes", len(content))
+        connection = self._connections.get(sock)
+        outbound_queue = connection.outbound_queue if connection else None
+        if outbound_queue is not None:
+            # the connection's writer sends it, this thread doesn't wait for a slow reader
+            with self._metrics.histogram("stage_seconds", stage="send").time():
+                queued = outbound_queue.put(content)
+            if not queued:
+                self._logger.warning("The connection is closed or too slow, the data wasn't queued.")
+                return False
+            self.record_sent(content)
+            return True
+
         try:
             # Send data
-            sock.sendall(content)
+            with self._metrics.histogram("stage_seconds", stage="send").time():
+                sock.sendall(content)
+            self.record_sent(content)
+            return True
         except BrokenPipeError:
-            print("Connection broken. Unable to send data.")
+            self._logger.warning("Connection broken. Unable to send data.")
         except ConnectionResetError:
-            print("Connection reset by peer.")
+            self._logger.warning("Connection reset by peer.")
         except socket.timeout:
-            print("Send operation timed out.")
+            self._logger.warning("Send operation timed out.")
         except OSError as e:
-            print(f"OS error occurred: {e}")
+            self._logger.error("OS error occurred: %s", e)
         except ValueError as e:
-            print(f"Value error: {e}")
+            self._logger.error("Value error: %s", e)
+        return False
 
-    def start(self):
+    def start(self, host: str = 'localhost', port: int = 12345):
         self._logger.info("Start server")
 
         # create server's private and public keys
-        self._private_key, self._public_key = EncryptorRSAKey.create_keys()
-
-        # set host and port of the server
-        host = 'localhost'
-        port = 12345
-
+        self.create_keys()
+        self.start_crypto_pool()
+        self.start_admin_server()
+        self.start_peer_bus()
+        self._timer_wheel.start()
 
         # create a socket object
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
             server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if self._reuse_port:
+                # all the workers listen on the port, the kernel spreads the new connections between them
+                server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
             server_socket.bind((host, port))
             server_socket.listen()
 
             self._logger.info("Server is listening for connections...")
 
             # accept and handle client connections
-            while True:
-                self._logger.info("Wait for a new client")
-                client_socket, address = server_socket.accept()
-                self._logger.info("New connection with client")
-                with self._lock:
-                    self._clients.append(client_socket)
-
-                client_handler = threading.Thread(target=self.handle_msg_receiving,
-                                                  args=(client_socket, address))
-                client_handler.daemon = True # ensures thread exits when main program ends
-                client_handler.start()
+            try:
+                while True:
+                    self._logger.info("Wait for a new client")
+                    client_socket, address = server_socket.accept()
+                    self._logger.info("New connection with client")
+                    connection = self._connections.open(client_socket, address=address,
+                                                        outbound_queue=self.create_outbound_queue(client_socket))
+                    self.start_connection_timer(connection)
+
+                    client_handler = threading.Thread(target=self.handle_msg_receiving,
+                                                      args=(client_socket, address))
+                    client_handler.daemon = True # ensures thread exits when main program ends
+                    client_handler.start()
+            finally:
+                self._timer_wheel.stop()
+                self.stop_peer_bus()
+                self.stop_admin_server()
+                self.stop_crypto_pool()
+                self._db.close()
+
+    def create_outbound_queue(self, sock: socket) -> OutboundQueue:
+        return OutboundQueue(sock=sock,
+                             high_watermark=self._outbound_high_watermark,
+                             low_watermark=self._outbound_low_watermark,
+                             on_slow_consumer=lambda: self.handle_slow_consumer(sock),
+                             on_drained=lambda: self.handle_drained(sock))
+
+    def can_send(self, sock) -> bool:
+        """False while the connection is a slow consumer."""
+        connection = self._connections.get(sock)
+        return connection is None or connection.outbound_queue is None or not connection.outbound_queue.is_slow
+
+    def handle_slow_consumer(self, sock):
+        """The connection has more than the high watermark waiting to be written."""
+        self._logger.warning("Slow consumer, policy %s", self._slow_consumer_policy.value)
+        self._metrics.counter("slow_consumers_total", "Connections that went over the outbound high watermark.",
+                              policy=self._slow_consumer_policy.value).inc()
+        if self._slow_consumer_policy == SlowConsumerPolicyEnum.DISCONNECT:
+            self.disconnect(sock)
+        # with PARK send_msg refuses data until the connection drains, deliver() parks it in the mailbox
+
+    def disconnect(self, sock: socket):
+        """Close the connection from another thread than the one receiving from it."""
+        try:
+            # wakes up the receiving thread, close alone doesn't
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.cleanup_client(sock)
+
+    def handle_drained(self, sock):
+        """The slow consumer caught up, send it what was parked meanwhile."""
+        self._logger.info("Slow consumer drained, delivering its parked messages.")
+        for uid in self._connections.uids_of(sock):
+            self.flush_mailbox(uid)
+
+    def schedule(self, delay: float, callback: Callable, *args) -> Timer:
+        """Call callback(*args) after delay seconds, where the connections are handled."""
+        return self._timer_wheel.schedule(delay, self.run_timer, callback, args)
+
+    def run_timer(self, callback: Callable, args: tuple):
+        """Called on the timer wheel's thread when a timer of schedule() expires."""
+        callback(*args)
+
+    def cancel_timer(self, timers: dict, key):
+        with self._timers_lock:
+            timer = timers.pop(key, None)
+        if timer:
+            timer.cancel()
+
+    def set_timer(self, timers: dict, key, delay: float, callback: Callable, *args):
+        """Schedule the timer of key in timers, in place of the one it had."""
+        with self._timers_lock:
+            timer = timers.pop(key, None)
+            if timer:
+                timer.cancel()
+            timers[key] = self.schedule(delay, callback, *args)
+
+    def start_registration_timers(self, uid: str, sock: socket):
+        self.set_timer(self._opt_timers, uid, self._opt_timeout, self.handle_opt_expired, uid, sock,
+                       self._opt_resends)
+        self.set_timer(self._registration_timers, uid, self._registration_timeout, self.reap_registration, uid, sock)
+
+    def handle_opt_expired(self, uid: str, sock: socket, resends: int):
+        """The OPT wasn't answered in time, send a new one while there are resends left."""
+        registration_row = self._db.registration_table.find_by_uid(uid)
+        if (not registration_row or registration_row.recieved_opt or resends <= 0
+                or self._connections.socket_of(uid) is not sock):
+            with self._timers_lock:
+                self._opt_timers.pop(uid, None)
+            return
+
+        # a late answer to the OPT already got a new one, wait for it
+        waited = (datetime.now() - registration_row.opt_time).total_seconds()
+        if waited < self._opt_timeout:
+            self.set_timer(self._opt_timers, uid, self._opt_timeout - waited, self.handle_opt_expired, uid, sock,
+                           resends)
+            return
+
+        self._logger.warning("The OPT of %s wasn't answered in %s seconds, sending a new one", uid, self._opt_timeout)
+        self._metrics.counter("opt_resent_total", "OPTs sent again since they weren't answered in time.").inc()
+        self.send_opt(uid=uid, sock=sock)
+        self.set_timer(self._opt_timers, uid, self._opt_timeout, self.handle_opt_expired, uid, sock, resends - 1)
+
+    def reap_registration(self, uid: str, sock: Optional[socket]):
+        """Remove a registration that wasn't done in time, and close the connection that started it."""
+        with self._timers_lock:
+            self._registration_timers.pop(uid, None)
+        self.cancel_timer(self._opt_timers, uid)
+        registration_row = self._db.registration_table.find_by_uid(uid)
+        if not registration_row or registration_row.passed_registration:
+            return
+
+        self._logger.warning("The registration of %s wasn't done in %s seconds, removing it",
+                             uid, self._registration_timeout)
+        self._metrics.counter("registrations_reaped_total",
+                              "Registrations removed since they weren't done in time.").inc()
+        self._db.registration_table.remove_row_by_uid(uid)
+        self._db.user_key_table.remove_row_by_uid(uid)
+        self._public_keys.invalidate(uid)
+        if sock is not None and self._connections.socket_of(uid) is sock:
+            self.disconnect(sock)
+
+    def schedule_stale_registrations(self):
+        """The registrations of a previous run that weren't done are removed if they aren't done in time."""
+        for registration_row in self._db.registration_table.rows:
+            if not registration_row.passed_registration:
+                self.set_timer(self._registration_timers, registration_row._uid, self._registration_timeout,
+                               self.reap_registration, registration_row._uid, None)
+
+    def start_connection_timer(self, connection: Connection):
+        """Schedule the heartbeat and idle checks of a new connection."""
+        delay = min(timeout for timeout in (self._heartbeat_interval, self._idle_timeout, float("inf")) if timeout)
+        if delay != float("inf"):
+            connection.timer = self.schedule(delay, self.check_connection, connection.sock)
+
+    def touch(self, sock):
+        """The connection received data, it's alive."""
+        connection = self._connections.get(sock)
+        if connection is not None:
+            # the timer isn't moved on every frame, when it expires it waits for the rest of the time
+            connection.last_received = time.monotonic()
+
+    def check_connection(self, sock):
+        """Send a heartbeat to a connection that was quiet for the heartbeat interval, close an idle one."""
+        connection = self._connections.get(sock)
+        if connection is None:
+            return
+        now = time.monotonic()
+        idle = now - connection.last_received
+        if self._idle_timeout and idle >= self._idle_timeout:
+            self._logger.warning("The connection %s received nothing for %s seconds, closing it",
+                                 connection.address, self._idle_timeout)
+            self._metrics.counter("idle_disconnects_total", "Connections closed since they received nothing.").inc()
+            self.disconnect(sock)
+            return
+
+        delays = []
+        if self._idle_timeout:
+            delays.append(self._idle_timeout - idle)
+        if self._heartbeat_interval:
+            if idle >= self._heartbeat_interval and now - connection.last_heartbeat >= self._heartbeat_interval:
+                uids = list(connection.uids)
+                heartbeat_message = HeartbeatMessage(uid=uids[0] if uids else "")
+                self.send_msg(sock=sock, content=self.encode_for(sock, heartbeat_message))
+                self._metrics.counter("heartbeats_sent_total", "Heartbeats sent to quiet connections.").inc()
+                connection.last_heartbeat = now
+            delays.append(self._heartbeat_interval - min(idle, now - connection.last_heartbeat))
+        connection.timer = self.schedule(min(delays), self.check_connection, sock)
+
+    def handle_heartbeat_msg(self, heartbeat_message: HeartbeatMessage, sock):
+        # receiving it already marked the connection alive, a ping of the client is answered
+        if not heartbeat_message.pong:
+            pong_message = HeartbeatMessage(uid=heartbeat_message.uid, pong=True)
+            self.send_msg(sock=sock, content=self.encode_for(sock, pong_message))
+
+    def handle_expired_message(self, row: PendingMessageTableRow, reason: MailboxDropReasonsEnum):
+        if reason == MailboxDropReasonsEnum.NO_TRIES_LEFT:
+            self._logger.warning("A message to %s couldn't be delivered in any of its tries, dropping it",
+                                 row.des_uid)
+        else:
+            self._logger.info("A message to %s was in the mailbox longer than its ttl, dropping it", row.des_uid)
+        self._metrics.counter("mailbox_expired_total",
+                              "Messages dropped from the mailbox undelivered, by the reason.",
+                              reason=reason.value).inc()
+
+    def create_keys(self):
+        """Create the server's keys of every supported suite, or load them from the keys_dir."""
+        for suite in CRYPTO_SUITES.values():
+            self._signing_keys[suite.NAME] = self.load_or_create_keys(name=suite.NAME.value,
+                                                                      create_keys=suite.create_signing_keys,
+                                                                      import_key=suite.import_key)
+            if suite.USES_KEY_AGREEMENT:
+                self._agreement_keys[suite.NAME] = self.load_or_create_keys(name=f"{suite.NAME.value}_agreement",
+                                                                            create_keys=suite.create_agreement_keys,
+                                                                            import_key=EncryptorECCKey)
+        self._private_key, self._public_key = self._signing_keys[CryptoSuitesEnum.RSA]
+        self._server_private_keys = {name: keys[0] for name, keys in self._signing_keys.items()}
+        self._tickets = ResumptionTickets(key=self.load_or_create_ticket_key(), lifetime=self._ticket_lifetime)
+
+    def load_or_create_ticket_key(self) -> EncryptorAESKey:
+        """The key of the resumption tickets, saved in the keys_dir so that the tickets of every node and of the
+        previous runs open."""
+        if self._keys_dir is None:
+            return EncryptorAESKey.create()
+
+        file_path = os.path.join(self._keys_dir, "ticket.key")
+        if os.path.exists(file_path):
+            return EncryptorAESKey(EncryptorRSAKey.load_key_from_file(file_path).decode())
+
+        ticket_key = EncryptorAESKey.create()
+        os.makedirs(self._keys_dir, exist_ok=True)
+        EncryptorRSAKey.save_key_to_file(ticket_key.str().encode(), file_path)
+        return ticket_key
+
+    def load_or_create_keys(self,
+                            name: str,
+                            create_keys: Callable[[], tuple],
+                            import_key: Callable[[bytes], SigningKey]) -> tuple:
+        """Return the (private, public) keys saved in the keys_dir under the name, create and save them if
+        there are none."""
+        if self._keys_dir is None:
+            return create_keys()
+
+        file_path = os.path.join(self._keys_dir, f"{name}.pem")
+        if os.path.exists(file_path):
+            self._logger.info("Loading the server's %s keys", name)
+            private_key = import_key(EncryptorRSAKey.load_key_from_file(file_path))
+            return private_key, private_key.public_key()
+
+        private_key, public_key = create_keys()
+        os.makedirs(self._keys_dir, exist_ok=True)
+        EncryptorRSAKey.save_key_to_file(private_key.bytes(), file_path)
+        return private_key, public_key
+
+    def start_crypto_pool(self):
+        if self._crypto_workers > 0:
+            self._logger.info("Starting %s crypto workers", self._crypto_workers)
+            self._crypto_pool = CryptoWorkerPool(server_private_keys=self._server_private_keys,
+                                                 workers=self._crypto_workers)
+
+    def stop_crypto_pool(self):
+        if self._crypto_pool:
+            self._crypto_pool.close()
+            self._crypto_pool = None
+
+    def start_admin_server(self):
+        if self._admin_port is not None:
+            self._admin_server = AdminServer(metrics=self._metrics, port=self._admin_port)
+            self._admin_server.start()
+            self._logger.info("Metrics are served on http://127.0.0.1:%s/metrics", self._admin_server.port)
+
+    def stop_admin_server(self):
+        if self._admin_server:
+            self._admin_server.close()
+            self._admin_server = None
+
+    def start_peer_bus(self):
+        if self._peer_bus is not None:
+            self._logger.info("Node %s of %s", self._peer_bus.node_id, [self._peer_bus.node_id] + self._peer_bus.peers)
+            # the users of a previous run of this node are gone
+            self._uid_directory.clear_node(self._peer_bus.node_id)
+            self._peer_bus.start(on_message=self.on_bus_message,
+                                 on_undelivered=self.on_bus_undelivered,
+                                 snapshot=self.bus_snapshot)
+
+    def stop_peer_bus(self):
+        if self._peer_bus is not None:
+            self._peer_bus.close()
+            self._uid_directory.close()
+
+    def register_gauges(self):
+        """Gauges that are read from the server's state on every scrape."""
+        self._metrics.gauge("connections", "Open client connections.", function=lambda: len(self._connections))
+        self._metrics.gauge("online_users", "Users bound to an open connection.",
+                            function=lambda: self._connections.online_count)
+        self._metrics.gauge("receive_loops", "Loops receiving from the connections.",
+                            function=lambda: self._receive_loops)
+        # resources left behind by connections that are gone, all 0 while nothing leaks
+        self._metrics.gauge("leaked_resources", "Closed connections that were never released.",
+                            function=lambda: self._connections.leaked_connections(self.is_closed),
+                            resource="connection")
+        self._metrics.gauge("leaked_resources", "Users bound to a released connection.",
+                            function=self._connections.leaked_uids, resource="uid")
+        self._metrics.gauge("leaked_resources", "Receive loops that run without an open connection.",
+                            function=lambda: max(0, self._receive_loops - len(self._connections)),
+                            resource="receive_loop")
+        self._metrics.gauge("timers", "Timers scheduled on the timer wheel.", function=lambda: len(self._timer_wheel))
+        self._metrics.gauge("streams", "Streams that are relayed now.",
+                            function=lambda: sum(len(connection.streams)
+                                                 for connection in self._connections.connections()))
+        self._metrics.gauge("uid_directory_cache_size", "Cached nodes of users.",
+                            function=lambda: len(self._uid_directory) if self._uid_directory else 0)
+        self._metrics.gauge("outbound_queued_bytes", "Bytes waiting to be written to the connections.",
+                            function=self.outbound_queued_bytes)
+        self._metrics.gauge("slow_consumers", "Connections over the outbound high watermark.",
+                            function=self.slow_consumer_count)
+        self._metrics.gauge("crypto_pool_pending_jobs", "Jobs submitted to the crypto workers and not done yet.",
+                            function=lambda: self._crypto_pool.pending if self._crypto_pool else 0)
+        self._metrics.gauge("session_key_cache_size", "Decrypted AES keys in the cache.",
+                            function=lambda: len(self._session_keys))
+        self._metrics.gauge("public_key_cache_size", "Imported public keys in the cache.",
+                            function=lambda: len(self._public_keys))
+
+    def outbound_queued_bytes(self) -> int:
+        return sum(connection.outbound_queue.queued_bytes for connection in self._connections.connections()
+                   if connection.outbound_queue)
+
+    def slow_consumer_count(self) -> int:
+        return sum(1 for connection in self._connections.connections()
+                   if connection.outbound_queue and connection.outbound_queue.is_slow)
+
+    @staticmethod
+    def is_closed(sock) -> bool:
+        return sock.fileno() == -1
+
+    def record_message(self, message: CommunicationMessage, seconds: float):
+        message_type = type(message).__name__
+        self._metrics.counter("messages_received_total", "Messages received by type.",
+                              message_type=message_type).inc()
+        self._metrics.histogram("message_handle_seconds", "Time to handle a received message, by type.",
+                                message_type=message_type).record(seconds)
+
+    def record_crypto(self, job: CryptoJob, timings: StageTimings, seconds: float):
+        """The time of a crypto job, with the time it waited for a worker, and of every stage of it."""
+        self._metrics.histogram("crypto_job_seconds", "Time of a crypto job including the wait for a worker.",
+                                job=type(job).__name__).record(seconds)
+        self.record_stages(timings)
+
+    def record_stages(self, timings: StageTimings):
+        for stage, seconds in timings:
+            self._metrics.histogram("stage_seconds", "Time of every stage of handling a message.",
+                                    stage=stage).record(seconds)
+
+    def record_sent(self, content: bytes):
+        self._metrics.counter("sends_total", "Sends to the connections, a mailbox flush is one send.").inc()
+        self._metrics.counter("bytes_sent_total", "Bytes queued or written to the connections.").inc(len(content))
 
     def cleanup_client(self, client_socket:socket):
-        # Remove client from the list and close its socket
-        with self._lock:
-            if client_socket in self._clients:
-                self._clients.remove(client_socket)
+        """Release everything of the connection and close it, once, whichever thread gets here first."""
+        # messages for the users of this socket go to the mailbox from now on
+        connection = self._connections.release(client_socket)
         client_socket.close()
+        if connection is None:
+            return
+        if connection.outbound_queue is not None:
+            connection.outbound_queue.close()
         self._logger.info("Closed Client Socket")
+        # the streams that the connection sent end at their receivers
+        for relay in list(connection.streams.values()):
+            self.end_stream(relay=relay, error=StreamErrorsEnum.ABORTED)
+        connection.streams.clear()
+        for uid in connection.uids:
+            if self._connections.socket_of(uid) is None:
+                self.publish_offline(uid)
 
 
 if __name__ == "__main__":
-    service_runner = ServerRunner()
-    service_runner.start()
+    parser = argparse.ArgumentParser(description="Run the chat server.")
+    parser.add_argument("--mode", choices=["threaded", "asyncio"], default="threaded",
+                        help="'threaded' runs a thread per connection, 'asyncio' serves all connections "
+                             "from one event loop.")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="Processes that share the port, every one runs the whole server on its own core.")
+    parser.add_argument("--node-id", default=None,
+                        help="Run as this node of a cluster, one of the --cluster-nodes.")
+    parser.add_argument("--cluster-nodes", default="",
+                        help="Bus addresses of all the nodes of the cluster, e.g. 'a=10.0.0.1:7000,b=10.0.0.2:7000'.")
+    parser.add_argument("--cluster-directory", default=None,
+                        help="SQLite file of the directory of the users' nodes that all the nodes open.")
+    parser.add_argument("--cluster-secret", default=os.environ.get("CHAT_CLUSTER_SECRET"),
+                        help="Secret that the nodes show each other on the bus, CHAT_CLUSTER_SECRET by default, "
+                             "a node doesn't start without it.")
+    parser.add_argument("--cluster-pool-size", type=int, default=DEFAULT_NODE_POOL_SIZE,
+                        help="Connections of a node to every other node.")
+    parser.add_argument("--host", default="localhost")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--db-path", default=None,
+                        help="SQLite file that keeps the data base between runs, in memory only if not set. "
+                             "The workers share it, every node of a cluster needs its own.")
+    parser.add_argument("--mailbox-dir", default=None,
+                        help="Directory for messages of offline users that don't fit in memory.")
+    parser.add_argument("--crypto-workers", type=int, default=0,
+                        help="Processes that run the relay crypto, 0 runs it on the connection's thread "
+                             "(on the default executor of the asyncio server).")
+    parser.add_argument("--slow-consumer-policy", choices=[policy.value for policy in SlowConsumerPolicyEnum],
+                        default=SlowConsumerPolicyEnum.PARK.value,
+                        help="What to do with a connection that has more unsent data than the high watermark.")
+    parser.add_argument("--outbound-high-watermark", type=int, default=4 * 1024 * 1024,
+                        help="Bytes waiting to be written to a connection that make it a slow consumer.")
+    parser.add_argument("--outbound-low-watermark", type=int, default=1024 * 1024,
+                        help="Bytes waiting to be written to a slow consumer when it is considered caught up.")
+    parser.add_argument("--stream-room-timeout", type=float, default=5,
+                        help="Seconds a chunk of a stream waits for its receiver to take the previous ones before the "
+                             "stream is ended, the sender's connection reads nothing else meanwhile.")
+    parser.add_argument("--keys-dir", default=None,
+                        help="Directory of the server's private keys, created on the first run and loaded on the "
+                             "next ones. New keys on every run if not set.")
+    parser.add_argument("--registration-timeout", type=float, default=120,
+                        help="Seconds to finish the registration, after them the registration and its connection "
+                             "are removed.")
+    parser.add_argument("--heartbeat-interval", type=float, default=30,
+                        help="Seconds a connection may receive nothing before it's sent a heartbeat, 0 sends none.")
+    parser.add_argument("--idle-timeout", type=float, default=90,
+                        help="Seconds a connection may receive nothing before it's closed, 0 never closes it.")
+    parser.add_argument("--ticket-lifetime", type=float, default=7 * 24 * 3600,
+                        help="Seconds a resumption ticket lets a client reconnect without registering again.")
+    parser.add_argument("--admin-port", type=int, default=None,
+                        help="Loopback port that serves the metrics as text at /metrics, not served if not set.")
+    parser.add_argument("--log-level", choices=["DEBUG", "INFO", "WARNING", "ERROR"], default="INFO")
+    parser.add_argument("--log-module-levels", default="",
+                        help="Levels of single modules, e.g. 'Server.server_runner=WARNING,Client=DEBUG'.")
+    parser.add_argument("--log-sample-every", type=int, default=1,
+                        help="Log one of every N of the events of every relayed message.")
+    parser.add_argument("--log-json", action="store_true", help="Write the log as JSON lines.")
+    args = parser.parse_args()
+    if args.node_id is not None and (not args.cluster_nodes or not args.cluster_directory):
+        parser.error("A node of a cluster needs --cluster-nodes and --cluster-directory.")
+    if args.node_id is not None and not args.keys_dir:
+        # a node signs and encrypts the messages that it passes to the others with the server keys
+        parser.error("The nodes of a cluster have the same server keys, give them all the same --keys-dir.")
+    if args.node_id is not None and not args.cluster_secret:
+        parser.error("The nodes of a cluster check each other's secret, set --cluster-secret or CHAT_CLUSTER_SECRET.")
+    if args.node_id is not None and args.workers > 1:
+        parser.error("Every node of a cluster is a single process, run more nodes instead of --workers.")
+
+    module_levels = dict(module_level.split("=", 1) for module_level in args.log_module_levels.split(",")
+                         if module_level)
+    logging_arguments = dict(level=args.log_level,
+                             module_levels=module_levels,
+                             json_format=args.log_json,
+                             sample_every=args.log_sample_every)
+    configure_logging(**logging_arguments)
+
+    runner_arguments = dict(db_path=args.db_path,
+                            mailbox_dir=args.mailbox_dir,
+                            crypto_workers=args.crypto_workers,
+                            outbound_high_watermark=args.outbound_high_watermark,
+                            outbound_low_watermark=args.outbound_low_watermark,
+                            slow_consumer_policy=SlowConsumerPolicyEnum(args.slow_consumer_policy),
+                            keys_dir=args.keys_dir,
+                            registration_timeout=args.registration_timeout,
+                            heartbeat_interval=args.heartbeat_interval or None,
+                            idle_timeout=args.idle_timeout or None,
+                            ticket_lifetime=args.ticket_lifetime,
+                            stream_room_timeout=args.stream_room_timeout,
+                            admin_port=args.admin_port)
+    if args.node_id is not None:
+        runner_arguments.update(peer_bus=NodeBus(node_id=args.node_id,
+                                                 nodes=parse_nodes(args.cluster_nodes),
+                                                 pool_size=args.cluster_pool_size,
+                                                 secret=args.cluster_secret),
+                                uid_directory=FileUidDirectory(args.cluster_directory))
+
+    if args.workers > 1:
+        from Server.multi_worker import run_workers
+        run_workers(workers=args.workers,
+                    mode=args.mode,
+                    host=args.host,
+                    port=args.port,
+                    runner_arguments=runner_arguments,
+                    logging_arguments=logging_arguments)
+    elif args.mode == "asyncio":
+        from Server.async_server_runner import AsyncServerRunner
+        AsyncServerRunner(**runner_arguments).start(host=args.host, port=args.port)
+    else:
+        ServerRunner(**runner_arguments).start(host=args.host, port=args.port)
@@ -0,0 +1,30 @@
+from typing import Optional
+
+from Tools.crypto_suites import CryptoSuite
+from Tools.encryptors import EncryptorAESStream
+
+
+class StreamRelay:
+    """A stream that a connection sends through the server, kept on the connection until the stream ends.
+
+    opened decrypts the chunks of the sender and sealed encrypts them again for the receiver, both go on from
+    chunk to chunk. An e2e stream has neither, its chunks are passed on as they are.
+    """
+
+    def __init__(self,
+                 uid: str,
+                 des_uid: str,
+                 stream_id: str,
+                 opened: Optional[EncryptorAESStream] = None,
+                 sealed: Optional[EncryptorAESStream] = None,
+                 sender_suite: Optional[CryptoSuite] = None,
+                 recipient_suite: Optional[CryptoSuite] = None):
+        self.uid = uid
+        self.des_uid = des_uid
+        self.stream_id = stream_id
+        self.opened = opened
+        self.sealed = sealed
+        self.sender_suite = sender_suite
+        self.recipient_suite = recipient_suite
+        # bytes of the chunks that were relayed
+        self.relayed_bytes = 0
@@ -0,0 +1,149 @@
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from typing import Optional
+
+from Tools.lru_cache import LRUCache
+
+
+class UidDirectory(ABC):
+    """Which node (a worker or a server of a cluster) every online user is connected to.
+
+    All the nodes share the directory: a node sets the users that connect to it and removes them when they
+    disconnect, and looks up the node of the receiver of a message that isn't connected to it.
+    """
+
+    @abstractmethod
+    def get_node(self, uid: str) -> Optional[str]:
+        """The id of the user's node, None if the user isn't connected to any node."""
+        pass
+
+    @abstractmethod
+    def set_node(self, uid: str, node_id: str):
+        pass
+
+    @abstractmethod
+    def remove_node(self, uid: str, node_id: str):
+        """Remove the user if it's still on the node, it may have connected to another node meanwhile."""
+        pass
+
+    @abstractmethod
+    def clear_node(self, node_id: str):
+        """Remove all the users of the node, e.g. of a node that starts again after a crash."""
+        pass
+
+    def close(self):
+        pass
+
+
+class LocalUidDirectory(UidDirectory):
+    """In-process directory, for nodes that run in one process (e.g. tests)."""
+
+    def __init__(self):
+        self._nodes: dict[str, str] = {}
+        self._lock = threading.Lock()
+
+    def get_node(self, uid: str) -> Optional[str]:
+        return self._nodes.get(uid)
+
+    def set_node(self, uid: str, node_id: str):
+        with self._lock:
+            self._nodes[uid] = node_id
+
+    def remove_node(self, uid: str, node_id: str):
+        with self._lock:
+            if self._nodes.get(uid) == node_id:
+                del self._nodes[uid]
+
+    def clear_node(self, node_id: str):
+        with self._lock:
+            for uid in [uid for uid, uid_node_id in self._nodes.items() if uid_node_id == node_id]:
+                del self._nodes[uid]
+
+
+class FileUidDirectory(UidDirectory):
+    """Directory in an SQLite file, for nodes on one machine or on a shared file system.
+
+    Every node opens the same file, SQLite locks it between the processes.
+    """
+
+    def __init__(self, path: str):
+        self._path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, isolation_level=None, check_same_thread=False)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("CREATE TABLE IF NOT EXISTS uid_nodes (uid TEXT PRIMARY KEY, node_id TEXT NOT NULL)")
+
+    def get_node(self, uid: str) -> Optional[str]:
+        with self._lock:
+            row = self._connection.execute("SELECT node_id FROM uid_nodes WHERE uid = ?", (uid,)).fetchone()
+        return row[0] if row else None
+
+    def set_node(self, uid: str, node_id: str):
+        with self._lock:
+            self._connection.execute("INSERT OR REPLACE INTO uid_nodes (uid, node_id) VALUES (?, ?)", (uid, node_id))
+
+    def remove_node(self, uid: str, node_id: str):
+        with self._lock:
+            self._connection.execute("DELETE FROM uid_nodes WHERE uid = ? AND node_id = ?", (uid, node_id))
+
+    def clear_node(self, node_id: str):
+        with self._lock:
+            self._connection.execute("DELETE FROM uid_nodes WHERE node_id = ?", (node_id,))
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+class CachedUidDirectory(UidDirectory):
+    """Keeps the answers of a shared directory, so relaying a message doesn't ask the directory every time.
+
+    The nodes tell each other when a user connects or disconnects, and the cached answer of the user is
+    invalidated then. Users that aren't on any node are cached too.
+    """
+
+    # cached answer of a user that isn't on any node
+    _NOWHERE = ""
+
+    def __init__(self, directory: UidDirectory, max_size: int = 100000):
+        self._directory = directory
+        self._cache: LRUCache[str, str] = LRUCache(max_size=max_size)
+        # changes on every invalidation, an answer that was read before an invalidation isn't cached
+        self._generation = 0
+        self._lock = threading.Lock()
+
+    def get_node(self, uid: str) -> Optional[str]:
+        node_id = self._cache.get(uid)
+        if node_id is None:
+            generation = self._generation
+            node_id = self._directory.get_node(uid) or self._NOWHERE
+            with self._lock:
+                if generation == self._generation:
+                    self._cache.put(uid, node_id)
+        return node_id or None
+
+    def set_node(self, uid: str, node_id: str):
+        self._directory.set_node(uid, node_id)
+        self._cache.put(uid, node_id)
+
+    def remove_node(self, uid: str, node_id: str):
+        self._directory.remove_node(uid, node_id)
+        self.invalidate(uid)
+
+    def clear_node(self, node_id: str):
+        self._directory.clear_node(node_id)
+        with self._lock:
+            self._generation += 1
+            self._cache.clear()
+
+    def invalidate(self, uid: str):
+        with self._lock:
+            self._generation += 1
+            self._cache.invalidate(uid)
+
+    def __len__(self):
+        return len(self._cache)
+
+    def close(self):
+        self._directory.close()
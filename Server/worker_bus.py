@@ -0,0 +1,54 @@
+import errno
+import os
+import socket
+
+from Server.peer_bus import PeerBus
+
+
+class WorkerBus(PeerBus):
+    """The bus of the worker processes of a multi-worker server, over Unix sockets.
+
+    Every worker listens on <bus_dir>/worker-<id>.sock, only the user that runs the server can reach the sockets
+    since the directory is its own. Every pair of workers has one connection in each direction.
+    """
+
+    # the workers start together on one machine, one that doesn't listen in a few seconds isn't coming, and
+    # trying to connect again is cheap
+    CONNECT_TIMEOUT = 3.0
+    MAX_RECONNECT_BACKOFF = 1.0
+
+    def __init__(self, worker_id: int, workers: int, bus_dir: str):
+        super().__init__(node_id=str(worker_id), peers=[str(peer_id) for peer_id in range(workers)])
+        self._bus_dir = bus_dir
+
+    @staticmethod
+    def socket_path(bus_dir: str, node_id: str) -> str:
+        return os.path.join(bus_dir, f"worker-{node_id}.sock")
+
+    def create_listener(self) -> socket.socket:
+        path = self.socket_path(self._bus_dir, self.node_id)
+        if os.path.exists(path):
+            os.remove(path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(path)
+        listener.listen()
+        return listener
+
+    def create_connection(self, node_id: str) -> socket.socket:
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            connection.connect(self.socket_path(self._bus_dir, node_id))
+        except OSError:
+            connection.close()
+            raise
+        return connection
+
+    def is_gone(self, error: OSError) -> bool:
+        # the socket file is there but no one listens on it, the worker died without removing it
+        return error.errno == errno.ECONNREFUSED
+
+    def remove_listener(self):
+        try:
+            os.remove(self.socket_path(self._bus_dir, self.node_id))
+        except OSError:
+            pass
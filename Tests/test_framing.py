@@ -0,0 +1,42 @@
+import pytest
+
+from Communication.framing import FrameDecoder, FrameTooLargeError, encode_frame
+
+
+def test_frame_split_across_reads():
+    decoder = FrameDecoder(initial_size=8)
+    data = encode_frame(b"hello world")
+    for i in range(len(data) - 1):
+        decoder.feed(data[i:i + 1])
+        assert list(decoder.frames()) == []
+    decoder.feed(data[-1:])
+    assert list(decoder.frames()) == [b"hello world"]
+
+
+def test_frames_merged_into_one_read():
+    decoder = FrameDecoder(initial_size=8)
+    data = encode_frame(b"first") + encode_frame(b"") + encode_frame(b"third")
+    # the second read completes the last frame
+    decoder.feed(data[:-2])
+    assert list(decoder.frames()) == [b"first", b""]
+    decoder.feed(data[-2:])
+    assert list(decoder.frames()) == [b"third"]
+
+
+def test_frame_bigger_than_the_buffer():
+    decoder = FrameDecoder(initial_size=4)
+    payload = bytes(range(256)) * 4
+    decoder.feed(encode_frame(payload)[:100])
+    assert list(decoder.frames()) == []
+    decoder.feed(encode_frame(payload)[100:])
+    assert list(decoder.frames()) == [payload]
+
+
+def test_oversized_frame():
+    decoder = FrameDecoder(max_frame_size=16)
+    decoder.feed(encode_frame(b"x" * 16))
+    assert list(decoder.frames()) == [b"x" * 16]
+    # the header is enough, the payload isn't waited for
+    decoder.feed(encode_frame(b"x" * 17)[:4])
+    with pytest.raises(FrameTooLargeError):
+        list(decoder.frames())
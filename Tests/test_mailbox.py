@@ -0,0 +1,80 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from Server.DB.tables import PendingMessageTable
+from Server.mailbox import MailboxDropReasonsEnum, OfflineMailbox
+from Tools.timer_wheel import TimerWheel
+
+
+def numbers(rows) -> list:
+    return [row.message["n"] for row in rows]
+
+
+@pytest.fixture
+def dropped():
+    return []
+
+
+# with 2 messages in memory the rest of the queue is on disk
+@pytest.fixture(params=[100, 2], ids=["memory", "spilled"])
+def mailbox(request, tmp_path, dropped):
+    return OfflineMailbox(PendingMessageTable(),
+                          spill_dir=str(tmp_path),
+                          max_messages_in_memory=request.param,
+                          ttl=timedelta(seconds=60),
+                          max_tries=3,
+                          on_expired=lambda row, reason: dropped.append((row.message["n"], reason)))
+
+
+def test_drain_in_order(mailbox):
+    for n in range(5):
+        mailbox.park("a", "b", {"n": n})
+    mailbox.park("a", "c", {"n": "other"})
+    assert mailbox.has_messages("b")
+    assert numbers(mailbox.drain("b")) == [0, 1, 2, 3, 4]
+    assert not mailbox.has_messages("b")
+    assert numbers(mailbox.drain("c")) == ["other"]
+
+
+def test_retry_goes_before_newer_messages(mailbox):
+    for n in range(3):
+        mailbox.park("a", "b", {"n": n})
+    rows = mailbox.drain("b")
+    mailbox.park("a", "b", {"n": "new"})
+    mailbox.retry(rows)
+    rows = mailbox.drain("b")
+    assert numbers(rows) == [0, 1, 2, "new"]
+    assert [row.remain_tries for row in rows] == [2, 2, 2, 3]
+
+
+def test_retry_drops_messages_without_tries(mailbox, dropped):
+    mailbox.park("a", "b", {"n": 0}, remain_tries=1)
+    mailbox.park("a", "b", {"n": 1})
+    mailbox.retry(mailbox.drain("b"))
+    assert numbers(mailbox.drain("b")) == [1]
+    assert dropped == [(0, MailboxDropReasonsEnum.NO_TRIES_LEFT)]
+
+
+def test_drain_drops_expired_messages(mailbox, dropped):
+    mailbox.park("a", "b", {"n": 0}, timestamp=datetime.now() - timedelta(seconds=120))
+    mailbox.park("a", "b", {"n": 1})
+    assert numbers(mailbox.drain("b")) == [1]
+    assert dropped == [(0, MailboxDropReasonsEnum.EXPIRED)]
+
+
+def test_timer_wheel_expires_messages_in_memory(tmp_path):
+    dropped = []
+    timer_wheel = TimerWheel(tick=0.1)
+    mailbox = OfflineMailbox(PendingMessageTable(),
+                             spill_dir=str(tmp_path),
+                             ttl=timedelta(seconds=1),
+                             timer_wheel=timer_wheel,
+                             on_expired=lambda row, reason: dropped.append((row.message["n"], reason)))
+    mailbox.park("a", "b", {"n": 0})
+    mailbox.park("a", "b", {"n": 1}, timestamp=datetime.now() + timedelta(seconds=10))
+    timer_wheel.advance(timer_wheel._start + 2)
+    assert dropped == [(0, MailboxDropReasonsEnum.EXPIRED)]
+    assert numbers(mailbox.drain("b")) == [1]
+    # the drained message's timer was cancelled
+    assert len(timer_wheel) == 0
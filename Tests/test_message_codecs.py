@@ -0,0 +1,54 @@
+import base64
+import json
+
+import pytest
+
+from Communication.Messages.message_codecs import BinaryCodec, JsonCodec, MessageDecodeError, decode_message
+from Communication.Messages.messages import AckMessage, ContentMessage, GroupMessage, StreamChunkMessage
+
+MESSAGES = [
+    ContentMessage(uid="0501234567",
+                   des_uid="0507654321",
+                   content=base64.b64encode(b"\x00secret").decode(),
+                   hmac="ab" * 32,
+                   signature=base64.b64encode(b"signature").decode(),
+                   e2e=True,
+                   compression="zlib"),
+    AckMessage(uid="0501234567", ack="ok", error=None),
+    GroupMessage(uid="0501234567", group_id="friends", members=["0507654321", "0509999999"]),
+    StreamChunkMessage(uid="0501234567", des_uid="0507654321", stream_id="s1",
+                       data=base64.b64encode(b"chunk").decode()),
+]
+
+
+@pytest.mark.parametrize("message", MESSAGES, ids=lambda message: type(message).__name__)
+@pytest.mark.parametrize("codec", [BinaryCodec(), JsonCodec()], ids=lambda codec: codec.NAME.value)
+def test_round_trip(codec, message):
+    decoded = decode_message(codec.encode(message))
+    assert type(decoded) is type(message)
+    assert decoded.__dict__ == message.__dict__
+
+
+@pytest.mark.parametrize("payload", [
+    b"",
+    bytes([BinaryCodec.MAGIC]),
+    bytes([BinaryCodec.MAGIC, 0xEE]),
+    # the last field is shorter than its length
+    BinaryCodec().encode(MESSAGES[0])[:-3],
+    # a length without its field
+    BinaryCodec().encode(MESSAGES[1])[:-2],
+], ids=["empty", "header", "unknown_type", "truncated_field", "truncated_length"])
+def test_malformed_binary_message(payload):
+    with pytest.raises(MessageDecodeError):
+        BinaryCodec().decode(payload)
+
+
+@pytest.mark.parametrize("payload", [
+    b"{not json",
+    b"[]",
+    json.dumps({"type": "no_such_message", "data": {}}).encode(),
+    json.dumps({"type": "ack_message", "data": {"unknown": 1}}).encode(),
+], ids=["not_json", "not_object", "unknown_type", "unknown_field"])
+def test_malformed_json_message(payload):
+    with pytest.raises(MessageDecodeError):
+        decode_message(payload)
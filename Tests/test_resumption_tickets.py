@@ -0,0 +1,68 @@
+import base64
+import time
+
+import pytest
+
+from Server.DB.rows import UserKeyTableRow
+from Server.resumption_tickets import ResumptionTickets
+from Tools.encryptors import EncryptorAES, EncryptorAESKey
+from Tools.tools import Tools
+
+
+@pytest.fixture
+def key():
+    return EncryptorAESKey.create()
+
+
+@pytest.fixture
+def user_key_row():
+    return UserKeyTableRow(uid="0501234567", encrypted_aes_key="wrapped", public_key="public", suite="rsa")
+
+
+def test_open(key, user_key_row):
+    tickets = ResumptionTickets(key=key, lifetime=60)
+    ticket, expires = tickets.issue(uid="0501234567", user_key_row=user_key_row, codec="binary_v1")
+    payload = tickets.open(ticket)
+    assert payload == {"uid": "0501234567",
+                       "keys": ResumptionTickets.keys_fingerprint(user_key_row),
+                       "codec": "binary_v1",
+                       "expires": expires}
+    # another server with the same key opens it too
+    assert ResumptionTickets(key=key, lifetime=60).open(ticket) == payload
+
+
+def test_expired(key, user_key_row, monkeypatch):
+    tickets = ResumptionTickets(key=key, lifetime=60)
+    ticket, expires = tickets.issue(uid="0501234567", user_key_row=user_key_row, codec="json")
+    monkeypatch.setattr(time, "time", lambda: expires + 1)
+    assert tickets.open(ticket) is None
+
+
+def test_tampered(key, user_key_row):
+    tickets = ResumptionTickets(key=key, lifetime=60)
+    ticket, _ = tickets.issue(uid="0501234567", user_key_row=user_key_row, codec="json")
+    sealed, _, hmac = ticket.partition(ResumptionTickets.SEPARATOR)
+    raw = bytearray(base64.b64decode(sealed))
+    raw[-1] ^= 1
+    assert tickets.open(f"{base64.b64encode(raw).decode()}.{hmac}") is None
+    assert tickets.open(f"{sealed}.{'0' * len(hmac)}") is None
+    assert tickets.open(sealed) is None
+    assert tickets.open("") is None
+    assert ResumptionTickets(key=EncryptorAESKey.create(), lifetime=60).open(ticket) is None
+
+
+@pytest.mark.parametrize("payload", ["not json", "[]", '{"uid": "0501234567"}'],
+                         ids=["not_json", "not_object", "missing_fields"])
+def test_malformed(key, payload):
+    # a ticket that verifies, but its payload isn't one that issue() writes
+    tickets = ResumptionTickets(key=key, lifetime=60)
+    sealed = EncryptorAES().encrypt(key=tickets._enc_key, content=payload)
+    hmac = Tools.generate_hmac(key=tickets._mac_key, content=sealed.encode())
+    assert tickets.open(f"{sealed}{ResumptionTickets.SEPARATOR}{hmac}") is None
+
+
+def test_old_format(key, user_key_row):
+    # the tickets that were encrypted and HMACed with the ticket key itself
+    sealed = EncryptorAES().encrypt(key=key, content='{"uid": "0501234567", "expires": 0}')
+    hmac = Tools.generate_hmac(key=key, content=sealed.encode())
+    assert ResumptionTickets(key=key, lifetime=60).open(f"{sealed}.{hmac}") is None
@@ -0,0 +1,64 @@
+import pytest
+
+from Server.DB.rows import PendingMessageTableRow
+from Server.DB.storage import SQLiteStorage
+from Server.DB.tables import PendingMessageTable
+from Server.mailbox import OfflineMailbox
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "chat.db")
+
+
+def test_rows_are_replayed_in_order(path):
+    storage = SQLiteStorage(path)
+    for n in range(5):
+        storage.put("rows", f"r{n}", {"n": n})
+    storage.flush()
+    # a replaced row keeps its place, a deleted row that is added again goes last
+    storage.put("rows", "r0", {"n": "0b"})
+    storage.delete("rows", "r1")
+    storage.put("rows", "r1", {"n": "1b"})
+    storage.put("rows", "r9", {"n": 9})
+    storage.delete("rows", "r9")
+    storage.close()
+
+    storage = SQLiteStorage(path)
+    assert [row["n"] for row in storage.load("rows")] == ["0b", 2, 3, 4, "1b"]
+    assert storage.load("other") == []
+    storage.close()
+
+
+def test_mailbox_survives_a_restart(path, tmp_path):
+    storage = SQLiteStorage(path)
+    mailbox = OfflineMailbox(PendingMessageTable(storage=storage), spill_dir=str(tmp_path / "spill"))
+    for n in range(3):
+        mailbox.park("a", "b", {"n": n})
+    mailbox.retry(mailbox.drain("b"))
+    storage.close()
+
+    storage = SQLiteStorage(path)
+    table = PendingMessageTable(storage=storage)
+    assert all(isinstance(row, PendingMessageTableRow) for row in table.rows)
+    rows = OfflineMailbox(table, spill_dir=str(tmp_path / "spill")).drain("b")
+    assert [row.message["n"] for row in rows] == [0, 1, 2]
+    assert [row.remain_tries for row in rows] == [2, 2, 2]
+    storage.flush()
+    # the drained messages are deleted from the storage too
+    assert storage.load(PendingMessageTable.TABLE_NAME) == []
+    storage.close()
+
+
+@pytest.mark.filterwarnings("ignore::pytest.PytestUnhandledThreadExceptionWarning")
+def test_changes_fail_once_the_writer_stopped(path):
+    storage = SQLiteStorage(path)
+    storage.FLUSH_POLL = 0.01
+    # a malformed change kills the writer thread
+    storage._queue.put(("rows", "r0"))
+    with pytest.raises(RuntimeError):
+        storage.flush()
+    with pytest.raises(RuntimeError):
+        storage.put("rows", "r1", {"n": 1})
+    with pytest.raises(RuntimeError):
+        storage.delete("rows", "r1")
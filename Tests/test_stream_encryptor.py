@@ -0,0 +1,92 @@
+import os
+
+import pytest
+
+from Tools.encryptors import EncryptorAESKey, EncryptorAESStream
+from Tools.tools import Tools
+
+ASSOCIATED_DATA = Tools.stream_fingerprint("0501234567", "0507654321", "s1")
+
+
+def chunks(data: bytes, size: int) -> list[bytes]:
+    return [data[i:i + size] for i in range(0, len(data), size)]
+
+
+@pytest.fixture
+def key():
+    return EncryptorAESKey.create()
+
+
+@pytest.fixture
+def payload():
+    return os.urandom(10000)
+
+
+def seal(key: EncryptorAESKey, payload: bytes, size: int) -> tuple[bytes, list[bytes], str]:
+    sealed = EncryptorAESStream(key=key, associated_data=ASSOCIATED_DATA)
+    return sealed.nonce, [sealed.encrypt(chunk) for chunk in chunks(payload, size)], sealed.hexdigest()
+
+
+def test_open_sealed_chunks(key, payload):
+    nonce, sealed_chunks, hmac = seal(key, payload, 1000)
+    opened = EncryptorAESStream(key=key, nonce=nonce, associated_data=ASSOCIATED_DATA)
+    assert b"".join(opened.decrypt(chunk) for chunk in sealed_chunks) == payload
+    assert opened.verify(hmac)
+
+
+@pytest.mark.parametrize("size", [1, 7, 4096])
+def test_chunking_doesnt_change_the_stream(key, payload, size):
+    nonce, sealed_chunks, hmac = seal(key, payload, 1000)
+    resealed = EncryptorAESStream(key=key, nonce=nonce, associated_data=ASSOCIATED_DATA)
+    assert b"".join(resealed.encrypt(chunk) for chunk in chunks(payload, size)) == b"".join(sealed_chunks)
+    assert resealed.hexdigest() == hmac
+    opened = EncryptorAESStream(key=key, nonce=nonce, associated_data=ASSOCIATED_DATA)
+    assert b"".join(opened.decrypt(chunk) for chunk in chunks(b"".join(sealed_chunks), size)) == payload
+    assert opened.verify(hmac)
+
+
+def test_relay_seals_again_for_the_receiver(key, payload):
+    # the server opens the sender's chunks and seals them with the receiver's key and its own nonce
+    nonce, sealed_chunks, hmac = seal(key, payload, 1000)
+    receiver_key = EncryptorAESKey.create()
+    opened = EncryptorAESStream(key=key, nonce=nonce, associated_data=ASSOCIATED_DATA)
+    resealed = EncryptorAESStream(key=receiver_key, associated_data=ASSOCIATED_DATA)
+    relayed_chunks = [resealed.encrypt(opened.decrypt(chunk)) for chunk in sealed_chunks]
+    assert opened.verify(hmac)
+
+    received = EncryptorAESStream(key=receiver_key, nonce=resealed.nonce, associated_data=ASSOCIATED_DATA)
+    assert b"".join(received.decrypt(chunk) for chunk in relayed_chunks) == payload
+    assert received.verify(resealed.hexdigest())
+
+
+def test_tampered_chunk(key, payload):
+    nonce, sealed_chunks, hmac = seal(key, payload, 1000)
+    sealed_chunks[3] = bytes([sealed_chunks[3][0] ^ 1]) + sealed_chunks[3][1:]
+    opened = EncryptorAESStream(key=key, nonce=nonce, associated_data=ASSOCIATED_DATA)
+    for chunk in sealed_chunks:
+        opened.decrypt(chunk)
+    assert not opened.verify(hmac)
+
+
+def test_missing_chunk(key, payload):
+    nonce, sealed_chunks, hmac = seal(key, payload, 1000)
+    opened = EncryptorAESStream(key=key, nonce=nonce, associated_data=ASSOCIATED_DATA)
+    for chunk in sealed_chunks[:-1]:
+        opened.decrypt(chunk)
+    assert not opened.verify(hmac)
+
+
+def test_other_stream(key, payload):
+    # the chunks of a stream don't verify as the chunks of another one
+    nonce, sealed_chunks, hmac = seal(key, payload, 1000)
+    opened = EncryptorAESStream(key=key,
+                                nonce=nonce,
+                                associated_data=Tools.stream_fingerprint("0501234567", "0507654321", "s2"))
+    for chunk in sealed_chunks:
+        opened.decrypt(chunk)
+    assert not opened.verify(hmac)
+
+
+def test_invalid_nonce(key):
+    with pytest.raises(ValueError):
+        EncryptorAESStream(key=key, nonce=b"short")
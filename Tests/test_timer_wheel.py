@@ -0,0 +1,61 @@
+import pytest
+
+from Tools.timer_wheel import TimerWheel
+
+
+def advance_to(timer_wheel: TimerWheel, tick: int):
+    # half a tick later, so the float division can't round down to the tick before
+    timer_wheel.advance(timer_wheel._start + (tick + 0.5) * timer_wheel._tick)
+
+
+def run_ticks(timer_wheel: TimerWheel, ticks: int, ran: list) -> dict:
+    """Advance the wheel one tick at a time, return the tick every timer ran on by the name it added to ran."""
+    fired = {}
+    for tick in range(1, ticks + 1):
+        advance_to(timer_wheel, tick)
+        for name in ran:
+            fired[name] = tick
+        ran.clear()
+    return fired
+
+
+@pytest.fixture
+def ran():
+    return []
+
+
+@pytest.mark.parametrize("ticks", [1, 63, 64, 65, 100, 4095, 4096, 4097, 5000])
+def test_timer_runs_on_its_tick(ticks, ran):
+    # timers further than a turn of the first level cascade down before they run
+    timer_wheel = TimerWheel(tick=1.0)
+    timer_wheel.schedule(ticks, ran.append, "timer")
+    assert run_ticks(timer_wheel, ticks + 1, ran) == {"timer": ticks}
+    assert len(timer_wheel) == 0
+
+
+def test_timers_scheduled_while_the_wheel_turns(ran):
+    timer_wheel = TimerWheel(tick=1.0)
+    advance_to(timer_wheel, 60)
+    for ticks in (3, 10, 70, 200):
+        timer_wheel.schedule(ticks, ran.append, ticks)
+    fired = run_ticks(timer_wheel, 300, ran)
+    assert fired == {3: 63, 10: 70, 70: 130, 200: 260}
+
+
+def test_cancel(ran):
+    timer_wheel = TimerWheel(tick=1.0)
+    kept = timer_wheel.schedule(100, ran.append, "kept")
+    cancelled = timer_wheel.schedule(100, ran.append, "cancelled")
+    cancelled.cancel()
+    assert len(timer_wheel) == 1 and kept.active and not cancelled.active
+    # a cancelled timer isn't moved down the levels either
+    assert run_ticks(timer_wheel, 101, ran) == {"kept": 100}
+    cancelled.cancel()
+    assert len(timer_wheel) == 0
+
+
+def test_failed_callback_doesnt_stop_the_others(ran):
+    timer_wheel = TimerWheel(tick=1.0)
+    timer_wheel.schedule(5, lambda: 1 / 0)
+    timer_wheel.schedule(5, ran.append, "after")
+    assert run_ticks(timer_wheel, 6, ran) == {"after": 5}
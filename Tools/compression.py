@@ -0,0 +1,141 @@
+import lzma
+import zlib
+from abc import ABC, abstractmethod
+from enum import Enum
+from typing import Optional
+
+# nothing is decompressed to more than the largest frame, so a small message can't expand to a huge one
+MAX_DECOMPRESSED_SIZE = 16 * 1024 * 1024
+
+# content shorter than this is sent as is, the compression overhead is bigger than what it saves
+COMPRESSION_THRESHOLD = 64
+
+# common chat text, shared by both sides so even short messages find matches. zlib finds the end of the
+# dictionary with the shortest distances, so the most common strings are last.
+PRESET_DICTIONARY = (
+    b"thanks a lot, see you tomorrow. what do you think about it? I don't know, maybe later. "
+    b"sorry, I can't talk right now. call me when you can. where are you? on my way, I'll be there soon. "
+    b"did you see the message I sent you? let me know when you're home. happy birthday! good morning, "
+    b"good night. how are you doing today? I'm fine, thank you. are we still meeting tonight? "
+    b"what time? at eight. okay, sounds good. yes, no problem. I love you. of course. "
+    b"Hey, are you there? Hi, how are you? ok thanks, you too. see you later. lol haha :) "
+)
+
+
+# all supported compressions of the message content.
+class CompressionsEnum(str, Enum):
+    NONE = "none"
+    ZLIB = "zlib"
+    # zlib with PRESET_DICTIONARY, best for short messages
+    ZLIB_DICT = "zlib_dict"
+    LZMA = "lzma"
+
+
+class Compression(ABC):
+    """Compresses the content of a message before it's encrypted."""
+
+    NAME: CompressionsEnum
+
+    @abstractmethod
+    def compress(self, data: bytes) -> bytes:
+        pass
+
+    @abstractmethod
+    def decompress(self, data: bytes) -> bytes:
+        """Raise an ValueError if the data is invalid or decompresses to more than MAX_DECOMPRESSED_SIZE."""
+        pass
+
+
+class NoCompression(Compression):
+    NAME = CompressionsEnum.NONE
+
+    def compress(self, data: bytes) -> bytes:
+        return data
+
+    def decompress(self, data: bytes) -> bytes:
+        return data
+
+
+class ZlibCompression(Compression):
+
+    def __init__(self, name: CompressionsEnum, zdict: Optional[bytes] = None, level: int = 6):
+        self.NAME = name
+        self._zdict = zdict
+        self._level = level
+
+    def compress(self, data: bytes) -> bytes:
+        # raw deflate, the zlib header and checksum aren't needed under the HMAC
+        if self._zdict:
+            compressor = zlib.compressobj(self._level, zlib.DEFLATED, -zlib.MAX_WBITS, zdict=self._zdict)
+        else:
+            compressor = zlib.compressobj(self._level, zlib.DEFLATED, -zlib.MAX_WBITS)
+        return compressor.compress(data) + compressor.flush()
+
+    def decompress(self, data: bytes) -> bytes:
+        if self._zdict:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS, zdict=self._zdict)
+        else:
+            decompressor = zlib.decompressobj(-zlib.MAX_WBITS)
+        try:
+            decompressed = decompressor.decompress(data, MAX_DECOMPRESSED_SIZE)
+        except zlib.error as e:
+            raise ValueError(f"Invalid {self.NAME.value} content: {e}")
+        if decompressor.unconsumed_tail or not decompressor.eof:
+            raise ValueError(f"The {self.NAME.value} content is truncated or too large.")
+        return decompressed
+
+
+class LzmaCompression(Compression):
+    NAME = CompressionsEnum.LZMA
+
+    # raw LZMA2 stream, the xz container adds more than a short message weighs
+    FILTERS = [{"id": lzma.FILTER_LZMA2, "preset": 6}]
+
+    def compress(self, data: bytes) -> bytes:
+        return lzma.compress(data, format=lzma.FORMAT_RAW, filters=self.FILTERS)
+
+    def decompress(self, data: bytes) -> bytes:
+        decompressor = lzma.LZMADecompressor(format=lzma.FORMAT_RAW, filters=self.FILTERS)
+        try:
+            decompressed = decompressor.decompress(data, MAX_DECOMPRESSED_SIZE)
+        except lzma.LZMAError as e:
+            raise ValueError(f"Invalid {self.NAME.value} content: {e}")
+        if not decompressor.eof:
+            raise ValueError(f"The {self.NAME.value} content is truncated or too large.")
+        return decompressed
+
+
+COMPRESSIONS: dict[CompressionsEnum, Compression] = {
+    CompressionsEnum.ZLIB_DICT: ZlibCompression(CompressionsEnum.ZLIB_DICT, zdict=PRESET_DICTIONARY),
+    CompressionsEnum.ZLIB: ZlibCompression(CompressionsEnum.ZLIB),
+    CompressionsEnum.LZMA: LzmaCompression(),
+    CompressionsEnum.NONE: NoCompression(),
+}
+
+
+def get_compression(name: Optional[str]) -> Compression:
+    """The compression by its name, an empty flag means the content isn't compressed."""
+    return COMPRESSIONS[CompressionsEnum(name or CompressionsEnum.NONE)]
+
+
+def choose_compression(offered: Optional[list[str]]) -> Compression:
+    """Pick the first compression the peer offered that is supported here, no compression if none is."""
+    for name in offered or []:
+        if name in COMPRESSIONS.keys():
+            return COMPRESSIONS[CompressionsEnum(name)]
+    return COMPRESSIONS[CompressionsEnum.NONE]
+
+
+def compress(data: bytes, compression: Compression, threshold: int = COMPRESSION_THRESHOLD) -> (bytes, str):
+    """Compress the data if it's worth it, return the data and the compression flag of the message."""
+    if compression.NAME == CompressionsEnum.NONE or len(data) < threshold:
+        return data, ""
+    compressed = compression.compress(data)
+    if len(compressed) >= len(data):
+        return data, ""
+    return compressed, compression.NAME.value
+
+
+def decompress(data: bytes, flag: str) -> bytes:
+    """Undo compress by the compression flag of the message."""
+    return get_compression(flag).decompress(data)
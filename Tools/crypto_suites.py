@@ -0,0 +1,164 @@
+import base64
+from abc import ABC, abstractmethod
+from enum import Enum
+from typing import Union, Optional
+
+from Crypto.Hash import SHA256
+from Crypto.Protocol.DH import key_agreement
+from Crypto.Protocol.KDF import HKDF
+from Crypto.Signature import eddsa
+
+from Tools.encryptors import EncryptorAESKey, EncryptorRSAKey, EncryptorECCKey, EncryptorRSA
+from Tools.tools import Tools
+
+SigningKey = Union[EncryptorRSAKey, EncryptorECCKey]
+
+
+# all supported suites of signature and AES key exchange.
+class CryptoSuitesEnum(str, Enum):
+    # RSA-2048 PKCS#1 v1.5 signatures, the client's AES key is sent encrypted with the server's RSA key
+    RSA = "rsa2048"
+    # Ed25519 signatures, the AES key is derived from an X25519 key agreement
+    ED25519_X25519 = "ed25519_x25519"
+
+
+class CryptoSuite(ABC):
+    """The signature scheme and the way the AES key is shared, negotiated during the registration."""
+
+    NAME: CryptoSuitesEnum
+    # True if the AES key is derived from a key agreement instead of being sent encrypted
+    USES_KEY_AGREEMENT: bool = False
+
+    @abstractmethod
+    def create_signing_keys(self) -> (SigningKey, SigningKey):
+        pass
+
+    @abstractmethod
+    def import_key(self, key: Union[bytes, str]) -> SigningKey:
+        pass
+
+    @abstractmethod
+    def sign(self, private_key: SigningKey, hmac: str) -> str:
+        pass
+
+    @abstractmethod
+    def verify(self, public_key: SigningKey, signature: str, hmac: str):
+        """Raise an ValueError, TypeError if verification fails."""
+        pass
+
+    def create_agreement_keys(self) -> (EncryptorECCKey, EncryptorECCKey):
+        raise NotImplementedError(f"{self.NAME} doesn't use a key agreement.")
+
+    def derive_aes_key(self, private_key: EncryptorECCKey, peer_public_key: EncryptorECCKey) -> EncryptorAESKey:
+        raise NotImplementedError(f"{self.NAME} doesn't use a key agreement.")
+
+    @abstractmethod
+    def wrap_session_key(self,
+                         peer_public_key: SigningKey,
+                         peer_agreement_key: Optional[EncryptorECCKey]) -> (EncryptorAESKey, str):
+        """Create a session key for a peer of this suite, return it with the form only the peer can open."""
+        pass
+
+    @abstractmethod
+    def unwrap_session_key(self,
+                           private_key: SigningKey,
+                           agreement_private_key: Optional[EncryptorECCKey],
+                           wrapped_key: str) -> EncryptorAESKey:
+        pass
+
+
+class RSASuite(CryptoSuite):
+    NAME = CryptoSuitesEnum.RSA
+
+    def create_signing_keys(self) -> (EncryptorRSAKey, EncryptorRSAKey):
+        return EncryptorRSAKey.create_keys()
+
+    def import_key(self, key: Union[bytes, str]) -> EncryptorRSAKey:
+        return EncryptorRSAKey(key)
+
+    def sign(self, private_key: EncryptorRSAKey, hmac: str) -> str:
+        return Tools.create_signature(rsa_private_key=private_key, hmac=hmac)
+
+    def verify(self, public_key: EncryptorRSAKey, signature: str, hmac: str):
+        Tools.varify_signature(rsa_public_key=public_key, signature=signature, hmac=hmac)
+
+    def wrap_session_key(self,
+                         peer_public_key: EncryptorRSAKey,
+                         peer_agreement_key: Optional[EncryptorECCKey]) -> (EncryptorAESKey, str):
+        session_key = EncryptorAESKey.create()
+        return session_key, EncryptorRSA().encrypt(key=peer_public_key, content=session_key.str())
+
+    def unwrap_session_key(self,
+                           private_key: EncryptorRSAKey,
+                           agreement_private_key: Optional[EncryptorECCKey],
+                           wrapped_key: str) -> EncryptorAESKey:
+        return EncryptorAESKey(EncryptorRSA().decrypt(key=private_key, content=wrapped_key))
+
+
+class Ed25519X25519Suite(CryptoSuite):
+    NAME = CryptoSuitesEnum.ED25519_X25519
+    USES_KEY_AGREEMENT = True
+
+    # binds the derived key to this protocol
+    KDF_CONTEXT = b"chat_sjenko aes key"
+
+    def create_signing_keys(self) -> (EncryptorECCKey, EncryptorECCKey):
+        return EncryptorECCKey.create_keys(curve='Ed25519')
+
+    def import_key(self, key: Union[bytes, str]) -> EncryptorECCKey:
+        return EncryptorECCKey(key)
+
+    def sign(self, private_key: EncryptorECCKey, hmac: str) -> str:
+        signature = eddsa.new(private_key.ecc_key(), 'rfc8032').sign(hmac.encode())
+        return base64.b64encode(signature).decode('utf-8')
+
+    def verify(self, public_key: EncryptorECCKey, signature: str, hmac: str):
+        eddsa.new(public_key.ecc_key(), 'rfc8032').verify(hmac.encode(), base64.b64decode(signature))
+
+    def create_agreement_keys(self) -> (EncryptorECCKey, EncryptorECCKey):
+        return EncryptorECCKey.create_keys(curve='Curve25519')
+
+    def derive_aes_key(self, private_key: EncryptorECCKey, peer_public_key: EncryptorECCKey) -> EncryptorAESKey:
+        key = key_agreement(static_priv=private_key.ecc_key(),
+                            static_pub=peer_public_key.ecc_key(),
+                            kdf=lambda secret: HKDF(secret, 32, b"", SHA256, context=self.KDF_CONTEXT))
+        return EncryptorAESKey(key)
+
+    def wrap_session_key(self,
+                         peer_public_key: EncryptorECCKey,
+                         peer_agreement_key: Optional[EncryptorECCKey]) -> (EncryptorAESKey, str):
+        # an ephemeral key agreement with the peer's agreement key, the peer gets our ephemeral public key
+        ephemeral_private_key, ephemeral_public_key = self.create_agreement_keys()
+        session_key = self.derive_aes_key(private_key=ephemeral_private_key, peer_public_key=peer_agreement_key)
+        return session_key, ephemeral_public_key.str()
+
+    def unwrap_session_key(self,
+                           private_key: EncryptorECCKey,
+                           agreement_private_key: Optional[EncryptorECCKey],
+                           wrapped_key: str) -> EncryptorAESKey:
+        return self.derive_aes_key(private_key=agreement_private_key, peer_public_key=EncryptorECCKey(wrapped_key))
+
+
+CRYPTO_SUITES: dict[CryptoSuitesEnum, CryptoSuite] = {
+    CryptoSuitesEnum.ED25519_X25519: Ed25519X25519Suite(),
+    CryptoSuitesEnum.RSA: RSASuite(),
+}
+
+# the suite of clients that don't advertise any suite
+DEFAULT_SUITE = CryptoSuitesEnum.RSA
+
+
+def get_suite(name: Optional[str]) -> CryptoSuite:
+    return CRYPTO_SUITES[CryptoSuitesEnum(name or DEFAULT_SUITE)]
+
+
+def choose_suite(offered: Optional[list[str]]) -> Optional[CryptoSuite]:
+    """Pick the suite for a registering client, None if it isn't supported here.
+
+    The client creates its public key for the first suite it offers, so that's the suite that is used,
+    clients that don't offer anything get the default suite.
+    """
+    name = offered[0] if offered else DEFAULT_SUITE
+    if name not in CRYPTO_SUITES.keys():
+        return None
+    return CRYPTO_SUITES[CryptoSuitesEnum(name)]
@@ -1,9 +1,11 @@
 import base64
+import os
 from abc import ABC, abstractmethod
-from typing import Union
+from typing import Union, Optional
 
 from Crypto.Cipher import AES, PKCS1_OAEP
-from Crypto.PublicKey import RSA
+from Crypto.Hash import HMAC, SHA256
+from Crypto.PublicKey import RSA, ECC
 from Crypto.Random import get_random_bytes
 
 
@@ -59,26 +61,90 @@ class EncryptorAES(Encryptor):
 
     # Encrypt with AES in CTR mode
     def encrypt(self, key: EncryptorAESKey, content: str) -> str:
+        return self.encrypt_bytes(key=key, data=content.encode(self.ENCODING_STD))
+
+    # Decrypt with AES in CTR mode
+    def decrypt(self, key: EncryptorAESKey, content: str) -> str:
+        return self.decrypt_bytes(key=key, content=content).decode(self.ENCODING_STD)
+
+    def encrypt_bytes(self, key: EncryptorAESKey, data: bytes) -> str:
+        """Encrypt raw bytes (e.g. compressed content) instead of text."""
         nonce = get_random_bytes(8)
         cipher = AES.new(key.bytes(), AES.MODE_CTR, nonce=nonce)
         self._used_nonce = cipher.nonce  # update the last used nonce.
-        ciphertext = cipher.encrypt(content.encode(self.ENCODING_STD))
+        ciphertext = cipher.encrypt(data)
 
         return base64.b64encode(cipher.nonce + ciphertext).decode(self.ENCODING_STD)
 
-    # Decrypt with AES in CTR mode
-    def decrypt(self, key: EncryptorAESKey, content: str) -> str:
+    def decrypt_bytes(self, key: EncryptorAESKey, content: str) -> bytes:
         raw = base64.b64decode(content)
         nonce, ciphertext = raw[:8], raw[8:]
         cipher = AES.new(key.bytes(), AES.MODE_CTR, nonce=nonce)
-        return cipher.decrypt(ciphertext).decode(self.ENCODING_STD)
+        return cipher.decrypt(ciphertext)
 
     def get_used_nonce(self) -> bytes:
         return self._used_nonce
 
+
+class EncryptorAESStream:
+    """AES-CTR and HMAC of a payload that is encrypted or decrypted in chunks, never held whole in memory.
+
+    The counter continues from one chunk to the next, so the chunks together are the encryption of the whole
+    payload with one nonce however it was split, and the HMAC is updated with every encrypted chunk. The HMAC
+    starts with the associated data (what identifies the stream) and the nonce. The cipher and the HMAC use
+    their own keys, both derived from the AES key.
+    """
+
+    NONCE_SIZE = 8
+
+    def __init__(self, key: EncryptorAESKey, nonce: Optional[bytes] = None, associated_data: bytes = b""):
+        self.nonce = nonce if nonce is not None else get_random_bytes(self.NONCE_SIZE)
+        if len(self.nonce) != self.NONCE_SIZE:
+            raise ValueError(f"The nonce must be {self.NONCE_SIZE} bytes long.")
+        self._cipher = AES.new(self._subkey(key, b"enc"), AES.MODE_CTR, nonce=self.nonce)
+        self._hmac = HMAC.new(self._subkey(key, b"mac"), digestmod=SHA256)
+        self._hmac.update(associated_data)
+        self._hmac.update(self.nonce)
+
+    @staticmethod
+    def _subkey(key: EncryptorAESKey, label: bytes) -> bytes:
+        return HMAC.new(key.bytes(), label, digestmod=SHA256).digest()
+
+    def encrypt(self, data: bytes) -> bytes:
+        encrypted_data = self._cipher.encrypt(data)
+        self._hmac.update(encrypted_data)
+        return encrypted_data
+
+    def decrypt(self, data: bytes) -> bytes:
+        self._hmac.update(data)
+        return self._cipher.decrypt(data)
+
+    def hexdigest(self) -> str:
+        """The HMAC of everything that was encrypted or decrypted so far."""
+        return self._hmac.copy().hexdigest()
+
+    def verify(self, hmac: str) -> bool:
+        try:
+            self._hmac.copy().hexverify(hmac)
+            return True
+        except ValueError:
+            return False
+
+
 class EncryptorRSAKey:
     def __init__(self,key:Union[bytes,str]):
         self._key = key
+        self._rsa_key: Optional[RSA.RsaKey] = None
+
+    def __getstate__(self):
+        # only the PEM is pickled, the receiving process imports the key when it needs it
+        return {"_key": self._key, "_rsa_key": None}
+
+    def rsa_key(self) -> RSA.RsaKey:
+        """Return the imported key object, the PEM is parsed only on the first call."""
+        if self._rsa_key is None:
+            self._rsa_key = RSA.import_key(self.bytes())
+        return self._rsa_key
 
     def bytes(self):
         if isinstance(self._key,bytes):
@@ -92,18 +158,31 @@ class EncryptorRSAKey:
         else:
             return self._key.decode(Encryptor.ENCODING_STD)
 
+    def public_key(self) -> 'EncryptorRSAKey':
+        """The public key of this private key."""
+        public_key = EncryptorRSAKey(self.rsa_key().publickey().export_key())
+        public_key._rsa_key = self.rsa_key().publickey()
+        return public_key
+
     # RSA Key Pair generation
     @staticmethod
     def create_keys() -> ('EncryptorRSAKey', 'EncryptorRSAKey'):
         key = RSA.generate(2048)
-        private_key = key.export_key()
-        public_key = key.publickey().export_key()
-        return EncryptorRSAKey(private_key), EncryptorRSAKey(public_key)
+        private_key = EncryptorRSAKey(key.export_key())
+        public_key = EncryptorRSAKey(key.publickey().export_key())
+
+        # we already have the key objects, no need to parse them again
+        private_key._rsa_key = key
+        public_key._rsa_key = key.publickey()
+        return private_key, public_key
 
     @staticmethod
     def save_key_to_file(key_data, file_path):
-        with open(file_path, "wb") as key_file:
+        # readable by the owner only, and written to a temporary file first so a crash never leaves half a key
+        temporary_path = f"{file_path}.tmp"
+        with open(os.open(temporary_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600), "wb") as key_file:
             key_file.write(key_data)
+        os.replace(temporary_path, file_path)
 
     @staticmethod
     def load_key_from_file(file_path):
@@ -111,16 +190,61 @@ class EncryptorRSAKey:
             return key_file.read()
 
 
+class EncryptorECCKey:
+    """Elliptic curve key (Ed25519 for signatures, Curve25519 for key agreement) held as PEM."""
+
+    def __init__(self,key:Union[bytes,str]):
+        self._key = key
+        self._ecc_key: Optional[ECC.EccKey] = None
+
+    def __getstate__(self):
+        # only the PEM is pickled, the receiving process imports the key when it needs it
+        return {"_key": self._key, "_ecc_key": None}
+
+    def ecc_key(self) -> ECC.EccKey:
+        """Return the imported key object, the PEM is parsed only on the first call."""
+        if self._ecc_key is None:
+            self._ecc_key = ECC.import_key(self.str())
+        return self._ecc_key
+
+    def bytes(self):
+        if isinstance(self._key,bytes):
+            return self._key
+        else:
+            return self._key.encode(Encryptor.ENCODING_STD)
+
+    def str(self):
+        if isinstance(self._key,str):
+            return self._key
+        else:
+            return self._key.decode(Encryptor.ENCODING_STD)
+
+    def public_key(self) -> 'EncryptorECCKey':
+        """The public key of this private key."""
+        public_key = EncryptorECCKey(self.ecc_key().public_key().export_key(format='PEM'))
+        public_key._ecc_key = self.ecc_key().public_key()
+        return public_key
+
+    @staticmethod
+    def create_keys(curve: str) -> ('EncryptorECCKey', 'EncryptorECCKey'):
+        key = ECC.generate(curve=curve)
+        private_key = EncryptorECCKey(key.export_key(format='PEM'))
+        public_key = EncryptorECCKey(key.public_key().export_key(format='PEM'))
+
+        # we already have the key objects, no need to parse them again
+        private_key._ecc_key = key
+        public_key._ecc_key = key.public_key()
+        return private_key, public_key
+
+
 class EncryptorRSA(Encryptor):
 
     def encrypt(self, key: EncryptorRSAKey, content: str) -> str:
-        rsa_key = RSA.import_key(key.bytes())
-        cipher = PKCS1_OAEP.new(rsa_key)
+        cipher = PKCS1_OAEP.new(key.rsa_key())
         ciphertext = cipher.encrypt(content.encode(self.ENCODING_STD))
         return base64.b64encode(ciphertext).decode(self.ENCODING_STD)
 
     def decrypt(self, key: EncryptorRSAKey, content: str) -> str:
-        rsa_key = RSA.import_key(key.bytes())
-        cipher = PKCS1_OAEP.new(rsa_key)
+        cipher = PKCS1_OAEP.new(key.rsa_key())
         decrypted_bytes = cipher.decrypt(base64.b64decode(content))
         return decrypted_bytes.decode(self.ENCODING_STD)
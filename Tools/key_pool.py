@@ -0,0 +1,74 @@
+import queue
+import threading
+from typing import Callable
+
+from Tools.crypto_suites import CryptoSuite, CryptoSuitesEnum, SigningKey
+
+# key pairs kept ready for every suite
+DEFAULT_POOL_SIZE = 2
+
+
+class KeyPairPool:
+    """Key pairs created ahead of time by a background thread, so taking one doesn't wait for the generation.
+
+    RSA-2048 generation takes from a hundred milliseconds to seconds, the pool creates the next pairs while the
+    process does other things (e.g. waits for the user's input or for the server). get() creates a pair itself
+    only when the pool ran out. Every pair is handed out once.
+    """
+
+    def __init__(self, create_keys: Callable[[], tuple[SigningKey, SigningKey]], size: int = DEFAULT_POOL_SIZE):
+        if size <= 0:
+            raise ValueError("size must be a positive number.")
+        self._create_keys = create_keys
+        self._keys: queue.Queue = queue.Queue(maxsize=size)
+        self._closed = threading.Event()
+        self._filler = None
+        self._lock = threading.Lock()
+
+    @property
+    def ready(self) -> int:
+        return self._keys.qsize()
+
+    def start(self):
+        """Start filling the pool, does nothing if it's already filled."""
+        with self._lock:
+            if self._filler is not None:
+                return
+            self._filler = threading.Thread(target=self._fill_loop, name="key-pair-pool")
+            self._filler.daemon = True
+            self._filler.start()
+
+    def get(self) -> tuple[SigningKey, SigningKey]:
+        """Return a (private, public) key pair."""
+        self.start()
+        try:
+            return self._keys.get_nowait()
+        except queue.Empty:
+            return self._create_keys()
+
+    def close(self):
+        self._closed.set()
+
+    def _fill_loop(self):
+        while not self._closed.is_set():
+            keys = self._create_keys()
+            # waits while the pool is full, checking from time to time if it was closed
+            while not self._closed.is_set():
+                try:
+                    self._keys.put(keys, timeout=1)
+                    break
+                except queue.Full:
+                    pass
+
+
+_KEY_POOLS: dict[CryptoSuitesEnum, KeyPairPool] = {}
+_KEY_POOLS_LOCK = threading.Lock()
+
+
+def get_key_pool(suite: CryptoSuite) -> KeyPairPool:
+    """The pool of signing key pairs of the suite, shared by the whole process."""
+    with _KEY_POOLS_LOCK:
+        key_pool = _KEY_POOLS.get(suite.NAME)
+        if key_pool is None:
+            key_pool = _KEY_POOLS[suite.NAME] = KeyPairPool(create_keys=suite.create_signing_keys)
+        return key_pool
@@ -0,0 +1,137 @@
+import logging
+import math
+import threading
+import time
+from typing import Callable, Optional
+
+from Utils.internal_logger import InternalLogger
+
+
+class Timer:
+    """A callback that is scheduled on a TimerWheel, cancel() stops it if it didn't run yet."""
+
+    __slots__ = ("expiry", "callback", "args", "_wheel", "_slot")
+
+    def __init__(self, wheel: 'TimerWheel', expiry: int, callback: Callable, args: tuple):
+        self.expiry = expiry  # the tick that the timer expires on
+        self.callback = callback
+        self.args = args
+        self._wheel = wheel
+        self._slot: Optional[dict] = None
+
+    @property
+    def active(self) -> bool:
+        return self._slot is not None
+
+    def cancel(self):
+        self._wheel.cancel(self)
+
+
+class TimerWheel:
+    """Hierarchical timer wheel, schedules and cancels a timer in O(1) whatever the number of timers.
+
+    Every level has SLOTS slots, a slot of the first level is one tick and a slot of every next level is a whole
+    turn of the level below it. A timer is put in the slot of the lowest level that reaches its expiry, when a
+    level turns the timers of the next slot of the level above are moved down, so a timer is moved at most once
+    per level. With the defaults the levels reach 6.4 seconds, 7 minutes, 7.5 hours and 20 days, timers that are
+    further away wait in the last level and are moved when their slot comes. The callbacks run on the wheel's
+    thread, late by up to a tick.
+    """
+
+    SLOT_BITS = 6
+    SLOTS = 1 << SLOT_BITS
+
+    def __init__(self, tick: float = 0.1, levels: int = 4):
+        if tick <= 0 or levels <= 0:
+            raise ValueError("tick and levels must be positive numbers.")
+        self._logger = InternalLogger(logging_level=logging.DEBUG, name="Tools.timer_wheel")
+        self._tick = tick
+        self._levels: list[list[dict[Timer, None]]] = [[{} for _ in range(self.SLOTS)] for _ in range(levels)]
+        self._start = time.monotonic()
+        self._now_tick = 0  # the last tick that was processed
+        self._count = 0
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def __len__(self):
+        return self._count
+
+    def schedule(self, delay: float, callback: Callable, *args) -> Timer:
+        """Call callback(*args) after delay seconds."""
+        with self._lock:
+            timer = Timer(self, expiry=self._now_tick + max(1, math.ceil(delay / self._tick)), callback=callback,
+                          args=args)
+            self._insert(timer)
+            self._count += 1
+            return timer
+
+    def cancel(self, timer: Timer):
+        with self._lock:
+            if timer._slot is not None:
+                del timer._slot[timer]
+                timer._slot = None
+                self._count -= 1
+
+    def start(self):
+        """Run the timers on a thread of the wheel."""
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run, name="timer-wheel")
+            self._thread.daemon = True
+            self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+
+    def advance(self, now: Optional[float] = None):
+        """Run the timers that expired until now (time.monotonic()), called by the wheel's thread."""
+        target_tick = int(((time.monotonic() if now is None else now) - self._start) / self._tick)
+        while True:
+            with self._lock:
+                if self._now_tick >= target_tick:
+                    return
+                expired = self._next_tick()
+            for timer in expired:
+                try:
+                    timer.callback(*timer.args)
+                except Exception:
+                    self._logger.exception("Timer %s failed", getattr(timer.callback, "__name__", timer.callback))
+
+    def _run(self):
+        while not self._stopped.wait(self._tick):
+            self.advance()
+
+    def _insert(self, timer: Timer):
+        ticks_left = max(0, timer.expiry - self._now_tick)
+        level = 0
+        while level < len(self._levels) - 1 and ticks_left >= 1 << (self.SLOT_BITS * (level + 1)):
+            level += 1
+        # a timer that already expired goes to the current slot of the first level, that is processed next
+        expiry = max(timer.expiry, self._now_tick)
+        slot = self._levels[level][(expiry >> (self.SLOT_BITS * level)) & (self.SLOTS - 1)]
+        slot[timer] = None
+        timer._slot = slot
+
+    def _next_tick(self) -> list[Timer]:
+        """Move to the next tick and return its expired timers, removed from the wheel."""
+        self._now_tick += 1
+        tick = self._now_tick
+        # the levels that turned on this tick, from the top down, pass their next slot to the levels below
+        turned_levels = [level for level in range(1, len(self._levels))
+                         if tick & ((1 << (self.SLOT_BITS * level)) - 1) == 0]
+        for level in reversed(turned_levels):
+            slot = self._levels[level][(tick >> (self.SLOT_BITS * level)) & (self.SLOTS - 1)]
+            timers = list(slot)
+            slot.clear()
+            for timer in timers:
+                self._insert(timer)
+
+        slot = self._levels[0][tick & (self.SLOTS - 1)]
+        expired = []
+        for timer in list(slot):
+            if timer.expiry <= tick:
+                del slot[timer]
+                timer._slot = None
+                expired.append(timer)
+        self._count -= len(expired)
+        return expired
@@ -1,7 +1,6 @@
 import base64
 
 from Crypto.Hash import HMAC, SHA256
-from Crypto.PublicKey import RSA
 from Crypto.Random import get_random_bytes
 from Crypto.Signature import pkcs1_15
 
@@ -33,24 +32,46 @@ class Tools:
         except ValueError:
             return False
 
+    @staticmethod
+    def fingerprint(*parts: str) -> str:
+        """SHA256 hex digest of the parts, to sign several fields with one signature."""
+        hash_obj = SHA256.new()
+        for part in parts:
+            hash_obj.update(part.encode())
+            hash_obj.update(b"\x00")
+        return hash_obj.hexdigest()
+
+    @staticmethod
+    def group_fingerprint(uid: str, group_id: str, content: str) -> str:
+        """What the server signs once for all the members of a group, content is the decrypted content."""
+        return Tools.fingerprint(uid, group_id, content)
+
+    @staticmethod
+    def resumption_fingerprint(uid: str, ticket: str, timestamp: str) -> str:
+        """What the client HMACs with its session key to resume a session, to show the ticket is its own."""
+        return Tools.fingerprint(uid, ticket, timestamp)
+
+    @staticmethod
+    def stream_fingerprint(uid: str, des_uid: str, stream_id: str) -> bytes:
+        """The associated data of the HMAC of a stream, that ties the chunks to their sender and receiver."""
+        return Tools.fingerprint(uid, des_uid, stream_id).encode()
+
     @staticmethod
     def create_signature(rsa_private_key: EncryptorRSAKey,hmac: str) -> str:
 
         # create a signature, by encrypting HMAC with client's private key
-        rsa_private_key = RSA.import_key(rsa_private_key.bytes())
         hash_obj = SHA256.new()
         hash_obj.update(hmac.encode())
-        signature = pkcs1_15.new(rsa_private_key).sign(hash_obj)
+        signature = pkcs1_15.new(rsa_private_key.rsa_key()).sign(hash_obj)
         return base64.b64encode(signature).decode('utf-8')  # Encode the signature as a Base64 string
 
     @staticmethod
     def varify_signature(rsa_public_key:EncryptorRSAKey,signature:str,hmac: str):
         """This function raise an ValueError, TypeError if verification fails"""
 
-        rsa_public_key = RSA.import_key(rsa_public_key.bytes())
         decoded_signature = base64.b64decode(signature)
 
         hash_obj = SHA256.new()
         hash_obj.update(hmac.encode())
 
-        pkcs1_15.new(rsa_public_key).verify(hash_obj, decoded_signature)
\ No newline at end of file
+        pkcs1_15.new(rsa_public_key.rsa_key()).verify(hash_obj, decoded_signature)
\ No newline at end of file
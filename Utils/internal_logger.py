@@ -1,5 +1,12 @@
+import atexit
+import copy
+import itertools
+import json
 import logging
-import os
+import queue
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional, TextIO
 
 
 class ColoredFormatter(logging.Formatter):
@@ -13,31 +20,149 @@ class ColoredFormatter(logging.Formatter):
     }
     RESET = '\033[0m'  # Reset color
 
-    def format(self, record):
+    def formatMessage(self, record):
         log_color = self.COLOR_CODES.get(record.levelname, self.RESET)
-        record.msg = f"{log_color}{record.msg}{self.RESET}"  # Apply color to the message
-        return super().format(record)
+        # color a copy, the record itself may still go to other handlers
+        colored_record = copy.copy(record)
+        colored_record.message = f"{log_color}{record.message}{self.RESET}"  # Apply color to the message
+        return super().formatMessage(colored_record)
+
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line, for log collectors."""
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record),
+            "level": record.levelname,
+            "logger": record.name,
+            "module": record.module,
+            "function": record.funcName,
+            "line": record.lineno,
+            "message": record.getMessage(),
+        }
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class _DeferredQueueHandler(QueueHandler):
+    """Puts the records on the queue with the message merged but not formatted.
+
+    The message is merged here, since its arguments may change after the call returns. The time, colors or JSON
+    and the write to the stream are done by the listener's thread.
+    """
+
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            # the traceback holds the frames of this thread
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
 
 FULL_FORMAT = "%(asctime)s - %(levelname)s - [file- %(module)s |func- %(funcName)s |line- %(lineno)d] - %(message)s"
 PRESENTATION_FORMAT = "%(levelname)s - %(message)s"
-class InternalLogger:
-    def __init__(self,logging_level:int):
-        # Create a logger
-        self._logger = logging.getLogger("Logger")
 
-        self._logger.setLevel(logging_level)  # Set the desired logging level
+# the logger of the whole process, the components log to its children, e.g. "Logger.Server.server_runner"
+ROOT_LOGGER_NAME = "Logger"
+
+_config_lock = threading.Lock()
+_queue_handler: Optional[QueueHandler] = None
+_listener: Optional[QueueListener] = None
+# InternalLogger.sampled() writes one of every _sample_every calls of the same message
+_sample_every = 1
+
+
+def configure_logging(level: int = logging.INFO,
+                      module_levels: Optional[dict[str, int]] = None,
+                      json_format: bool = False,
+                      sample_every: int = 1,
+                      stream: Optional[TextIO] = None):
+    """Set up the logging of the process, may be called again to change it.
 
-        # Create a console handler (output to console)
-        console_handler = logging.StreamHandler()
+    The loggers only put the records on a queue, one listener thread formats them and writes them to the stream
+    (stderr by default), so a slow terminal doesn't slow down the threads that log. module_levels sets the level
+    of a component and everything under it, e.g. {"Server": logging.WARNING, "Server.crypto_pool": logging.DEBUG}.
+    """
+    if sample_every <= 0:
+        raise ValueError("sample_every must be a positive number.")
 
-        # Create a custom format with colors
-        formatter = ColoredFormatter(PRESENTATION_FORMAT)
+    with _config_lock:
+        _configure(level, module_levels, json_format, sample_every, stream)
+
+
+def _configure(level: int, module_levels: Optional[dict[str, int]], json_format: bool, sample_every: int,
+               stream: Optional[TextIO]):
+    """configure_logging() with the lock held."""
+    global _queue_handler, _listener, _sample_every
+    logger = logging.getLogger(ROOT_LOGGER_NAME)
+    if _listener is not None:
+        # writes what was logged with the previous configuration
+        _listener.stop()
+        logger.removeHandler(_queue_handler)
+
+    stream_handler = logging.StreamHandler(stream)
+    stream_handler.setFormatter(JsonFormatter() if json_format else ColoredFormatter(PRESENTATION_FORMAT))
+    log_queue: queue.SimpleQueue = queue.SimpleQueue()
+    _queue_handler = _DeferredQueueHandler(log_queue)
+    _listener = QueueListener(log_queue, stream_handler)
+    _listener.start()
+
+    logger.addHandler(_queue_handler)
+    logger.setLevel(level)
+    # the records are written once, by the listener, and not again by the handlers of the root logger
+    logger.propagate = False
+    for module, module_level in (module_levels or {}).items():
+        logging.getLogger(f"{ROOT_LOGGER_NAME}.{module}").setLevel(module_level)
+    _sample_every = sample_every
+
+
+def stop_logging():
+    """Write the records that are still on the queue and stop the listener's thread."""
+    global _queue_handler, _listener
+    with _config_lock:
+        if _listener is None:
+            return
+        _listener.stop()
+        logging.getLogger(ROOT_LOGGER_NAME).removeHandler(_queue_handler)
+        _queue_handler = None
+        _listener = None
+
+
+atexit.register(stop_logging)
+
+
+class InternalLogger:
+    def __init__(self, logging_level: int, name: str = ""):
+        """The logger of a component, name is its module, e.g. "Server.server_runner".
+
+        The logging is set up with logging_level if the process didn't call configure_logging() before.
+        """
+        with _config_lock:
+            if _listener is None:
+                _configure(logging_level, module_levels=None, json_format=False, sample_every=1, stream=None)
 
-        # Attach the custom format to the handler
-        console_handler.setFormatter(formatter)
+        self._logger = logging.getLogger(f"{ROOT_LOGGER_NAME}.{name}" if name else ROOT_LOGGER_NAME)
+        # message -> number of its calls to sampled()
+        self._sample_counters: dict[str, itertools.count] = {}
 
-        # Add the handler to the logger
-        self._logger.addHandler(console_handler)
+    def sampled(self, level: int, msg: str, *args, **kwargs):
+        """Log one of every sample_every calls with the same msg, for events of every message that is relayed."""
+        if not self._logger.isEnabledFor(level):
+            return
+        if _sample_every > 1:
+            counter = self._sample_counters.get(msg)
+            if counter is None:
+                counter = self._sample_counters.setdefault(msg, itertools.count())
+            if next(counter) % _sample_every:
+                return
+        self._logger.log(level, msg, *args, stacklevel=2, **kwargs)
 
     def __getattr__(self, attr):
         """
@@ -0,0 +1,243 @@
+import threading
+import time
+from typing import Callable, Optional, Union
+
+# the label names and values of a metric, sorted by name
+Labels = tuple[tuple[str, str], ...]
+
+
+class Counter:
+    def __init__(self):
+        self._value = 0
+        self._lock = threading.Lock()
+
+    @property
+    def value(self) -> Union[int, float]:
+        return self._value
+
+    def inc(self, amount: Union[int, float] = 1):
+        with self._lock:
+            self._value += amount
+
+
+class Gauge:
+    """A value that goes up and down, or a function that is called for the value on every scrape."""
+
+    def __init__(self, function: Optional[Callable[[], Union[int, float]]] = None):
+        self._value = 0
+        self._function = function
+        self._lock = threading.Lock()
+
+    @property
+    def value(self) -> Union[int, float]:
+        if self._function is not None:
+            return self._function()
+        return self._value
+
+    def set(self, value: Union[int, float]):
+        self._value = value
+
+    def inc(self, amount: Union[int, float] = 1):
+        with self._lock:
+            self._value += amount
+
+    def dec(self, amount: Union[int, float] = 1):
+        self.inc(-amount)
+
+
+class _Timer:
+    def __init__(self, histogram: 'Histogram'):
+        self._histogram = histogram
+        self._start = 0.0
+
+    def __enter__(self):
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._histogram.record(time.perf_counter() - self._start)
+
+
+class Histogram:
+    """Latencies in seconds, kept in HDR-style log-linear buckets of microseconds.
+
+    Every power of two is split to 2^(SIGNIFICANT_BITS - 1) linear buckets, so a percentile is off by at most
+    1/32 of its value whatever the range, and the memory is bounded by the number of powers of two that were seen
+    (about a thousand buckets for everything from a microsecond to an hour). Recording is a dict increment.
+    """
+
+    SIGNIFICANT_BITS = 6
+
+    def __init__(self):
+        # bucket's lowest value in microseconds -> count
+        self._buckets: dict[int, int] = {}
+        self._count = 0
+        self._sum = 0.0
+        self._max = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def count(self) -> int:
+        return self._count
+
+    @property
+    def sum(self) -> float:
+        return self._sum
+
+    @property
+    def max(self) -> float:
+        return self._max
+
+    def record(self, seconds: float):
+        microseconds = max(0, int(seconds * 1_000_000))
+        shift = max(0, microseconds.bit_length() - self.SIGNIFICANT_BITS)
+        bucket = microseconds >> shift << shift
+        with self._lock:
+            self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+            self._count += 1
+            self._sum += seconds
+            if seconds > self._max:
+                self._max = seconds
+
+    def time(self) -> _Timer:
+        """Record the time of a with block."""
+        return _Timer(self)
+
+    def percentile(self, percent: float) -> float:
+        """The highest value of the bucket of the percentile in seconds, 0 if nothing was recorded."""
+        with self._lock:
+            buckets = sorted(self._buckets.items())
+            count = self._count
+        if not count:
+            return 0.0
+
+        rank = max(1, round(percent / 100 * count))
+        seen = 0
+        for bucket, bucket_count in buckets:
+            seen += bucket_count
+            if seen >= rank:
+                shift = max(0, bucket.bit_length() - self.SIGNIFICANT_BITS)
+                return min(bucket + (1 << shift) - 1, self._max * 1_000_000) / 1_000_000
+        return self._max
+
+
+Metric = Union[Counter, Gauge, Histogram]
+
+
+class _Family:
+    def __init__(self, metric_type: type, help_text: str):
+        self.metric_type = metric_type
+        self.help_text = help_text
+        self.metrics: dict[Labels, Metric] = {}
+
+
+class MetricsRegistry:
+    """Named counters, gauges and histograms with labels, rendered in the Prometheus text format.
+
+    A metric is created on its first use and returned from then on, so instrumented code just asks for it:
+    registry.counter("messages_total", message_type="content").inc()
+    """
+
+    # quantiles that are rendered for every histogram
+    QUANTILES = (0.5, 0.9, 0.99, 0.999)
+
+    def __init__(self, prefix: str = ""):
+        self._prefix = prefix
+        self._families: dict[str, _Family] = {}
+        self._metrics: dict[tuple[str, Labels], Metric] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help_text: str = "", **labels) -> Counter:
+        return self._get(Counter, name, help_text, labels)
+
+    def gauge(self, name: str, help_text: str = "",
+              function: Optional[Callable[[], Union[int, float]]] = None, **labels) -> Gauge:
+        gauge = self._get(Gauge, name, help_text, labels)
+        if function is not None:
+            gauge._function = function
+        return gauge
+
+    def histogram(self, name: str, help_text: str = "", **labels) -> Histogram:
+        return self._get(Histogram, name, help_text, labels)
+
+    def _get(self, metric_type: type, name: str, help_text: str, labels: dict) -> Metric:
+        key = (name, tuple(sorted(labels.items())))
+        metric = self._metrics.get(key)
+        if metric is not None:
+            return metric
+
+        with self._lock:
+            family = self._families.get(name)
+            if family is None:
+                family = self._families[name] = _Family(metric_type, help_text)
+            elif family.metric_type is not metric_type:
+                raise ValueError(f"The metric {name} is a {family.metric_type.__name__}.")
+            family.help_text = family.help_text or help_text
+            metric = family.metrics.get(key[1])
+            if metric is None:
+                metric = family.metrics[key[1]] = metric_type()
+                self._metrics[key] = metric
+            return metric
+
+    def render(self) -> str:
+        """All the metrics in the Prometheus text exposition format, histograms as summaries."""
+        with self._lock:
+            families = [(name, family, list(family.metrics.items())) for name, family in self._families.items()]
+
+        lines = []
+        for name, family, metrics in sorted(families, key=lambda item: item[0]):
+            full_name = self._prefix + name
+            if family.help_text:
+                lines.append(f"# HELP {full_name} {family.help_text}")
+            if family.metric_type is Histogram:
+                lines.append(f"# TYPE {full_name} summary")
+                for labels, histogram in metrics:
+                    for quantile in self.QUANTILES:
+                        quantile_labels = labels + (("quantile", str(quantile)),)
+                        lines.append(f"{full_name}{_format_labels(quantile_labels)} "
+                                     f"{histogram.percentile(quantile * 100):.6f}")
+                    lines.append(f"{full_name}_sum{_format_labels(labels)} {histogram.sum:.6f}")
+                    lines.append(f"{full_name}_count{_format_labels(labels)} {histogram.count}")
+                    lines.append(f"{full_name}_max{_format_labels(labels)} {histogram.max:.6f}")
+                continue
+
+            lines.append(f"# TYPE {full_name} {'counter' if family.metric_type is Counter else 'gauge'}")
+            for labels, metric in metrics:
+                try:
+                    value = metric.value
+                except Exception as e:  # a gauge's function shouldn't break the whole scrape
+                    lines.append(f"# {full_name}{_format_labels(labels)} failed: {e}")
+                    continue
+                lines.append(f"{full_name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+
+def _format_labels(labels: Labels) -> str:
+    if not labels:
+        return ""
+    values = ",".join(f'{name}="{_escape(str(value))}"' for name, value in labels)
+    return "{" + values + "}"
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+class StageClock:
+    """Durations of the stages of one job, taken where the job runs (maybe a worker process) and
+    recorded in the histograms by the caller.
+
+    clock = StageClock()
+    verify()
+    clock.lap("verify")
+    """
+
+    def __init__(self):
+        self.timings: list[tuple[str, float]] = []
+        self._last = time.perf_counter()
+
+    def lap(self, stage: str):
+        """The stage took the time since the previous lap."""
+        now = time.perf_counter()
+        self.timings.append((stage, now - self._last))
+        self._last = now